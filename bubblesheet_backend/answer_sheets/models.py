@@ -68,6 +68,9 @@ class AnswerSheetTemplate(Document):
         return super().save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
+        # Bỏ template đã biên dịch khỏi cache kể cả khi dọn file bị lỗi
+        from grading.template_cache import invalidate_template
+        invalidate_template(self.id)
         try:
             # Delete associated files
             if self.file_pdf and os.path.exists(self.file_pdf):
@@ -9,6 +9,7 @@ import fitz  # PyMuPDF
 from rest_framework.response import Response
 from rest_framework import status
 from reportlab.lib import colors
+from grading.template_cache import invalidate_template
 
 logger = logging.getLogger(__name__)
 
@@ -368,6 +369,9 @@ def generate_answer_sheet(template, output_dir=None, aruco_dir=None, widths=None
         json_path = os.path.join(output_dir, f'{file_id}.json')
         with open(json_path, 'w') as f:
             json.dump(output_data, f, indent=2)
+
+        # Drop any compiled copy of the previous layout
+        invalidate_template(file_id)
         
         return pdf_path, json_path
         
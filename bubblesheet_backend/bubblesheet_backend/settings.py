@@ -148,14 +148,40 @@ ANSWER_SHEET_CONFIG = {
 GRADING_CONFIG = {
     'SCANNED_IMAGE_DIR': os.path.join(MEDIA_ROOT, 'grading', 'scanned_images'),
     'ANNOTATED_IMAGE_DIR': os.path.join(MEDIA_ROOT, 'grading', 'annotated_images'),
+    'ANNOTATION_CACHE_DIR': os.path.join(MEDIA_ROOT, 'grading', 'annotation_cache'),  # Rendered by scan, kept on save
     'MAX_IMAGE_SIZE_MB': 10,
     'RECOMMENDED_IMAGE_SIZE_MB': 5,
     'PREVIEW_CHECK_TIMEOUT': 5,  # seconds
-    'IMAGE_PROCESSING_TIMEOUT': 30,  # seconds
+    'IMAGE_PROCESSING_TIMEOUT': 30,  # seconds, per sheet (scan returns 504, the worker stops at its next stage)
     'API_REQUEST_TIMEOUT': 60,  # seconds
-    'IMAGE_QUALITY': 85,  # JPEG quality
+    'IMAGE_QUALITY': 85,  # Annotated image quality (JPEG/WebP), 100 = fastest PNG level
+    'TEMPLATE_CACHE_SIZE': 32,  # Compiled templates kept in memory per process (LRU)
+    'THRESHOLD_MODE': 'group',  # 'group' (Otsu per question/ID column), 'region' (Otsu per area), 'tiled'
+    'WARP_DPI': 300,  # Resolution of the warped sheet (template is 300 DPI; 150 is ~4x cheaper)
+    'GRADING_EXECUTOR': 'process',  # 'process' (warm worker processes), 'thread' or 'inline' (request thread)
+    'GRADING_WORKERS': 2,  # Sheets graded in parallel per server process
+    'GRADING_QUEUE_DEPTH': 8,  # Sheets allowed to wait for a worker before scans are rejected (503)
+    'GRADING_QUEUE_TIMEOUT': 2,  # seconds a scan waits for a queue slot
+    'ANNOTATION_OUTPUT': 'inline',  # 'inline' (base64 in response) or 'url' (ANNOTATION_CACHE_DIR file)
+    'ANNOTATION_CACHE_TTL': 3600,  # seconds an unsaved rendered annotation is kept
+    'ANNOTATION_THUMBNAIL_WIDTH': 600,  # pixels, for annotate=thumbnail
+    'ANNOTATION_FORMAT': 'jpeg',  # 'jpeg' | 'webp' | 'png'
+    'ANNOTATION_MAX_WIDTH': None,  # pixels, None = no limit
+    'ANNOTATION_MAX_HEIGHT': None,  # pixels, None = no limit
+    'ANNOTATION_CROP': None,  # None (whole sheet) | 'answer_area' | 'student_id' | 'quiz_id' | 'class_id' | 'ids'
+    'SCAN_SESSION_TTL': 300,  # seconds a scan_session keeps its marker tracking seed
+    'MAX_SCAN_SESSIONS': 1000,  # Tracked scan sessions per server process
+    'MAX_QUEUED_JOBS': 100,  # Unfinished async scan jobs per server process
+    'JOB_RESULT_TTL': 600,  # seconds a finished async scan job can be polled
+    'JOB_SPOOL_DIR': None,  # Images of queued async scans wait here on disk (None = system temp dir)
+    'MAX_BATCH_SIZE': 200,  # Max images per batch scan request
+    'ITEM_ANALYSIS_BACKEND': 'engine',  # 'engine' (NumPy, full statistics) | 'aggregate' (MongoDB counts only)
 }
 
+# Giữ ảnh upload (tới MAX_IMAGE_SIZE_MB) trong bộ nhớ thay vì ghi ra file tạm:
+# scan đọc ảnh bằng cv2.imdecode từ bytes, không cần qua đĩa
+FILE_UPLOAD_MAX_MEMORY_SIZE = GRADING_CONFIG['MAX_IMAGE_SIZE_MB'] * 1024 * 1024
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -0,0 +1,110 @@
+"""
+MongoDB aggregation backend for grade statistics.
+
+Instead of loading every Grade of a quiz into Python, one aggregation
+pipeline does the counting in MongoDB: $match on exam_id / teacher_id,
+$project of only the answers / version_code / score / percentage fields,
+$unwind of the answers and a $group per (version, question, answer). Score
+and percentage totals are grouped in the same pipeline ($facet).
+
+MongoDB groups by the raw stored answer value; the Python side only maps
+each distinct value to its answer code (analysis.encode_student_answer)
+and reshapes the result into a QuizStats-like document, so the report is
+built by quiz_stats.quiz_stats_report() exactly as for the materialized
+statistics.
+"""
+from collections import defaultdict
+
+from .analysis import BLANK, encode_student_answer
+from .models import Grade
+from .quiz_stats import version_key
+
+
+def item_counts_pipeline(exam_id, teacher_id):
+    """Aggregation pipeline counting answers per (version, question, value) and score totals"""
+    version = {'$ifNull': ['$version_code', '']}
+    return [
+        {'$match': {'exam_id': exam_id, 'teacher_id': teacher_id}},
+        {'$project': {
+            '_id': 0,
+            'version_code': 1,
+            'score': 1,
+            'percentage': 1,
+            'answers': {'$objectToArray': {'$ifNull': ['$answers', {}]}},
+        }},
+        {'$facet': {
+            'answers': [
+                {'$project': {'version_code': 1, 'answers': 1}},
+                {'$unwind': '$answers'},
+                {'$group': {
+                    '_id': {'v': version, 'q': '$answers.k', 'a': '$answers.v'},
+                    'count': {'$sum': 1},
+                }},
+            ],
+            'versions': [
+                {'$group': {'_id': version, 'count': {'$sum': 1}}},
+            ],
+            'scores': [
+                {'$match': {'score': {'$ne': None}}},
+                {'$group': {'_id': '$score', 'count': {'$sum': 1}}},
+            ],
+            'percentages': [
+                {'$match': {'percentage': {'$ne': None}}},
+                {'$group': {'_id': None, 'count': {'$sum': 1}, 'sum': {'$sum': '$percentage'}}},
+            ],
+        }},
+    ]
+
+
+def stats_from_aggregation(result):
+    """
+    Reshape the pipeline output into a quiz_stats document
+
+    Args:
+        result: The single document returned by item_counts_pipeline()
+
+    Returns:
+        dict: Same layout as the QuizStats document
+    """
+    option_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    for row in result.get('answers', []):
+        question = str(row['_id'].get('q'))
+        code = encode_student_answer(row['_id'].get('a'))
+        if code == BLANK or not question.isdigit():
+            continue
+        option_counts[version_key(row['_id'].get('v'))][question][str(code)] += row['count']
+
+    papers = {version_key(row['_id']): row['count'] for row in result.get('versions', [])}
+
+    histogram = defaultdict(int)
+    score_count, score_sum, score_sq_sum = 0, 0.0, 0.0
+    for row in result.get('scores', []):
+        score, count = float(row['_id']), row['count']
+        histogram[str(int(round(score * 100)))] += count
+        score_count += count
+        score_sum += score * count
+        score_sq_sum += score * score * count
+
+    percentages = (result.get('percentages') or [{}])[0]
+    return {
+        'num_papers': sum(papers.values()),
+        'papers': papers,
+        'option_counts': {v: {q: dict(c) for q, c in qs.items()} for v, qs in option_counts.items()},
+        'score_histogram': dict(histogram),
+        'score_count': score_count,
+        'score_sum': score_sum,
+        'score_sq_sum': score_sq_sum,
+        'percentage_count': percentages.get('count', 0),
+        'percentage_sum': float(percentages.get('sum', 0.0)),
+    }
+
+
+def aggregate_quiz_stats(exam_id, teacher_id):
+    """
+    Statistics of a quiz counted by a MongoDB aggregation (one round trip)
+
+    Returns:
+        dict: quiz_stats document, see quiz_stats.quiz_stats_report()
+    """
+    results = list(Grade._get_collection().aggregate(item_counts_pipeline(exam_id, teacher_id)))
+    return stats_from_aggregation(results[0] if results else {})
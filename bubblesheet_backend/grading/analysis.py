@@ -0,0 +1,398 @@
+"""
+Item analysis engine.
+
+Grades of a quiz are loaded once into a (papers x questions) int8 answer
+matrix and the answer key into a (versions x questions) int8 key matrix.
+Correct / incorrect / blank counts, option distributions and score
+statistics are then computed with vectorized NumPy operations instead of
+one pass over the grades per question.
+
+Classical test theory statistics are computed from the same papers x
+questions correct matrix: item difficulty, upper/lower 27% discrimination
+index, point-biserial correlation with the total score, distractor counts
+per score group, and test-level KR-20 / Cronbach's alpha and SEM.
+
+Answers are compared the way the item-analysis API always has: a student
+answer may be an option index, a [index] list, a numeric string or a
+letter; the key answer is a letter (or an index). A non-blank answer
+without a key answer for the paper's version counts as incorrect.
+"""
+import numpy as np
+
+# Mã đặc biệt trong ma trận int8
+BLANK = -128      # không trả lời (None, '' hoặc -1)
+INVALID = -127    # câu trả lời không đọc được → luôn sai
+NO_KEY = -126     # version không có đáp án cho câu này → luôn sai
+MIN_VALUE = -125  # giá trị hợp lệ trong [MIN_VALUE, 127]
+
+OPTION_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+MIN_OPTIONS = 4
+
+# Nhóm điểm cao / thấp cho chỉ số phân biệt: 27% số bài mỗi nhóm
+DISCRIMINATION_GROUP = 0.27
+
+
+def _clip_code(value):
+    return value if MIN_VALUE <= value <= 127 else INVALID
+
+
+def encode_student_answer(value):
+    """int8 code of a stored student answer (same parsing as the legacy item analysis)"""
+    if value is None or value == '' or value == -1:
+        return BLANK
+    if isinstance(value, list):
+        value = value[0] if value else None
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return _clip_code(value) if isinstance(value, int) else INVALID
+    if isinstance(value, int):
+        return _clip_code(value)
+    if isinstance(value, str):
+        try:
+            return _clip_code(int(value))
+        except ValueError:
+            return _clip_code(ord(value.upper()[0]) - ord('A'))
+    return INVALID
+
+
+def encode_key_answer(answer):
+    """int8 code of an answer-key answer ('A' → 0, ..., missing → NO_KEY)"""
+    if not answer:
+        return NO_KEY
+    if isinstance(answer, str):
+        return _clip_code(ord(answer.upper()[0]) - ord('A'))
+    if isinstance(answer, int):
+        return _clip_code(answer)
+    return NO_KEY
+
+
+def version_answers(version):
+    """{question_str: answer} of a version, matching 'order' or 'question_code' (first question wins)"""
+    answers = {}
+    for q in version.get('questions', []):
+        for key in (str(q.get('order', '')), str(q.get('question_code', ''))):
+            answers.setdefault(key, q.get('answer', ''))
+    return answers
+
+
+class KeyMatrix:
+    """
+    Answer key of a quiz as a (versions + 1) x questions int8 matrix
+
+    The last row is all NO_KEY and is used for papers whose version code is
+    not in the answer key.
+
+    Attributes:
+        version_codes: {version_code: row}
+        codes: np.ndarray (versions + 1, questions) int8
+        display_answers: List[str] correct answer of each question in the first version
+    """
+
+    def __init__(self, versions, num_questions):
+        self.version_codes = {}
+        rows = []
+        for version in versions or []:
+            code = version.get('version_code')
+            if code in self.version_codes:
+                continue
+            answers = version_answers(version) if 'questions' in version else {}
+            self.version_codes[code] = len(rows)
+            rows.append([encode_key_answer(answers.get(str(q))) for q in range(1, num_questions + 1)])
+        rows.append([NO_KEY] * num_questions)
+        self.codes = np.array(rows, dtype=np.int8).reshape(len(rows), num_questions)
+
+        first = version_answers(versions[0]) if versions and 'questions' in versions[0] else {}
+        self.display_answers = [first.get(str(q)) or '' for q in range(1, num_questions + 1)]
+
+    def version_rows(self, version_codes):
+        """Row of each paper's version (unknown versions → the NO_KEY row)"""
+        missing = len(self.codes) - 1
+        return np.fromiter(
+            (self.version_codes.get(code or '', missing) for code in version_codes),
+            dtype=np.intp, count=len(version_codes),
+        )
+
+
+class GradeMatrix:
+    """
+    Grades of a quiz as dense arrays
+
+    Attributes:
+        answers: np.ndarray (papers, questions) int8 student answer codes
+        version_codes: List[str] version code of each paper
+        scores: np.ndarray float64 scores (papers without a score left out)
+        percentages: np.ndarray float64 percentages (papers without one left out)
+    """
+
+    def __init__(self, answers, version_codes, scores, percentages):
+        self.answers = answers
+        self.version_codes = version_codes
+        self.scores = scores
+        self.percentages = percentages
+
+    @property
+    def num_papers(self):
+        return self.answers.shape[0]
+
+    @classmethod
+    def from_documents(cls, documents, num_questions):
+        """
+        Build from grade documents in one pass
+
+        Args:
+            documents: Iterable of dicts (e.g. Grade queryset .as_pymongo()) or Grade
+                objects with 'answers', 'version_code', 'score', 'percentage'
+            num_questions: Number of questions ("1".."num_questions" answer keys)
+        """
+        q_keys = [str(q) for q in range(1, num_questions + 1)]
+        rows, version_codes, scores, percentages = [], [], [], []
+        for doc in documents:
+            get = doc.get if isinstance(doc, dict) else (lambda name, d=doc: getattr(d, name, None))
+            answers = get('answers') or {}
+            rows.append([encode_student_answer(answers.get(k)) for k in q_keys])
+            version_codes.append(get('version_code') or '')
+            if get('score') is not None:
+                scores.append(get('score'))
+            if get('percentage') is not None:
+                percentages.append(get('percentage'))
+        matrix = np.array(rows, dtype=np.int8).reshape(len(rows), num_questions)
+        return cls(matrix, version_codes, np.array(scores, dtype=np.float64), np.array(percentages, dtype=np.float64))
+
+
+def analyze_items(grades, key):
+    """
+    Per-question counts and option distributions
+
+    Args:
+        grades: GradeMatrix
+        key: KeyMatrix
+
+    Returns:
+        dict: {
+            'correct': (questions,) int, 'incorrect': ..., 'blank': ...,
+            'options': List[str] option letters,
+            'option_counts': (questions, options) int  # how often each option was chosen
+            'correct_matrix': (papers, questions) bool,
+        }
+    """
+    answers = grades.answers
+    expected = key.codes[key.version_rows(grades.version_codes)]
+    blank = answers == BLANK
+    correct = (answers == expected) & (expected != NO_KEY) & (answers != INVALID) & ~blank
+    incorrect = ~blank & ~correct
+
+    # Option distribution over valid option indices
+    valid_keys = key.codes[(key.codes >= 0)]
+    chosen = (answers >= 0) & (answers < len(OPTION_LETTERS))
+    num_options = max(
+        MIN_OPTIONS,
+        int(answers[chosen].max(initial=-1)) + 1,
+        int(valid_keys[valid_keys < len(OPTION_LETTERS)].max(initial=-1)) + 1,
+    )
+
+    return {
+        'correct': correct.sum(axis=0),
+        'incorrect': incorrect.sum(axis=0),
+        'blank': blank.sum(axis=0),
+        'options': list(OPTION_LETTERS[:num_options]),
+        'option_counts': option_counts(answers, num_options),
+        'correct_matrix': correct,
+    }
+
+
+def option_counts(answers, num_options):
+    """(questions, num_options) number of papers choosing each option (one bincount)"""
+    num_questions = answers.shape[1]
+    chosen = (answers >= 0) & (answers < num_options)
+    q_idx = np.broadcast_to(np.arange(num_questions), answers.shape)[chosen]
+    return np.bincount(
+        q_idx * num_options + answers[chosen].astype(np.intp), minlength=num_questions * num_options
+    ).reshape(num_questions, num_options)
+
+
+def score_statistics(grades):
+    """
+    Summary of the stored scores / percentages
+
+    Returns:
+        dict: {'min_score', 'max_score', 'average_score', 'average_percent',
+               'median_score', 'std_deviation'} (population std, 0 for < 2 scores)
+    """
+    scores, percentages = grades.scores, grades.percentages
+    if scores.size:
+        std = float(scores.std()) if scores.size > 1 else 0.0
+        stats = (float(scores.min()), float(scores.max()), float(scores.mean()), float(np.median(scores)), std)
+    else:
+        stats = (0, 0, 0, 0, 0)
+    min_score, max_score, avg_score, median_score, std_dev = stats
+    return {
+        'min_score': round(min_score, 2),
+        'max_score': round(max_score, 2),
+        'average_score': round(avg_score, 2),
+        'average_percent': round(float(percentages.mean()) if percentages.size else 0, 2),
+        'median_score': round(median_score, 2),
+        'std_deviation': round(std_dev, 2),
+    }
+
+
+def score_groups(total_scores, fraction=DISCRIMINATION_GROUP):
+    """
+    Upper and lower score groups
+
+    Args:
+        total_scores: (papers,) number of correct answers of each paper
+        fraction: Share of the papers in each group
+
+    Returns:
+        tuple: (upper, lower) (papers,) bool masks, each of max(1, round(fraction * papers))
+            papers (ties broken by paper order); both empty for fewer than 2 papers
+    """
+    n = total_scores.shape[0]
+    upper = np.zeros(n, dtype=bool)
+    lower = np.zeros(n, dtype=bool)
+    if n < 2:
+        return upper, lower
+    size = min(n // 2, max(1, int(round(fraction * n))))
+    order = np.argsort(total_scores, kind='stable')
+    lower[order[:size]] = True
+    upper[order[-size:]] = True
+    return upper, lower
+
+
+def test_statistics(grades, key, counts=None):
+    """
+    Classical test theory statistics
+
+    Items are scored 0/1 from the correct matrix (blank = 0); the total score
+    of a paper is its number of correct answers.
+
+    Args:
+        grades: GradeMatrix
+        key: KeyMatrix
+        counts: analyze_items() result, computed if omitted
+
+    Returns:
+        dict: {
+            'difficulty': (questions,) proportion correct (NaN without papers),
+            'discrimination': (questions,) p(upper 27%) - p(lower 27%),
+            'point_biserial': (questions,) correlation of the item with the total
+                score (NaN when the item or the total does not vary),
+            'upper', 'lower': (papers,) bool score groups,
+            'upper_option_counts', 'lower_option_counts': (questions, options) int,
+            'kr20', 'cronbach_alpha', 'sem': float (NaN when undefined),
+            'total_scores': (papers,) int,
+        }
+    """
+    if counts is None:
+        counts = analyze_items(grades, key)
+    x = counts['correct_matrix'].astype(np.float64)
+    n, k = x.shape
+    total = x.sum(axis=1)
+
+    # Difficulty (p) and score-group discrimination
+    difficulty = x.mean(axis=0) if n else np.full(k, np.nan)
+    upper, lower = score_groups(total)
+    if upper.any():
+        discrimination = x[upper].mean(axis=0) - x[lower].mean(axis=0)
+    else:
+        discrimination = np.full(k, np.nan)
+
+    # Point-biserial = Pearson correlation of each 0/1 item with the total score
+    item_std = x.std(axis=0) if n else np.zeros(k)
+    total_std = float(total.std()) if n else 0.0
+    cov = (x * (total - total.mean())[:, None]).mean(axis=0) if n else np.zeros(k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        point_biserial = np.where((item_std > 0) & (total_std > 0), cov / (item_std * total_std), np.nan)
+
+    # Reliability: KR-20 (sum p*q) and alpha (sum of item variances) agree for 0/1 items
+    total_var = total_std ** 2
+    if k > 1 and total_var > 0:
+        kr20 = k / (k - 1) * (1 - float((difficulty * (1 - difficulty)).sum()) / total_var)
+        alpha = k / (k - 1) * (1 - float(x.var(axis=0).sum()) / total_var)
+        sem = total_std * np.sqrt(max(0.0, 1 - kr20))
+    else:
+        kr20 = alpha = sem = float('nan')
+
+    return {
+        'difficulty': difficulty,
+        'discrimination': discrimination,
+        'point_biserial': point_biserial,
+        'upper': upper,
+        'lower': lower,
+        'upper_option_counts': option_counts(grades.answers[upper], counts['option_counts'].shape[1]),
+        'lower_option_counts': option_counts(grades.answers[lower], counts['option_counts'].shape[1]),
+        'kr20': kr20,
+        'cronbach_alpha': alpha,
+        'sem': float(sem),
+        'total_scores': total.astype(np.int64),
+    }
+
+
+def _stat(value, digits=4):
+    """JSON-ready rounded statistic (None when undefined)"""
+    value = float(value)
+    return None if np.isnan(value) else round(value, digits)
+
+
+def item_analysis_report(grades, key):
+    """
+    Item analysis response body (without quiz_id)
+
+    Args:
+        grades: GradeMatrix
+        key: KeyMatrix
+
+    Returns:
+        dict: {'total_papers', 'num_questions', 'items', 'statistics'}
+            Each item also carries 'difficulty', 'discrimination', 'point_biserial'
+            and 'distractors' ({option: {'count', 'upper', 'lower'}}); statistics
+            carries 'kr20', 'cronbach_alpha', 'sem' and 'group_size'.
+            Undefined coefficients (e.g. no score variance) are None.
+    """
+    total = grades.num_papers
+    num_questions = grades.answers.shape[1]
+    counts = analyze_items(grades, key)
+    ctt = test_statistics(grades, key, counts)
+
+    def percent(count):
+        return round(count / total * 100, 2) if total > 0 else 0
+
+    correct, incorrect, blank = counts['correct'].tolist(), counts['incorrect'].tolist(), counts['blank'].tolist()
+    options = counts['options']
+    option_counts = counts['option_counts'].tolist()
+    upper_counts, lower_counts = ctt['upper_option_counts'].tolist(), ctt['lower_option_counts'].tolist()
+
+    items = []
+    for q in range(num_questions):
+        items.append({
+            'question_number': q + 1,
+            'correct_answer': key.display_answers[q],
+            'correct_count': correct[q],
+            'incorrect_count': incorrect[q],
+            'blank_count': blank[q],
+            'correct_percent': percent(correct[q]),
+            'incorrect_percent': percent(incorrect[q]),
+            'blank_percent': percent(blank[q]),
+            'option_counts': dict(zip(options, option_counts[q])),
+            'difficulty': _stat(ctt['difficulty'][q]),
+            'discrimination': _stat(ctt['discrimination'][q]),
+            'point_biserial': _stat(ctt['point_biserial'][q]),
+            'distractors': {
+                option: {'count': option_counts[q][i], 'upper': upper_counts[q][i], 'lower': lower_counts[q][i]}
+                for i, option in enumerate(options)
+            },
+        })
+
+    statistics = score_statistics(grades)
+    statistics.update({
+        'kr20': _stat(ctt['kr20']),
+        'cronbach_alpha': _stat(ctt['cronbach_alpha']),
+        'sem': _stat(ctt['sem']),
+        'group_size': int(ctt['upper'].sum()),
+    })
+    return {
+        'total_papers': total,
+        'num_questions': num_questions,
+        'items': items,
+        'statistics': statistics,
+    }
@@ -0,0 +1,272 @@
+"""
+Annotated image rendering, run only when a caller asks for it.
+
+Grading (grade_pipeline.grade_sheet) never draws. render_annotation() draws
+the ID highlights, grading circles and score text over a graded sheet at
+full or thumbnail size (optionally cropped to one region), encode_image()
+is the output encoding stage (JPEG/WebP/PNG, quality, max dimensions) and
+the annotation cache helpers write the result to disk so the API can return
+a URL instead of an inline base64 image.
+"""
+import os
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+ANNOTATE_MODES = ('none', 'thumbnail', 'full')
+THUMBNAIL_WIDTH = 600
+
+# Định dạng ảnh đầu ra: (đuôi file, MIME type)
+IMAGE_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+    'png': ('.png', 'image/png'),
+}
+DEFAULT_IMAGE_QUALITY = 85
+
+# Vùng có thể cắt ra từ ảnh annotate (khóa trong template JSON, [x, y, w, h] ở 300 DPI)
+CROP_REGIONS = {
+    'answer_area': ('answer_area',),
+    'student_id': ('student_id_section',),
+    'quiz_id': ('quiz_id_section',),
+    'class_id': ('class_id_section',),
+    'ids': ('student_id_section', 'quiz_id_section', 'class_id_section'),
+}
+
+# Màu vẽ
+COLORS = {
+    'correct': (0, 255, 0),
+    'wrong': (0, 0, 255),
+    'highlight': (0, 255, 255),
+    'text': (0, 0, 255)
+}
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Xóa ảnh annotate tạm trong cache tối đa mỗi 5 phút
+CACHE_PURGE_INTERVAL = 300  # seconds
+_last_purge = 0.0
+
+
+def annotate_mode(value, default='full'):
+    """
+    Normalize an annotate option ('none' | 'thumbnail' | 'full', or a bool)
+
+    Raises:
+        ValueError: for an unknown mode
+    """
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return 'full' if value else 'none'
+    mode = str(value).lower()
+    if mode in ('1', 'true', 'yes'):
+        return 'full'
+    if mode in ('0', 'false', 'no'):
+        return 'none'
+    if mode not in ANNOTATE_MODES:
+        raise ValueError(f'Unknown annotate mode: {value}. Expected one of {ANNOTATE_MODES}')
+    return mode
+
+
+def draw_answer_circles(img, centers, radii, selected, correct_idx, thickness=3):
+    """
+    Draw grading circles for one question
+
+    Args:
+        img: Image to draw on
+        centers: (options, 2) bubble centers in image space
+        radii: (options,) bubble radii in image space
+        selected: List of selected option indices
+        correct_idx: Correct option index
+        thickness: Circle line thickness
+    """
+    def circle(idx, color):
+        x, y = map(int, centers[idx])
+        cv2.circle(img, (x, y), int(radii[idx]), color, thickness)
+
+    if len(selected) == 0:
+        circle(correct_idx, COLORS['highlight'])
+
+    if len(selected) == 1:
+        sel = selected[0]
+        if sel == correct_idx:
+            circle(sel, COLORS['correct'])
+        else:
+            circle(sel, COLORS['wrong'])
+            circle(correct_idx, COLORS['highlight'])
+
+    if correct_idx in selected:
+        circle(correct_idx, COLORS['correct'])
+        for sel in selected:
+            if sel == correct_idx: continue
+            circle(sel, COLORS['wrong'])
+
+    else:
+        circle(correct_idx, COLORS['highlight'])
+        for sel in selected:
+            circle(sel, COLORS['wrong'])
+
+
+def crop_box(sheet, crop):
+    """
+    Box (x1, y1, x2, y2) of a CROP_REGIONS entry in warped-image space
+
+    Raises:
+        ValueError: for an unknown region
+    """
+    if crop not in CROP_REGIONS:
+        raise ValueError(f'Unknown crop region: {crop}. Expected one of {tuple(CROP_REGIONS)}')
+    scale = sheet.template.scale
+    boxes = np.array([sheet.data[key]['position'] for key in CROP_REGIONS[crop]], dtype=np.float64) * scale
+    h, w = sheet.warped.shape[:2]
+    x1, y1 = boxes[:, :2].min(axis=0)
+    x2, y2 = (boxes[:, :2] + boxes[:, 2:]).max(axis=0)
+    return (max(0, int(x1)), max(0, int(y1)), min(w, int(np.ceil(x2))), min(h, int(np.ceil(y2))))
+
+
+def render_annotation(sheet, result, answer_key_dict=None, mode='full', thumbnail_width=THUMBNAIL_WIDTH, crop=None):
+    """
+    Draw the grading result over the warped sheet
+
+    Args:
+        sheet: WarpedSheet from read_sheet() (needs the full color warp)
+        result: grade_sheet() result for the sheet
+        answer_key_dict: Dict {question_index: answer_index} used for grading
+        mode: 'full' (warped resolution), 'thumbnail' (thumbnail_width wide) or 'none'
+        thumbnail_width: Width of the thumbnail in pixels
+        crop: Optional CROP_REGIONS key, e.g. 'answer_area' (cropped before resizing)
+
+    Returns:
+        np.ndarray BGR image, or None for mode 'none' / a sheet without color warp
+    """
+    if mode == 'none' or sheet.warped is None:
+        return None
+
+    img = sheet.warped
+    ox = oy = 0
+    if crop:
+        ox, oy, x2, y2 = crop_box(sheet, crop)
+        img = img[oy:y2, ox:x2]
+    f = 1.0
+    if mode == 'thumbnail' and img.shape[1] > thumbnail_width:
+        f = thumbnail_width / img.shape[1]
+        img = cv2.resize(img, (thumbnail_width, int(round(img.shape[0] * f))), interpolation=cv2.INTER_AREA)
+    else:
+        img = img.copy()
+
+    scale = sheet.template.scale * f
+    thickness = max(1, int(round(3 * scale)))
+
+    # Highlight chosen ID bubbles
+    for px, py, pr in sheet.id_bubbles:
+        cv2.circle(img, (int(round((px - ox) * f)), int(round((py - oy) * f))), max(1, int(round(pr * f))),
+                   COLORS['correct'], max(1, int(round(2 * scale))))
+
+    # Grading circles (rows with a keyed answer)
+    if answer_key_dict:
+        sampler = sheet.template.answer_sampler
+        centers = (sampler.centers - (ox, oy)) * f
+        radii = np.maximum(1, np.round(sampler.radii * f))
+        selected = result['sheet_result'].selected
+        key = result['key']
+        for row in np.flatnonzero(key >= 0).tolist():
+            sel = int(selected[row])
+            draw_answer_circles(img, centers[row], radii[row], [sel] if sel >= 0 else [], int(key[row]), thickness)
+
+    # Text overlay
+    lines = [f"Score: {result['score']}/{result['total_questions']} = {result['percentage']:.2f}%"]
+    if result['student_id']:
+        lines.append("Student ID: " + ''.join(map(str, result['student_id'])))
+    if result['quiz_id']:
+        lines.append("Quiz ID:    " + ''.join(map(str, result['quiz_id'])))
+    if result['class_id']:
+        lines.append("Class ID:   " + ''.join(map(str, result['class_id'])))
+    line_height = max(10, int(round(30 * scale)))
+    for i, txt in enumerate(lines):
+        cv2.putText(img, txt, (10, line_height * (i + 1)), FONT, 0.8 * scale, COLORS['text'],
+                    max(1, int(round(2 * scale))))
+    return img
+
+
+def encode_image(img, fmt='jpeg', quality=DEFAULT_IMAGE_QUALITY, max_width=None, max_height=None):
+    """
+    Output encoding stage: downscale to fit max dimensions, then encode
+
+    Args:
+        img: BGR image
+        fmt: 'jpeg' | 'webp' | 'png'
+        quality: 1..100 for JPEG/WebP; for PNG it is mapped to the zlib level
+            (100 = level 1, fastest / largest)
+        max_width / max_height: Optional bounds in pixels (aspect ratio kept)
+
+    Returns:
+        bytes: Encoded image
+
+    Raises:
+        ValueError: for an unknown format or if encoding fails
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f'Unknown image format: {fmt}. Expected one of {tuple(IMAGE_FORMATS)}')
+    h, w = img.shape[:2]
+    f = min(
+        max_width / w if max_width else 1.0,
+        max_height / h if max_height else 1.0,
+    )
+    if f < 1.0:
+        img = cv2.resize(img, (max(1, int(round(w * f))), max(1, int(round(h * f)))), interpolation=cv2.INTER_AREA)
+
+    quality = int(min(100, max(1, quality)))
+    if fmt == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    elif fmt == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(round(9 - quality * 8 / 100))]
+    ok, buffer = cv2.imencode(IMAGE_FORMATS[fmt][0], img, params)
+    if not ok:
+        raise ValueError(f'Failed to encode image as {fmt}')
+    return buffer.tobytes()
+
+
+def save_annotation(data, cache_dir, fmt='jpeg', owner=None):
+    """
+    Write an encoded annotation into the annotation cache
+
+    Args:
+        data: Encoded image bytes (see encode_image())
+        cache_dir: Annotation cache directory
+        fmt: Image format of data
+        owner: Teacher id the scan belongs to, recorded as the file name
+            prefix (see is_annotation_owner())
+
+    Returns:
+        str: File name inside cache_dir
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = f"{owner}_" if owner else ''
+    filename = f"{prefix}{uuid.uuid4()}_annotated{IMAGE_FORMATS[fmt][0]}"
+    with open(os.path.join(cache_dir, filename), 'wb') as f:
+        f.write(data)
+    return filename
+
+
+def is_annotation_owner(filename, owner):
+    """Whether a cached annotation was rendered for a scan of this teacher"""
+    return bool(owner) and os.path.basename(filename) == filename and filename.startswith(f"{owner}_")
+
+
+def purge_annotation_cache(cache_dir, ttl):
+    """Delete cached annotations older than ttl seconds (at most every CACHE_PURGE_INTERVAL)"""
+    global _last_purge
+    now = time.time()
+    if now - _last_purge < CACHE_PURGE_INTERVAL or not os.path.isdir(cache_dir):
+        return
+    _last_purge = now
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > ttl:
+                os.unlink(entry.path)
+        except OSError:
+            pass
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class GradingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'grading'
+
+    def ready(self):
+        from django.conf import settings
+        from .template_cache import DEFAULT_TEMPLATE_CACHE_SIZE, set_template_cache_size
+        config = getattr(settings, 'GRADING_CONFIG', {})
+        set_template_cache_size(config.get('TEMPLATE_CACHE_SIZE', DEFAULT_TEMPLATE_CACHE_SIZE))
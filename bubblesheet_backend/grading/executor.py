@@ -0,0 +1,196 @@
+"""
+Grading executor: runs the OpenCV part of a scan outside the request thread.
+
+Sheets are graded by a pool of warm workers. Each worker process keeps its
+own compiled template cache and ArUco detectors, so after the first sheet of
+a template nothing is rebuilt. Submissions go through a bounded number of
+slots (workers + queue depth); when every slot is taken, submit() waits at
+most queue_timeout seconds and then raises GradingOverloaded instead of
+letting the backlog grow without limit.
+"""
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+EXECUTOR_MODES = ('process', 'thread', 'inline')
+DEFAULT_EXECUTOR_MODE = 'process'
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_DEPTH = 8
+DEFAULT_QUEUE_TIMEOUT = 2  # seconds
+
+
+class GradingOverloaded(Exception):
+    """Raised when no grading slot frees up within the queue timeout"""
+
+
+def _init_worker(template_cache_size):
+    # Worker processes run one sheet at a time: keep OpenCV single threaded
+    # so N workers do not oversubscribe the CPU, and build the detector now.
+    # Settings come from the parent: a worker never imports the project settings.
+    import cv2
+    from .grade_pipeline import ARUCO_TYPE
+    from .marker_detector import get_marker_detector
+    from .template_cache import set_template_cache_size
+    cv2.setNumThreads(1)
+    set_template_cache_size(template_cache_size)
+    get_marker_detector(ARUCO_TYPE, 'grading')
+
+
+class GradingExecutor:
+    """
+    Bounded executor for grading tasks
+
+    Args:
+        mode: 'process' (warm worker processes), 'thread' (thread pool in
+            this process) or 'inline' (run in the calling thread)
+        workers: Number of workers
+        queue_depth: Tasks allowed to wait for a worker
+        queue_timeout: Seconds submit() waits for a free slot
+        start_method: multiprocessing start method for 'process' mode
+        template_cache_size: Compiled templates kept by each worker process
+            (default: the size of this process' cache)
+    """
+
+    def __init__(self, mode=DEFAULT_EXECUTOR_MODE, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, start_method='spawn', template_cache_size=None):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f'Unknown executor mode: {mode}. Expected one of {EXECUTOR_MODES}')
+        self.mode = mode
+        self.workers = max(1, int(workers))
+        self.queue_depth = max(0, int(queue_depth))
+        self.queue_timeout = queue_timeout
+        self.start_method = start_method
+        self.template_cache_size = template_cache_size
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                if self.mode == 'process':
+                    cache_size = self.template_cache_size
+                    if cache_size is None:
+                        from .template_cache import template_cache_size
+                        cache_size = template_cache_size()
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context(self.start_method),
+                        initializer=_init_worker,
+                        initargs=(cache_size,),
+                    )
+                else:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='grading')
+            return self._pool
+
+    def _discard_pool(self, pool):
+        # A worker process died: drop the broken pool, the next submit starts a new one
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args, timeout=None, **kwargs):
+        """
+        Submit fn(*args, **kwargs) to a worker
+
+        fn and its arguments must be picklable in 'process' mode.
+
+        Args:
+            timeout: Seconds to wait for a free slot (default: queue_timeout)
+
+        Returns:
+            concurrent.futures.Future
+
+        Raises:
+            GradingOverloaded: if no slot frees up in time
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise GradingOverloaded('Grading queue is full, please retry later')
+        with self._lock:
+            self._in_flight += 1
+
+        if self.mode == 'inline':
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self._release()
+            return future
+
+        pool = self._get_pool()
+        try:
+            future = pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self._release()
+            self._discard_pool(pool)
+            raise
+        except Exception:
+            self._release()
+            raise
+
+        def done(f):
+            self._release()
+            if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                self._discard_pool(pool)
+
+        future.add_done_callback(done)
+        return future
+
+    def run(self, fn, *args, timeout=None, **kwargs):
+        """Submit and wait for the result (see submit())"""
+        return self.submit(fn, *args, timeout=timeout, **kwargs).result()
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'queue_depth': self.queue_depth,
+            'in_flight': self._in_flight,
+        }
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_grading_executor():
+    """Process-wide GradingExecutor configured from GRADING_CONFIG"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from django.conf import settings
+                config = getattr(settings, 'GRADING_CONFIG', {})
+                _executor = GradingExecutor(
+                    mode=config.get('GRADING_EXECUTOR', DEFAULT_EXECUTOR_MODE),
+                    workers=config.get('GRADING_WORKERS', DEFAULT_WORKERS),
+                    queue_depth=config.get('GRADING_QUEUE_DEPTH', DEFAULT_QUEUE_DEPTH),
+                    queue_timeout=config.get('GRADING_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT),
+                    template_cache_size=config.get('TEMPLATE_CACHE_SIZE'),
+                )
+    return _executor
+
+
+def shutdown_grading_executor(wait=True):
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
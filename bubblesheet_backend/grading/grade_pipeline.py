@@ -1,62 +1,132 @@
+import os
+import time
 import cv2
 import numpy as np
-import json
 import base64
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
-from .aruco_dict import ARUCO_DICT
+from typing import Dict, List, Optional
+from .bubble_sampler import disk_offsets
+from .marker_detector import get_marker_detector
+from .homography import HOMOGRAPHY_MAX_ERROR, RANSAC_REPROJ_THRESHOLD, solve_homography
+from .marker_tracker import seed_from_homography, track_markers
+from .results import SheetResult, classify_marks, mark_details
+from .template_cache import get_compiled_template, TEMPLATE_DPI, TEMPLATE_SIZE
+from .annotation import (
+    COLORS, FONT, IMAGE_FORMATS, THUMBNAIL_WIDTH,
+    annotate_mode, encode_image, render_annotation, save_annotation,
+)
 
 # --- Cấu hình chung ---
 ARUCO_TYPE = 'DICT_4X4_50'
 
-# Ngưỡng pixel tô
+# Marker ở 4 góc phiếu: trên-trái, trên-phải, dưới-phải, dưới-trái
+CORNER_MARKER_IDS = (1, 5, 9, 10)
+
+# Ngưỡng pixel tô (gốc) trên bubble bán kính 27px ở 300 DPI
 MIN_ANSWER_PIXELS = 1200
 MIN_ID_PIXELS = {
     'student': 700,
     'quiz': 600,
     'class': 600
 }
+BUBBLE_RADIUS = 27
+BUBBLE_AREA_PIXELS = len(disk_offsets(BUBBLE_RADIUS)[0])  # 2289
 
-# Màu vẽ
-COLORS = {
-    'correct': (0, 255, 0),
-    'wrong': (0, 0, 255),
-    'highlight': (0, 255, 255),
-    'text': (0, 0, 255)
-}
-FONT = cv2.FONT_HERSHEY_SIMPLEX
-
-
-def load_data(img_path, json_path):
-    img = cv2.imread(img_path)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    with open(json_path, 'r') as f:
-        data = json.load(f)
-    return img, gray, data
-
-
-def detect_aruco(gray, aruco_type):
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    gray = clahe.apply(blurred)
-    arucoDict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT[aruco_type])
-    arucoParams = cv2.aruco.DetectorParameters()
-    arucoDetector = cv2.aruco.ArucoDetector(arucoDict, arucoParams)
-    (corners, ids, _) = arucoDetector.detectMarkers(gray)
-    positions = []
-    if ids is not None:
-        ids = ids.flatten()
-        for markerCorner, markerID in zip(corners, ids):
-            corners_reshaped = markerCorner.reshape((4, 2))
-            (topLeft, topRight, bottomRight, bottomLeft) = corners_reshaped
-            cX = int((topLeft[0] + bottomRight[0]) / 2.0)
-            cY = int((topLeft[1] + bottomRight[1]) / 2.0)
-
-            positions.append({'id': int(markerID), 'position': [cX, cY]})
-    return positions
-
-
-def warp_to_template(img, detected, template_markers, output_size=(2481, 3508)):
+# Ngưỡng tô theo tỉ lệ diện tích bubble (không phụ thuộc độ phân giải),
+# suy ra chính xác từ ngưỡng pixel gốc
+MIN_ANSWER_FILL = MIN_ANSWER_PIXELS / BUBBLE_AREA_PIXELS
+MIN_ID_FILL = {label: pixels / BUBBLE_AREA_PIXELS for label, pixels in MIN_ID_PIXELS.items()}
+
+# Độ phân giải ảnh sau khi warp (template JSON ở 300 DPI)
+WARP_DPI = TEMPLATE_DPI
+
+# Ngưỡng nhị phân hóa: 'group' (mỗi câu/cột ID một Otsu), 'region' (mỗi vùng một Otsu), 'tiled'
+THRESHOLD_MODE = 'group'
+
+
+def decode_image(source, flags=cv2.IMREAD_COLOR):
+    """
+    Decode an image from a file path or from the encoded bytes in memory
+
+    Args:
+        source: Path (str / os.PathLike) or encoded image as bytes,
+            bytearray, memoryview or a 1-D uint8 np.ndarray
+        flags: cv2.IMREAD_* flags
+
+    Returns:
+        np.ndarray or None if the data cannot be decoded
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return cv2.imread(os.fspath(source), flags)
+    buffer = source if isinstance(source, np.ndarray) else np.frombuffer(source, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, flags)
+
+
+def load_data(img_path, json_path, template_key=None, scale=1.0, grayscale=False):
+    """
+    Load image and compiled template (from the process-wide template cache)
+
+    Args:
+        img_path: Image path or encoded image bytes (see decode_image())
+        grayscale: Decode straight to one channel (img is then None)
+
+    Returns:
+        tuple: (img, gray, template: CompiledTemplate)
+    """
+    if grayscale:
+        img, gray = None, decode_image(img_path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError('Invalid image data')
+    else:
+        img = decode_image(img_path)
+        if img is None:
+            raise ValueError('Invalid image data')
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    template = get_compiled_template(json_path, template_key, scale)
+    return img, gray, template
+
+
+def detect_aruco(gray, aruco_type, preset='grading'):
+    """
+    Detect ArUco markers with a reused detector (see grading.marker_detector)
+
+    Args:
+        gray: Grayscale image
+        aruco_type: Key of ARUCO_DICT
+        preset: 'grading' (robust) or 'preview' (fast)
+
+    Returns:
+        List[Dict]: [{'id': int, 'position': [cX, cY]}]
+    """
+    return get_marker_detector(aruco_type, preset).detect(gray)
+
+
+def find_homography(detected, template_markers, max_error=HOMOGRAPHY_MAX_ERROR,
+                    ransac_threshold=RANSAC_REPROJ_THRESHOLD):
+    """
+    Homography from the input image to template space
+
+    Uses the 4 corner markers directly and escalates to RANSAC over all
+    markers only if they do not fit (see homography.solve_homography()).
+
+    Args:
+        detected: Detected ArUco markers from image
+        template_markers: Template markers [{'id', 'position'}]
+        max_error: Reprojection error (template-space pixels) accepted for the corner homography
+        ransac_threshold: RANSAC inlier threshold (template-space pixels)
+
+    Returns:
+        tuple: (H 3x3 homography matrix, reprojection error in template-space pixels)
+    """
+    H, error, _ = solve_homography(
+        detected, template_markers, CORNER_MARKER_IDS, max_error, ransac_threshold=ransac_threshold
+    )
+    return H, error
+
+
+def warp_to_template(img, detected, template_markers, output_size=TEMPLATE_SIZE):
     """
     Warp image to template using ArUco markers
     
@@ -69,23 +139,7 @@ def warp_to_template(img, detected, template_markers, output_size=(2481, 3508)):
     Returns:
         warped: Warped image
     """
-    input_points, template_points = [], []
-
-    for marker in template_markers:
-        marker_id = marker["id"]
-
-        matching_marker = next((m for m in detected if m["id"] == marker_id), None)
-        if matching_marker:
-            input_points.append(matching_marker["position"])
-            template_points.append(marker["position"])
-
-    if len(input_points) < 4:
-        raise ValueError(f"Not enough markers found. Need 4, found {len(input_points)}")
-
-    input_points = np.array(input_points, dtype=np.float32)
-    template_points = np.array(template_points, dtype=np.float32)
-
-    H, _ = cv2.findHomography(input_points, template_points, cv2.RANSAC)
+    H, _ = find_homography(detected, template_markers)
     (w, h) = output_size
     warped = cv2.warpPerspective(img, H, (w, h))
     return warped
@@ -115,260 +169,428 @@ def verify_warp(image, data):
     return image
 
 
-def bounding_box(bubbles, shape):
-    xs = [b['position'][0] for b in bubbles]
-    ys = [b['position'][1] for b in bubbles]
-    rs = [b['radius'] for b in bubbles]
-    x1 = max(int(min(xs) - max(rs)), 0)
-    x2 = min(int(max(xs) + max(rs)), shape[1])
-    y1 = max(int(min(ys) - max(rs)), 0)
-    y2 = min(int(max(ys) + max(rs)), shape[0])
-    return x1, y1, x2, y2
+def encode_image_base64(img, **encoding):
+    """
+    Encode image to base64 string
+    
+    Args:
+        img: Image as numpy array
+        **encoding: format / quality / max size, see annotation.encode_image()
+    
+    Returns:
+        str: Base64 encoded image
+    """
+    # Encode image (JPEG by default)
+    buffer = encode_image(img, **encoding)
+    # Encode to base64
+    image_base64 = base64.b64encode(buffer).decode('utf-8')
+    return image_base64
+
+
+class WarpedSheet:
+    """
+    Stage-one output of the pipeline: the sheet warped to template space and
+    every bubble measured once. Grading against an answer key is done later
+    by grade_sheet() without touching the image again.
+
+    Attributes:
+        warped: Warped BGR image (None when only regions were warped)
+        gray: Warped grayscale image (None when only regions were warped)
+        template: CompiledTemplate
+        student_id / quiz_id / class_id: List[int] digits or None
+        id_bubbles: (x, y, r) of the bubbles chosen for the ID digits (for highlighting)
+        answer_counts: np.ndarray (questions x options) filled pixel counts
+        answer_fill: np.ndarray (questions x options) fill ratios of each bubble
+        sheet_result: SheetResult read from answer_fill (selected option, status and
+            confidence per question)
+        id_details: {'student'|'quiz'|'class': per-digit details}, see measure_id_section()
+        thresholds: Binarization thresholds used per region
+            {'mode', 'student_id', 'quiz_id', 'class_id', 'answer_area'}
+        homography: 3x3 homography from the input image to warped-image space
+        image_size: (width, height) of the input image
+        tracked: True if the markers were found by tracking (see marker_tracker)
+        homography_error: Largest marker reprojection error of the homography
+            (pixels at 300 DPI), a quality metric of the warp
+    """
+
+    def __init__(self, warped, gray, template, student_id, quiz_id, class_id, id_bubbles, answer_counts,
+                 answer_fill, thresholds=None, homography=None, image_size=None, tracked=False,
+                 homography_error=None, id_details=None):
+        self.warped = warped
+        self.gray = gray
+        self.template = template
+        self.student_id = student_id
+        self.quiz_id = quiz_id
+        self.class_id = class_id
+        self.id_bubbles = id_bubbles
+        self.answer_counts = answer_counts
+        self.answer_fill = answer_fill
+        self.sheet_result = SheetResult.from_fill(
+            template.question_index, answer_fill, MIN_ANSWER_FILL, template.answer_sampler.valid
+        )
+        self.id_details = id_details or {}
+        self.thresholds = thresholds or {}
+        self.homography = homography
+        self.image_size = image_size
+        self.tracked = tracked
+        self.homography_error = homography_error
 
+    @property
+    def data(self):
+        return self.template.data
 
-def threshold_region(gray, box):
-    x_min, y_min, x_max, y_max = box
-    roi = gray[y_min:y_max, x_min:x_max]
-    _, thresh = cv2.threshold(roi, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
-    return thresh, (x_min, y_min)
+    @property
+    def questions(self):
+        return self.template.questions
 
+    @property
+    def total_questions(self):
+        return self.template.total_questions
 
-def detect_marked(bubbles, thresh, min_pixels, origin):
+
+def measure_id_section(roi, layout, label, threshold_mode='group'):
     """
-    Detect marked bubbles in thresholded image
-    
+    Read an ID section without drawing
+
     Args:
-        bubbles: List of bubble definitions
-        thresh: Thresholded image
-        min_pixels: Minimum pixels to consider as marked
-        origin: Origin offset (x_min, y_min) from bounding box
-    
+        roi: Grayscale image of the section (layout.sampler.crop() or warp_region())
+        layout: IdSectionLayout from the compiled template
+        label: 'student' | 'quiz' | 'class'
+        threshold_mode: 'group' | 'region' | 'tiled' (see BubbleSampler.binarize)
+
     Returns:
-        marked: List of (pixel_count, bubble_index) tuples
+        tuple: (digits: List[int] or None if a column has no mark,
+            chosen bubbles as (x, y, r), thresholds,
+            details: per-column {'digits' (-1 = unread), 'status', 'confidence', 'fill', 'review'})
     """
-    marked = []
-    x_min, y_min = origin
-    for idx, b in enumerate(bubbles):
-        x0 = int(b["position"][0] - x_min)
-        y0 = int(b["position"][1] - y_min)
-        r = int(b["radius"])
-        mask = np.zeros_like(thresh)
-        cv2.circle(mask, (x0, y0), r, 255, -1)
-        cnt = cv2.countNonZero(cv2.bitwise_and(thresh, thresh, mask=mask))
-        if cnt >= min_pixels:
-            marked.append((cnt, idx))
-    return marked
-
-
-def draw_answer_circles(img, bubbles, selected, correct_idx):
-    if len(selected) == 0:
-        x, y = map(int, bubbles[correct_idx]['position'])
-        r = int(bubbles[correct_idx]['radius'])
-        cv2.circle(img, (x,y), r, COLORS['highlight'], 3)
-
-    if len(selected) == 1:
-        sel = selected[0]
-        x, y = map(int, bubbles[sel]['position'])
-        r = int(bubbles[sel]['radius'])
-        if sel == correct_idx:
-            cv2.circle(img, (x, y), r, COLORS['correct'], 3)
-        else:
-            cv2.circle(img, (x, y), r, COLORS['wrong'], 3)
-
-            x2, y2 = map(int, bubbles[correct_idx]['position'])
-            r2 = int(bubbles[correct_idx]['radius'])
-            cv2.circle(img,(x2, y2), r2, COLORS['highlight'], 3)
-
-    if correct_idx in selected:
-        x, y = map(int, bubbles[correct_idx]['position'])
-        r = int(bubbles[correct_idx]['radius'])
-        cv2.circle(img, (x, y), r, COLORS['correct'], 3)
-        for sel in selected:
-            if sel == correct_idx: continue
-            x, y = map(int, bubbles[sel]['position'])
-            r = int(bubbles[sel]['radius'])
-            cv2.circle(img, (x, y), r, COLORS['wrong'], 3)
+    _, fill, thresholds = layout.sampler.measure_region(roi, threshold_mode)
+    sampler = layout.sampler
+    best, status, confidence = classify_marks(fill, MIN_ID_FILL[label], sampler.valid, pick='max')
+    cols = np.flatnonzero(best >= 0)
+    column_digits = np.full(len(best), -1, dtype=np.int16)
+    column_digits[cols] = layout.values[cols, best[cols]]
+    details = mark_details(fill, status, confidence, {'digits': column_digits.tolist()}, required=True)
+
+    centers = sampler.centers[cols, best[cols]]
+    radii = sampler.radii[cols, best[cols]]
+    chosen = [(int(x), int(y), int(r)) for (x, y), r in zip(centers, radii)]
+    if len(best) == 0 or len(cols) < len(best):
+        # Incomplete ID: no digits, the details show which columns are unread
+        return None, chosen, thresholds, details
+    return column_digits.tolist(), chosen, thresholds, details
+
+
+def read_sheet(
+    image_path: str,
+    template_json_path: str,
+    template_key: Optional[str] = None,
+    threshold_mode: str = THRESHOLD_MODE,
+    dpi: int = WARP_DPI,
+    roi_only: bool = False,
+    grayscale: bool = False,
+    tracking_seed: Optional[Dict] = None,
+) -> WarpedSheet:
+    """
+    Stage one: load, detect markers, warp and measure every bubble once
 
+    Args:
+        image_path: Path to input image, or the encoded image bytes
+        template_json_path: Path to template JSON
+        template_key: Template cache key, e.g. answersheet_id (optional)
+        threshold_mode: 'group' (one Otsu per question row / ID column),
+            'region' (one Otsu per template region) or 'tiled'
+        dpi: Resolution of the warped image (300 = template resolution).
+            Lower values (e.g. 150) trade annotation quality for speed.
+        roi_only: Warp only the ID sections and the answer area instead of
+            the whole page. The sheet then has no warped image (no annotation).
+        grayscale: Decode and warp a single channel only. The sheet then has
+            no color warped image (no annotation), about 3x less decode/warp work.
+        tracking_seed: Seed from the previous frame of a scan session; markers
+            are first searched only around their expected positions, with
+            full detection as fallback (see marker_tracker.track_markers())
+
+    Returns:
+        WarpedSheet
+    """
+    # 1. Load image and compiled template
+    orig, gray, template = load_data(image_path, template_json_path, template_key, dpi / TEMPLATE_DPI, grayscale)
+
+    # 2. Track markers from the previous frame, or detect them on the whole image
+    tracked = track_markers(gray, template, tracking_seed, ARUCO_TYPE, CORNER_MARKER_IDS) if tracking_seed else None
+    det, H, error = tracked if tracked else (detect_aruco(gray, ARUCO_TYPE), None, None)
+
+    # Check if we have enough markers (need at least 4)
+    if len(det) < 4:
+        corner_ids = set(CORNER_MARKER_IDS)
+        detected_ids = {m['id'] for m in det if m['id'] in corner_ids}
+        missing_ids = corner_ids - detected_ids
+        raise ValueError(
+            f'ArUco markers not detected. Missing markers: {missing_ids}. '
+            f'Detected: {detected_ids}. '
+            f'Please ensure all 4 corner markers are visible and well-lit.'
+        )
+
+    # 3. Homography to template space
+    if H is None:
+        H, error = find_homography(
+            det, template.markers, HOMOGRAPHY_MAX_ERROR * template.scale, RANSAC_REPROJ_THRESHOLD * template.scale
+        )
+
+    # 4. Warp the whole page, or only the regions that will be sampled
+    if roi_only:
+        warped = w_gray = None
+    elif orig is None:
+        warped = None
+        w_gray = cv2.warpPerspective(gray, H, template.page_size)
     else:
-        x2, y2 = map(int, bubbles[correct_idx]['position'])
-        r2 = int(bubbles[correct_idx]['radius'])
-        cv2.circle(img, (x2, y2), r2, COLORS['highlight'], 3)
-        for sel in selected:
-            x, y = map(int, bubbles[sel]['position'])
-            r = int(bubbles[sel]['radius'])
-            cv2.circle(img, (x, y), r, COLORS['wrong'], 3)
+        warped = cv2.warpPerspective(orig, H, template.page_size)
+        w_gray = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
+
+    def region_of(sampler):
+        if roi_only:
+            return sampler.warp_region(gray, H)
+        return sampler.crop(w_gray)
+
+    # 5. Read IDs
+    id_bubbles = []
+    thresholds = {'mode': threshold_mode}
+    ids = {}
+    id_details = {}
+    for label, layout in template.id_sections.items():
+        ids[label], chosen, thresholds[f'{label}_id'], id_details[label] = measure_id_section(
+            region_of(layout.sampler), layout, label, threshold_mode
+        )
+        id_bubbles += chosen
+
+    # 6. Measure answer bubbles
+    sampler = template.answer_sampler
+    answer_counts, answer_fill, thresholds['answer_area'] = sampler.measure_region(region_of(sampler), threshold_mode)
+
+    return WarpedSheet(
+        warped, w_gray, template, ids['student'], ids['quiz'], ids['class'],
+        id_bubbles, answer_counts, answer_fill, thresholds, H,
+        image_size=(gray.shape[1], gray.shape[0]), tracked=tracked is not None,
+        homography_error=error / template.scale, id_details=id_details,
+    )
 
 
-def grade_answers(img, gray, questions, answer_key):
+def grade_sheet(sheet: WarpedSheet, answer_key_dict: Optional[Dict[int, int]] = None) -> Dict:
     """
-    Grade answers and draw circles on image
-    
+    Stage two: grade a WarpedSheet against an answer key (or just read answers)
+
+    Only works on the measurements stored in the sheet, so the same sheet can
+    be graded against several answer-key versions cheaply.
+
     Args:
-        img: Image to draw on
-        gray: Grayscale image
-        questions: List of question definitions from template
-        answer_key: Dict {question_index: answer_index}
-    
+        sheet: WarpedSheet from read_sheet()
+        answer_key_dict: Dict {question_index: answer_index} (optional)
+
     Returns:
-        correct: Number of correct answers
+        dict: {
+            'score', 'total_questions', 'percentage',
+            'student_id', 'quiz_id', 'class_id': List[int],
+            'sheet_result': SheetResult,  # dense answers, see grading.results
+            'key': np.ndarray,  # answer key aligned with sheet_result rows
+            'thresholds': dict, 'timestamp': str,
+        }
+        Legacy 'answers' dicts are built from sheet_result at the API boundary.
     """
-    correct = 0
-    for q in questions:
-        q_idx = q['question'] - 1
-        bubbles = q['bubbles']
-        box = bounding_box(bubbles, img.shape)
-        thresh, origin = threshold_region(gray, box)
-
-        marked = []
-        for cnt, idx in detect_marked(bubbles, thresh, MIN_ANSWER_PIXELS, origin):
-            marked.append(idx)
-
-        selected, status = [], 'skipped'
-        if len(marked) == 1:
-            selected = marked
-        elif len(marked) > 1:
-            selected = marked
-            status = 'multiple'
-
-        correct_idx = answer_key.get(q_idx)
-        if correct_idx is not None:
-            if status == 'skipped':
-                status = 'correct' if not marked else 'wrong'
-                if marked and marked[0] == correct_idx:
-                    correct += 1
-            elif status == 'correct' or (len(marked) == 1 and marked[0] == correct_idx):
-                correct += 1
-
-            draw_answer_circles(img, bubbles, selected, correct_idx)
-    return correct
-
-
-def grade_answers_with_details(img, gray, questions, answer_key_dict):
+    sheet_result = sheet.sheet_result
+    key = sheet_result.key_vector(answer_key_dict)
+    score = sheet_result.score(key)
+
+    total_questions = sheet.total_questions
+    percentage = (score / total_questions * 100) if answer_key_dict else 0.0
+    stu_id, quiz_id, cls_id = sheet.student_id, sheet.quiz_id, sheet.class_id
+
+    return {
+        'score': score,
+        'total_questions': total_questions,
+        'percentage': percentage,
+        'student_id': stu_id if stu_id else [],
+        'quiz_id': quiz_id if quiz_id else [],
+        'class_id': cls_id if cls_id else [],
+        'sheet_result': sheet_result,
+        'key': key,
+        'thresholds': sheet.thresholds,
+        'timestamp': datetime.now().isoformat(),
+    }
+
+
+def quiz_id_to_version_code(quiz_id_digits: List[int], num_exam_id: int) -> str:
     """
-    Grade answers and return detailed results
+    Convert quiz ID digits to version code
     
     Args:
-        img: Image to draw on
-        gray: Grayscale image
-        questions: List of question definitions from template
-        answer_key_dict: Dict {question_index: answer_index}
+        quiz_id_digits: List[int] like [0, 0, 1]
+        num_exam_id: int like 3 (number of digits)
     
     Returns:
-        tuple: (score: int, answers: dict)
-        answers: {question_index: answer_index}
+        str: Version code like "001"
     """
-    correct = 0
-    answers = {}
-    
-    for q in questions:
-        q_idx = q['question'] - 1
-        bubbles = q['bubbles']
-        box = bounding_box(bubbles, img.shape)
-        thresh, origin = threshold_region(gray, box)
-        
-        marked = []
-        for cnt, idx in detect_marked(bubbles, thresh, MIN_ANSWER_PIXELS, origin):
-            marked.append(idx)
-        
-        # Determine selected answer
-        selected = None
-        if len(marked) == 1:
-            selected = marked[0]
-        elif len(marked) > 1:
-            # Multiple answers marked - take first one
-            selected = marked[0]
-        
-        # Store answer
-        answers[q_idx] = selected if selected is not None else -1
-        
-        # Check if correct
-        correct_idx = answer_key_dict.get(q_idx)
-        if correct_idx is not None:
-            if selected is not None and selected == correct_idx:
-                correct += 1
-            
-            # Draw circles
-            draw_answer_circles(img, bubbles, [selected] if selected is not None else [], correct_idx)
-    
-    return correct, answers
+    version_code = ''.join(map(str, quiz_id_digits))
+    version_code = version_code.zfill(num_exam_id)
+    return version_code
 
 
-def read_answers_only(img, gray, questions):
+def check_deadline(deadline: Optional[float], stage: str):
     """
-    Read answers without grading
-    
+    Stop a grading task whose caller has already given up on it
+
     Args:
-        img: Image (not used, but kept for consistency)
-        gray: Grayscale image
-        questions: List of question definitions from template
-    
-    Returns:
-        dict: {question_index: answer_index}
+        deadline: time.time() after which the result is no longer wanted (None = no limit)
+        stage: Name of the next stage, for the error message
+
+    Raises:
+        TimeoutError: if the deadline has passed
     """
-    answers = {}
-    
-    for q in questions:
-        q_idx = q['question'] - 1
-        bubbles = q['bubbles']
-        box = bounding_box(bubbles, img.shape)
-        thresh, origin = threshold_region(gray, box)
-        
-        marked = []
-        for cnt, idx in detect_marked(bubbles, thresh, MIN_ANSWER_PIXELS, origin):
-            marked.append(idx)
-        
-        # Determine selected answer
-        selected = None
-        if len(marked) == 1:
-            selected = marked[0]
-        elif len(marked) > 1:
-            selected = marked[0]  # Take first one
-        
-        answers[q_idx] = selected if selected is not None else -1
-    
-    return answers
-
-
-def read_id_section(img, gray, sec, label):
-    digits = []
-    for col in sec['columns']:
-        box, origin = bounding_box(col['bubbles'], gray.shape), None
-        thresh, origin = threshold_region(gray, box)
-        best = None
-        for b in col['bubbles']:
-            x = int(b['position'][0] - origin[0])
-            y = int(b['position'][1] - origin[1])
-            r = int(b['radius'])
-            mask = np.zeros_like(thresh, dtype=np.uint8)
-            cv2.circle(mask, (x, y), r, 255, -1)
-            cnt = cv2.countNonZero(cv2.bitwise_and(thresh, thresh, mask=mask))
-            if cnt >= MIN_ID_PIXELS[label] and (best is None or cnt > best[0]):
-                best = (cnt, b['value'], b)
-        if best is None:
-            return None
-        _, val, bub = best
-        digits.append(val)
-        # highlight bubble chọn
-        px, py, pr = map(int, bub['position'] + [bub['radius']])
-        cv2.circle(img, (px, py), pr, COLORS['correct'], 2)
-    return digits
-
-
-def encode_image_base64(img):
+    if deadline is not None and time.time() > deadline:
+        raise TimeoutError(f'Grading deadline passed before {stage}')
+
+
+def grade_image(
+    image_path: str,
+    template_json_path: str,
+    template_key: Optional[str],
+    num_exam_id: int,
+    version_keys: Dict[str, Dict[int, int]],
+    annotate='full',
+    threshold_mode: str = THRESHOLD_MODE,
+    dpi: int = WARP_DPI,
+    annotation_dir: Optional[str] = None,
+    thumbnail_width: int = THUMBNAIL_WIDTH,
+    annotation_encoding: Optional[Dict] = None,
+    raw_annotation: bool = False,
+    track: bool = False,
+    tracking_seed: Optional[Dict] = None,
+    deadline: Optional[float] = None,
+    annotation_owner: Optional[str] = None,
+) -> Dict:
     """
-    Encode image to base64 string
-    
+    Read and grade one sheet image, picking the answer key by the quiz ID on the sheet
+
+    Only takes plain arguments and returns a plain dict, so it can run in a
+    grading worker process (see grading.executor).
+
     Args:
-        img: Image as numpy array
-    
+        image_path: Path to input image, or the encoded image bytes
+        template_json_path: Path to template JSON
+        template_key: Template cache key, e.g. answersheet_id
+        num_exam_id: Number of quiz ID digits (AnswerKey.num_exam_id)
+        version_keys: {version_code: {question_index: answer_index}}
+        annotate: 'none' | 'thumbnail' | 'full' (or a bool), see annotation.render_annotation()
+        threshold_mode: Binarization mode, see read_sheet()
+        dpi: Resolution of the warped image, see read_sheet()
+        annotation_dir: Write the annotated image into this cache directory
+            and return its file name instead of inline base64
+        thumbnail_width: Thumbnail width in pixels
+        annotation_encoding: Output encoding of the annotated image
+            {'format', 'quality', 'max_width', 'max_height', 'crop'}, see
+            annotation.encode_image() / render_annotation()
+        raw_annotation: Return the encoded image bytes instead of inline base64
+            (for binary responses)
+        track: Return the seed for tracking the next frame of a scan session
+        tracking_seed: Seed of the previous frame, see read_sheet()
+        deadline: time.time() past which the caller no longer waits for the
+            result: checked before each stage (read, grade, annotate) so a
+            timed-out scan frees its worker at the next stage boundary
+        annotation_owner: Teacher id recorded on the cached annotation
+            (annotation_dir mode), see annotation.save_annotation()
+
     Returns:
-        str: Base64 encoded image
+        dict: {
+            'success': bool,
+            'score', 'total_questions', 'percentage',
+            'student_id': str, 'quiz_id': str, 'class_id': str,
+            'sheet_result': SheetResult,  # dense answers; the service converts
+                                          # them to 'answers' / 'answer_details'
+            'id_details': dict,  # per-digit status / confidence, see measure_id_section()
+            'version_code': str, 'thresholds': dict,
+            'annotated_image_base64': str,  # inline mode
+            'annotated_image_file': str,  # annotation_dir mode
+            'annotated_image_bytes': bytes,  # raw_annotation mode
+            'annotated_image_mime': str,  # e.g. 'image/jpeg'
+            'homography_error': float,  # Marker reprojection error (pixels at 300 DPI)
+            'tracking_seed': dict, 'tracked': bool,  # track mode
+            'error': str,  # Optional
+        }
+
+    Raises:
+        ValueError: if the sheet cannot be read
+        TimeoutError: if the deadline passes, see check_deadline()
     """
-    # Encode image to JPEG
-    _, buffer = cv2.imencode('.jpg', img)
-    # Encode to base64
-    image_base64 = base64.b64encode(buffer).decode('utf-8')
-    return image_base64
+    annotate = annotate_mode(annotate)
+    check_deadline(deadline, 'reading the sheet')
+
+    # 1. Warp and measure the sheet once (IDs + all bubbles)
+    sheet = read_sheet(
+        image_path,
+        template_json_path,
+        template_key=template_key,
+        threshold_mode=threshold_mode,
+        dpi=dpi,
+        roi_only=annotate == 'none',
+        grayscale=annotate == 'none',
+        tracking_seed=tracking_seed,
+    )
+    
+    # 2. Convert quiz_id to version_code
+    if not sheet.quiz_id:
+        return {
+            'success': False,
+            'error': 'Failed to read quiz ID from answer sheet',
+            'id_details': sheet.id_details,
+        }
+    version_code = quiz_id_to_version_code(sheet.quiz_id, num_exam_id)
+    
+    # 3. Grade the measured sheet (answers only if version not found)
+    check_deadline(deadline, 'grading')
+    answer_key_dict = version_keys.get(version_code)
+    result = grade_sheet(sheet, answer_key_dict)
+    
+    # 4. Render the annotated image only when asked: inline, raw bytes or into the cache
+    encoding = dict(annotation_encoding or {})
+    crop = encoding.pop('crop', None)
+    fmt = encoding.pop('format', 'jpeg')
+    annotated_image_base64 = annotated_image_file = annotated_image_bytes = annotated_image_mime = None
+    if annotate != 'none':
+        check_deadline(deadline, 'rendering the annotated image')
+    annotated_img = render_annotation(sheet, result, answer_key_dict, annotate, thumbnail_width, crop)
+    if annotated_img is not None:
+        data = encode_image(annotated_img, fmt, **encoding)
+        annotated_image_mime = IMAGE_FORMATS[fmt][1]
+        if annotation_dir:
+            annotated_image_file = save_annotation(data, annotation_dir, fmt, annotation_owner)
+        elif raw_annotation:
+            annotated_image_bytes = data
+        else:
+            annotated_image_base64 = base64.b64encode(data).decode('utf-8')
+    
+    response = {
+        'success': True,
+        'score': result['score'],
+        'total_questions': result['total_questions'],
+        'percentage': result['percentage'],
+        'student_id': ''.join(map(str, result['student_id'])) if result['student_id'] else '',
+        'quiz_id': ''.join(map(str, result['quiz_id'])) if result['quiz_id'] else '',
+        'class_id': ''.join(map(str, result['class_id'])) if result['class_id'] else None,
+        'sheet_result': result['sheet_result'],
+        'id_details': sheet.id_details,
+        'version_code': version_code,
+        'thresholds': result['thresholds'],
+        'annotated_image_base64': annotated_image_base64,
+        'annotated_image_file': annotated_image_file,
+        'annotated_image_bytes': annotated_image_bytes,
+        'annotated_image_mime': annotated_image_mime,
+        'homography_error': round(sheet.homography_error, 3),
+    }
+    if track:
+        response['tracking_seed'] = seed_from_homography(sheet.homography, sheet.image_size, sheet.template.page_size)
+        response['tracked'] = sheet.tracked
+    if answer_key_dict is None:
+        # Version not found → score = 0 (annotated image has IDs but no grading circles)
+        response['error'] = f'Version code {version_code} not found in answer key'
+    return response
 
 
 def process_answer_sheet(
@@ -376,18 +598,28 @@ def process_answer_sheet(
     template_json_path: str,
     answer_key_dict: Optional[Dict[int, int]] = None,
     save_warped: bool = False,
-    output_dir: Optional[str] = None
+    output_dir: Optional[str] = None,
+    threshold_mode: str = THRESHOLD_MODE,
+    dpi: int = WARP_DPI,
+    roi_only: bool = False,
+    grayscale: bool = False,
+    annotate: str = 'full',
 ) -> Dict:
     """
     Process answer sheet image and grade answers
-    
+
     Args:
-        image_path: Path to input image
+        image_path: Path to input image, or the encoded image bytes
         template_json_path: Path to template JSON
         answer_key_dict: Dict {question_index: answer_index} (optional)
         save_warped: Whether to save warped image
         output_dir: Directory to save output images (optional)
-    
+        threshold_mode: Binarization mode, see read_sheet()
+        dpi: Resolution of the warped image, see read_sheet()
+        roi_only: Warp only the sampled regions (no annotated image), see read_sheet()
+        grayscale: Decode/warp one channel only (no annotated image), see read_sheet()
+        annotate: 'none' | 'thumbnail' | 'full', see annotation.render_annotation()
+
     Returns:
         dict: {
             'score': int,
@@ -397,95 +629,31 @@ def process_answer_sheet(
             'quiz_id': List[int],
             'class_id': List[int],
             'answers': dict,  # {question_index: answer_index}
+            'sheet_result': SheetResult,  # Dense answers (see grading.results)
+            'thresholds': dict,  # Binarization thresholds per region
+            'homography_error': float,  # Marker reprojection error (pixels at 300 DPI)
             'warped_image': np.ndarray,  # Optional
-            'annotated_image': np.ndarray,
+            'annotated_image': np.ndarray,  # None if annotate='none' or no color warp
         }
     """
-    # 1. Load image and template
-    orig, gray, data = load_data(image_path, template_json_path)
-    
-    # 2. Detect ArUco markers
-    det = detect_aruco(gray, ARUCO_TYPE)
-    
-    # Check if we have enough markers (need at least 4)
-    if len(det) < 4:
-        corner_ids = {1, 5, 9, 10}
-        detected_ids = {m['id'] for m in det if m['id'] in corner_ids}
-        missing_ids = corner_ids - detected_ids
-        raise ValueError(
-            f'ArUco markers not detected. Missing markers: {missing_ids}. '
-            f'Detected: {detected_ids}. '
-            f'Please ensure all 4 corner markers are visible and well-lit.'
-        )
-    
-    # 3. Warp image to template
-    warped = warp_to_template(orig, det, data['aruco_marker'])
-    
-    if warped is None:
-        raise ValueError("Failed to warp image to template")
-    
-    # 4. Convert to grayscale
-    w_gray = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
-    
-    # 5. Read IDs
-    stu_id = read_id_section(warped, w_gray, data['student_id_section'], 'student')
-    quiz_id = read_id_section(warped, w_gray, data['quiz_id_section'], 'quiz')
-    cls_id = read_id_section(warped, w_gray, data['class_id_section'], 'class')
-    
-    # 6. Grade answers or read answers only
-    total_questions = len(data['answer_area']['questions'])
-    score = 0
-    answers = {}
-    
-    if answer_key_dict:
-        # Grade with answer key
-        score, answers = grade_answers_with_details(
-            warped, w_gray, data['answer_area']['questions'], answer_key_dict
-        )
-    else:
-        # Just read answers without grading
-        answers = read_answers_only(warped, w_gray, data['answer_area']['questions'])
-    
-    # 7. Calculate percentage
-    percentage = (score / total_questions * 100) if answer_key_dict else 0.0
-    
-    # 8. Add text overlay to annotated image
-    annotated_img = warped.copy()
-    lines = [f"Score: {score}/{total_questions} = {percentage:.2f}%"]
-    if stu_id:
-        lines.append("Student ID: " + ''.join(map(str, stu_id)))
-    if quiz_id:
-        lines.append("Quiz ID:    " + ''.join(map(str, quiz_id)))
-    if cls_id:
-        lines.append("Class ID:   " + ''.join(map(str, cls_id)))
-    for i, txt in enumerate(lines):
-        cv2.putText(annotated_img, txt, (10, 30 + i * 30), FONT, 0.8, COLORS['text'], 2)
-    
-    # 9. Save warped image if requested
-    warped_path = None
-    if save_warped and output_dir:
-        import os
+    annotate = annotate_mode(annotate)
+    sheet = read_sheet(
+        image_path, template_json_path, threshold_mode=threshold_mode, dpi=dpi, roi_only=roi_only, grayscale=grayscale,
+    )
+    result = grade_sheet(sheet, answer_key_dict)
+    result['homography_error'] = sheet.homography_error
+    result['annotated_image'] = render_annotation(sheet, result, answer_key_dict, annotate)
+    result['answers'] = result['sheet_result'].answers_dict()
+
+    # Save warped image if requested (grayscale warp when decoded without color)
+    warped = sheet.warped if sheet.warped is not None else sheet.gray
+    if save_warped and output_dir and warped is not None:
         os.makedirs(output_dir, exist_ok=True)
-        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        base_name = os.path.splitext(os.path.basename(image_path))[0] if isinstance(image_path, str) else 'upload'
         warped_path = os.path.join(output_dir, f"warped_{base_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg")
         cv2.imwrite(warped_path, warped)
-    
-    # 10. Return result
-    result = {
-        'score': score,
-        'total_questions': total_questions,
-        'percentage': percentage,
-        'student_id': stu_id if stu_id else [],
-        'quiz_id': quiz_id if quiz_id else [],
-        'class_id': cls_id if cls_id else [],
-        'answers': answers,
-        'annotated_image': annotated_img,
-        'timestamp': datetime.now().isoformat(),
-    }
-    
-    if warped_path:
         result['warped_image_path'] = warped_path
-    
+
     return result
 
 
@@ -0,0 +1,80 @@
+"""
+Homography from detected ArUco markers to template space.
+
+The four corner markers span the whole sheet, so when all of them are
+detected cv2.getPerspectiveTransform() on those 4 points gives the
+homography directly. It is kept if every other detected marker reprojects
+within max_error; otherwise (a marker detected at the wrong place, a
+crumpled sheet) the solver escalates to RANSAC over all matched markers.
+The reprojection error of the chosen homography over every matched marker
+(RANSAC outliers included) is returned as a quality metric of the warp.
+"""
+import cv2
+import numpy as np
+
+# Sai số chiếu lại tối đa (pixel ở 300 DPI) để giữ homography từ 4 marker góc
+HOMOGRAPHY_MAX_ERROR = 3.0
+# Ngưỡng inlier của RANSAC (pixel ở 300 DPI, nhân với scale khi warp ở DPI thấp hơn)
+RANSAC_REPROJ_THRESHOLD = 3.0
+
+
+def reprojection_error(H, src, dst):
+    """Largest distance between H(src) and dst (points as (N, 2) arrays)"""
+    if len(src) == 0:
+        return 0.0
+    projected = cv2.perspectiveTransform(src.reshape(-1, 1, 2).astype(np.float64), H).reshape(-1, 2)
+    return float(np.sqrt(((projected - dst) ** 2).sum(axis=1)).max())
+
+
+def solve_homography(detected, template_markers, corner_ids, max_error=HOMOGRAPHY_MAX_ERROR, ransac=True,
+                     ransac_threshold=RANSAC_REPROJ_THRESHOLD):
+    """
+    Homography from the input image to template space
+
+    Args:
+        detected: Detected markers [{'id', 'position'}] in the image
+        template_markers: Template markers [{'id', 'position'}] in template space
+        corner_ids: Ids of the 4 corner markers, in matching order
+        max_error: Largest reprojection error (template-space pixels) accepted
+            for the corner-marker homography
+        ransac: Escalate to RANSAC over all matched markers when the corner
+            homography is not accurate enough or a corner is missing
+        ransac_threshold: Largest reprojection error (template-space pixels)
+            of a RANSAC inlier; scale it with the template like max_error
+
+    Returns:
+        tuple: (H 3x3, reprojection error in template-space pixels, 'corners' | 'ransac')
+            The error is over every matched marker, so a marker rejected by
+            RANSAC still shows in it. With ransac=False the corner homography
+            is returned even if its error exceeds max_error.
+
+    Raises:
+        ValueError: if fewer than 4 markers match or no homography can be computed
+    """
+    positions = {}
+    for m in detected:
+        positions.setdefault(m['id'], m['position'])
+    matched = [(positions[m['id']], m['position']) for m in template_markers if m['id'] in positions]
+    if len(matched) < 4:
+        raise ValueError(f"Not enough markers found. Need 4, found {len(matched)}")
+    src = np.array([p for p, _ in matched], dtype=np.float32)
+    dst = np.array([p for _, p in matched], dtype=np.float32)
+
+    # 1. Exactly the 4 corners: direct solve, checked against the other markers
+    template_positions = {m['id']: m['position'] for m in template_markers}
+    if all(i in positions and i in template_positions for i in corner_ids):
+        H = cv2.getPerspectiveTransform(
+            np.array([positions[i] for i in corner_ids], dtype=np.float32),
+            np.array([template_positions[i] for i in corner_ids], dtype=np.float32),
+        )
+        error = reprojection_error(H, src, dst)
+        if error <= max_error or not ransac:
+            return H, error, 'corners'
+    elif not ransac:
+        raise ValueError(f"Corner markers missing: {set(corner_ids) - set(positions)}")
+
+    # 2. RANSAC over every matched marker
+    H, _ = cv2.findHomography(src, dst, cv2.RANSAC, ransac_threshold)
+    if H is None:
+        raise ValueError("Failed to compute homography from markers")
+    return H, reprojection_error(H, src, dst), 'ransac'
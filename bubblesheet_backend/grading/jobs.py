@@ -0,0 +1,211 @@
+"""
+In-process scan job queue.
+
+A local stand-in for a message broker: POST /api/grading/scan/?async=true
+registers a job and returns its id at once; a small dispatcher thread pool
+runs scan_and_grade() (which grades on the grading executor) and the result
+is kept for JOB_RESULT_TTL seconds so the client can poll
+GET /api/grading/scan/jobs/<job_id>/.
+
+While a job waits for a dispatcher its image is spooled to a file in
+JOB_SPOOL_DIR rather than held in memory, so MAX_QUEUED_JOBS full size
+uploads do not pin their bytes in the server process; the file is removed
+once the job has run.
+
+Jobs live in the memory of the server process that accepted them, so with
+several server processes the status must be polled on the same process
+(sticky sessions) until a shared broker replaces this module.
+"""
+import os
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .executor import GradingOverloaded
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed')
+DEFAULT_JOB_RESULT_TTL = 600  # seconds
+DEFAULT_MAX_QUEUED_JOBS = 100
+DEFAULT_JOB_DISPATCHERS = 2
+
+
+class ScanJob:
+    """
+    State of one asynchronous scan
+
+    Set by a dispatcher thread and read by request threads: updates go
+    through update() and reads through to_dict(), both under the queue lock.
+
+    Attributes:
+        job_id: Hex job id returned to the client
+        teacher_id: Owner (only the owner may read the status)
+        status: 'queued' | 'running' | 'done' | 'failed'
+        result: scan_and_grade() result once finished
+        error: Error message of a failed job
+    """
+
+    def __init__(self, teacher_id, lock=None):
+        self._lock = lock or threading.Lock()
+        self.job_id = uuid.uuid4().hex
+        self.teacher_id = str(teacher_id)
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def update(self, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def to_dict(self):
+        def iso(ts):
+            return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+        with self._lock:
+            return {
+                'job_id': self.job_id,
+                'status': self.status,
+                'result': self.result,
+                'error': self.error,
+                'created_at': iso(self.created_at),
+                'started_at': iso(self.started_at),
+                'finished_at': iso(self.finished_at),
+            }
+
+
+class ScanJobQueue:
+    """
+    Registry + dispatcher of scan jobs
+
+    Args:
+        dispatchers: Threads handing jobs to the grading executor
+        max_queued: Unfinished jobs allowed before submit() is rejected
+        result_ttl: Seconds a finished job is kept for polling
+        spool_dir: Directory of the images of waiting jobs (None = system temp dir)
+    """
+
+    def __init__(self, dispatchers=DEFAULT_JOB_DISPATCHERS, max_queued=DEFAULT_MAX_QUEUED_JOBS,
+                 result_ttl=DEFAULT_JOB_RESULT_TTL, spool_dir=None):
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.spool_dir = spool_dir
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(dispatchers)), thread_name_prefix='scan-job')
+
+    def _purge(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _spool(self, image):
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix='scan-job-', dir=self.spool_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(image)
+        return path
+
+    def submit(self, fn, owner_id, image, **kwargs):
+        """
+        Queue fn(image_path, **kwargs), a scan_and_grade()-like callable returning a result dict
+
+        Args:
+            owner_id: Teacher owning the job
+            image: Encoded image bytes, spooled to a file whose path is passed to fn
+
+        Returns:
+            ScanJob
+
+        Raises:
+            GradingOverloaded: if max_queued jobs are already waiting
+        """
+        job = ScanJob(owner_id, self._lock)
+        with self._lock:
+            self._purge()
+            pending = sum(1 for j in self._jobs.values() if not j.finished)
+            if pending >= self.max_queued:
+                raise GradingOverloaded('Too many scan jobs in progress, please retry later')
+            self._jobs[job.job_id] = job
+        path = None
+        try:
+            path = self._spool(image)
+            self._pool.submit(self._run, job, fn, path, kwargs)
+        except Exception:
+            if path is not None:
+                self._remove(path)
+            with self._lock:
+                self._jobs.pop(job.job_id, None)
+            raise
+        return job
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _run(self, job, fn, path, kwargs):
+        job.update(started_at=time.time(), status='running')
+        try:
+            result = fn(path, **kwargs)
+            job.update(
+                result=result,
+                error=result.get('error') if not result.get('success') else None,
+                status='done' if result.get('success') else 'failed',
+                finished_at=time.time(),
+            )
+        except Exception as e:
+            logger.error(f"Scan job {job.job_id} failed: {str(e)}")
+            job.update(error=f'Processing failed: {str(e)}', status='failed', finished_at=time.time())
+        finally:
+            self._remove(path)
+
+    def get(self, job_id, teacher_id=None):
+        """Job by id (None if unknown, expired or owned by another teacher)"""
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+        if job is None or (teacher_id is not None and job.teacher_id != str(teacher_id)):
+            return None
+        return job
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Process-wide ScanJobQueue configured from GRADING_CONFIG"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                from django.conf import settings
+                config = getattr(settings, 'GRADING_CONFIG', {})
+                _queue = ScanJobQueue(
+                    dispatchers=config.get('GRADING_WORKERS', DEFAULT_JOB_DISPATCHERS),
+                    max_queued=config.get('MAX_QUEUED_JOBS', DEFAULT_MAX_QUEUED_JOBS),
+                    result_ttl=config.get('JOB_RESULT_TTL', DEFAULT_JOB_RESULT_TTL),
+                    spool_dir=config.get('JOB_SPOOL_DIR'),
+                )
+    return _queue
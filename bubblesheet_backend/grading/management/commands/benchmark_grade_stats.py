@@ -0,0 +1,87 @@
+"""
+Benchmark the grade statistics backends on a quiz
+
+    python manage.py benchmark_grade_stats <quiz_id> [--repeat 5]
+
+Times, end to end including the database round trips:
+    engine        Grade documents → GradeMatrix → item_analysis_report (NumPy)
+    aggregate     MongoDB aggregation pipeline → quiz_stats_report
+    materialized  QuizStats document → quiz_stats_report
+and checks that the three agree on the per-question counts.
+"""
+import time
+import statistics
+
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+
+from answer_keys.models import AnswerKey
+from exams.models import Exam as Quiz
+from grading.aggregation import aggregate_quiz_stats
+from grading.analysis import GradeMatrix, KeyMatrix, item_analysis_report
+from grading.models import Grade
+from grading.quiz_stats import get_quiz_stats, quiz_stats_report
+
+COUNT_FIELDS = ('correct_count', 'incorrect_count', 'blank_count', 'option_counts')
+
+
+class Command(BaseCommand):
+    help = 'Compare the in-process, MongoDB aggregation and materialized grade statistics backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('quiz_id')
+        parser.add_argument('--teacher-id', help='Defaults to the teacher of the quiz')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        quiz_id = options['quiz_id']
+        quiz = Quiz.objects(id=quiz_id).first()
+        if not quiz:
+            raise CommandError(f'Quiz {quiz_id} not found')
+        answer_key = AnswerKey.objects(quiz_id=quiz_id).first()
+        if not answer_key:
+            raise CommandError(f'Answer key not found for quiz {quiz_id}')
+        teacher_id = ObjectId(str(options['teacher_id'] or quiz.teacher_id))
+        num_questions = answer_key.num_questions
+
+        def key_matrix():
+            return KeyMatrix(answer_key.versions, num_questions)
+
+        def engine():
+            grades = Grade.objects(exam_id=quiz_id, teacher_id=teacher_id).only(
+                'answers', 'version_code', 'score', 'percentage'
+            ).as_pymongo()
+            return item_analysis_report(GradeMatrix.from_documents(grades, num_questions), key_matrix())
+
+        def aggregate():
+            return quiz_stats_report(aggregate_quiz_stats(quiz_id, teacher_id), key_matrix(), num_questions)
+
+        def materialized():
+            return quiz_stats_report(get_quiz_stats(quiz_id, teacher_id), key_matrix(), num_questions)
+
+        backends = (('engine', engine), ('aggregate', aggregate), ('materialized', materialized))
+        get_quiz_stats(quiz_id, teacher_id)  # build the stats document outside the timings
+
+        reports = {}
+        self.stdout.write(f'{"backend":<14}{"min ms":>10}{"median ms":>12}')
+        for name, run in backends:
+            timings = []
+            for _ in range(max(1, options['repeat'])):
+                start = time.perf_counter()
+                reports[name] = run()
+                timings.append((time.perf_counter() - start) * 1000)
+            self.stdout.write(f'{name:<14}{min(timings):>10.1f}{statistics.median(timings):>12.1f}')
+
+        expected = reports['engine']
+        self.stdout.write(f'papers: {expected["total_papers"]}, questions: {num_questions}')
+        for name in ('aggregate', 'materialized'):
+            report = reports[name]
+            same = report['total_papers'] == expected['total_papers'] and all(
+                a[field] == b[field]
+                for a, b in zip(report['items'], expected['items'])
+                for field in COUNT_FIELDS
+            )
+            if same:
+                self.stdout.write(self.style.SUCCESS(f'{name}: counts match engine'))
+            else:
+                self.stdout.write(self.style.WARNING(f'{name}: counts differ from engine'))
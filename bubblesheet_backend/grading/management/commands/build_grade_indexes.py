@@ -0,0 +1,83 @@
+"""
+Build the declared indexes of the grading collections in the background
+
+    python manage.py build_grade_indexes [--dry-run] [--drop-obsolete]
+
+Grade creates its missing indexes in the background on first access
+(index_background), so a fresh deploy is always indexed. Run this before
+starting the new release when Grade.meta['indexes'] changed, so a large
+existing collection is indexed ahead of the first request: missing indexes
+are created with background=True (MongoDB >= 4.2 always uses its
+non-blocking index build), existing ones are left alone. Indexes no longer
+declared are only reported unless --drop-obsolete is given.
+"""
+from django.core.management.base import BaseCommand
+
+from grading.models import Grade, QuizStats
+
+MODELS = (Grade, QuizStats)
+
+
+def index_key(fields):
+    """Comparable key of an index: ((field, direction), ...)"""
+    return tuple((name, int(direction)) for name, direction in fields)
+
+
+def index_plan(model):
+    """
+    Declared vs existing indexes of a model's collection
+
+    Returns:
+        tuple: (missing [(fields, options)], present [name], obsolete [name])
+    """
+    collection = model._get_collection()
+    existing = {
+        index_key(info['key']): name
+        for name, info in collection.index_information().items()
+        if name != '_id_'
+    }
+    missing, present = [], []
+    declared = set()
+    for spec in model._meta.get('index_specs', []):
+        options = dict(spec)
+        options.pop('cls', None)
+        fields = options.pop('fields')
+        key = index_key(fields)
+        declared.add(key)
+        if key in existing:
+            present.append(existing[key])
+        else:
+            missing.append((fields, options))
+    obsolete = [name for key, name in existing.items() if key not in declared]
+    return missing, present, obsolete
+
+
+class Command(BaseCommand):
+    help = 'Create missing grading indexes in the background and report obsolete ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change')
+        parser.add_argument('--drop-obsolete', action='store_true', help='Drop indexes no longer declared')
+
+    def handle(self, *args, **options):
+        for model in MODELS:
+            collection = model._get_collection()
+            missing, present, obsolete = index_plan(model)
+            self.stdout.write(f'{collection.name}:')
+            for name in present:
+                self.stdout.write(f'  ok       {name}')
+
+            for fields, index_options in missing:
+                label = index_options.get('name') or ', '.join(f'{f} {d}' for f, d in fields)
+                if options['dry_run']:
+                    self.stdout.write(f'  missing  {label}')
+                    continue
+                name = collection.create_index(fields, background=True, **index_options)
+                self.stdout.write(self.style.SUCCESS(f'  created  {name}'))
+
+            for name in obsolete:
+                if options['drop_obsolete'] and not options['dry_run']:
+                    collection.drop_index(name)
+                    self.stdout.write(self.style.WARNING(f'  dropped  {name}'))
+                else:
+                    self.stdout.write(f'  obsolete {name}')
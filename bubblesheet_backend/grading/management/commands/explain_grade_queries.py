@@ -0,0 +1,117 @@
+"""
+Explain the hot Grade queries and check they are served by an index
+
+    python manage.py explain_grade_queries [--teacher-id ...] [--quiz-id ...]
+
+Each query shape of the grade list, grades-by-quiz, item analysis and quiz
+stats endpoints is run through MongoDB's explain. For each one the winning
+plan's index, whether MongoDB had to sort in memory (SORT stage) and the
+keys / documents examined per document returned are reported. A COLLSCAN,
+an in-memory SORT or a plan not using the compound index planned for the
+query is flagged. Sample filter values default to the most recently
+scanned grade.
+"""
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+
+from grading.models import Grade
+from grading.quiz_stats import STATS_FIELDS
+
+# (name, expected index, queryset factory) – the same filters / sort / projection as the views
+HOT_QUERIES = (
+    ('grade list', 'teacher_scanned', lambda s: Grade.objects(teacher_id=s['teacher_id']).order_by('-scanned_at')),
+    ('grade list by quiz', 'teacher_exam_scanned', lambda s: Grade.objects(
+        teacher_id=s['teacher_id'], exam_id=s['exam_id']).order_by('-scanned_at')),
+    ('grade list by quiz + student', 'teacher_exam_student_scanned', lambda s: Grade.objects(
+        teacher_id=s['teacher_id'], exam_id=s['exam_id'], student_id=s['student_id']).order_by('-scanned_at')),
+    ('grade list by quiz + class', 'teacher_exam_class_scanned', lambda s: Grade.objects(
+        teacher_id=s['teacher_id'], exam_id=s['exam_id'], class_code=s['class_code']).order_by('-scanned_at')),
+    ('grade list by student', 'teacher_student_scanned', lambda s: Grade.objects(
+        teacher_id=s['teacher_id'], student_id=s['student_id']).order_by('-scanned_at')),
+    ('grade list by class', 'teacher_class_scanned', lambda s: Grade.objects(
+        teacher_id=s['teacher_id'], class_code=s['class_code']).order_by('-scanned_at')),
+    ('grades for quiz', 'teacher_exam_scanned', lambda s: Grade.objects(
+        exam_id=s['exam_id'], teacher_id=s['teacher_id']).order_by('-scanned_at')),
+    ('item analysis', 'teacher_exam_scanned', lambda s: Grade.objects(
+        exam_id=s['exam_id'], teacher_id=s['teacher_id']).only('answers', 'version_code', 'score', 'percentage')),
+    ('quiz stats rebuild', 'teacher_exam_scanned', lambda s: Grade.objects(
+        exam_id=s['exam_id'], teacher_id=s['teacher_id']).only(*STATS_FIELDS)),
+    ('grades for quiz (any teacher)', 'exam_id_1', lambda s: Grade.objects(exam_id=s['exam_id'])),
+)
+
+
+def plan_stages(plan):
+    """[(stage, index name or None)] of a query plan, root first"""
+    plan = plan.get('queryPlan', plan)  # slot-based engine explain output
+    stages = [(plan.get('stage'), plan.get('indexName'))]
+    children = plan.get('inputStages') or ([plan['inputStage']] if 'inputStage' in plan else [])
+    for child in children:
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def summarize_explain(explain):
+    """
+    Index usage of an explain() result
+
+    Returns:
+        dict: {'indexes', 'collscan', 'in_memory_sort', 'keys_examined', 'docs_examined', 'returned'}
+    """
+    stages = plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+    stats = explain.get('executionStats', {})
+    return {
+        'indexes': [index for _, index in stages if index],
+        'collscan': any(stage == 'COLLSCAN' for stage, _ in stages),
+        'in_memory_sort': any(stage in ('SORT', 'SORT_KEY_GENERATOR') for stage, _ in stages),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'returned': stats.get('nReturned'),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Explain the hot Grade queries and report which index serves each'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teacher-id')
+        parser.add_argument('--quiz-id')
+        parser.add_argument('--student-id')
+        parser.add_argument('--class-code')
+
+    def handle(self, *args, **options):
+        sample = Grade._get_collection().find_one(
+            {'teacher_id': {'$ne': None}}, sort=[('scanned_at', -1)]
+        ) or {}
+        values = {
+            'teacher_id': options['teacher_id'] or sample.get('teacher_id'),
+            'exam_id': options['quiz_id'] or sample.get('exam_id'),
+            'student_id': options['student_id'] or sample.get('student_id'),
+            'class_code': options['class_code'] or sample.get('class_code'),
+        }
+        if not values['teacher_id']:
+            raise CommandError('No grades found; pass --teacher-id and --quiz-id')
+        values['teacher_id'] = ObjectId(str(values['teacher_id']))
+
+        problems = 0
+        for name, expected, query in HOT_QUERIES:
+            summary = summarize_explain(query(values).explain())
+            index = ', '.join(summary['indexes']) or '-'
+            line = (
+                f'{name:<30} index: {index:<32} keys: {summary["keys_examined"]} '
+                f'docs: {summary["docs_examined"]} returned: {summary["returned"]}'
+            )
+            if summary['collscan'] or summary['in_memory_sort']:
+                problems += 1
+                issue = 'COLLSCAN' if summary['collscan'] else 'in-memory SORT'
+                self.stdout.write(self.style.WARNING(f'{line}  [{issue}]'))
+            elif expected not in summary['indexes']:
+                self.stdout.write(self.style.WARNING(f'{line}  [expected {expected}]'))
+            else:
+                self.stdout.write(line)
+
+        if problems:
+            self.stdout.write(self.style.WARNING(
+                f'{problems} queries not fully served by an index (run build_grade_indexes)'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS('All hot queries use an index without in-memory sort'))
@@ -0,0 +1,94 @@
+"""
+Registry of ArUco marker detectors.
+
+Building the ArUco dictionary, DetectorParameters, ArucoDetector and CLAHE
+objects costs more than detecting markers on a small frame, so they are
+built once per (dictionary, preset) and reused. OpenCV objects are not
+guaranteed to be thread-safe, so each thread gets its own instances.
+"""
+import threading
+
+import cv2
+
+from .aruco_dict import ARUCO_DICT
+
+# Tham số theo mục đích sử dụng:
+# - 'grading': mặc định của OpenCV (quét đủ cửa sổ adaptive threshold), ổn định nhất
+# - 'preview': ít cửa sổ threshold hơn, bỏ blur, bỏ qua marker quá nhỏ → nhanh cho khung hình camera
+DETECTOR_PRESETS = {
+    'grading': {
+        'blur': 5,
+        'clahe': {'clipLimit': 2.0, 'tileGridSize': (8, 8)},
+        'params': {},
+    },
+    'preview': {
+        'blur': 0,
+        'clahe': {'clipLimit': 2.0, 'tileGridSize': (8, 8)},
+        'params': {
+            'adaptiveThreshWinSizeMin': 3,
+            'adaptiveThreshWinSizeMax': 23,
+            'adaptiveThreshWinSizeStep': 20,
+            'minMarkerPerimeterRate': 0.04,
+        },
+    },
+}
+
+
+class MarkerDetector:
+    """
+    Preprocessing + ArucoDetector for one dictionary and preset
+
+    Args:
+        aruco_type: Key of ARUCO_DICT, e.g. 'DICT_4X4_50'
+        preset: Key of DETECTOR_PRESETS
+    """
+
+    def __init__(self, aruco_type, preset='grading'):
+        if preset not in DETECTOR_PRESETS:
+            raise ValueError(f'Unknown detector preset: {preset}. Expected one of {tuple(DETECTOR_PRESETS)}')
+        config = DETECTOR_PRESETS[preset]
+        self.aruco_type = aruco_type
+        self.preset = preset
+        self.blur = config['blur']
+        self.clahe = cv2.createCLAHE(**config['clahe']) if config['clahe'] else None
+        self.dictionary = cv2.aruco.getPredefinedDictionary(ARUCO_DICT[aruco_type])
+        self.params = cv2.aruco.DetectorParameters()
+        for name, value in config['params'].items():
+            setattr(self.params, name, value)
+        self.detector = cv2.aruco.ArucoDetector(self.dictionary, self.params)
+
+    def preprocess(self, gray):
+        if self.blur:
+            gray = cv2.GaussianBlur(gray, (self.blur, self.blur), 0)
+        if self.clahe is not None:
+            gray = self.clahe.apply(gray)
+        return gray
+
+    def detect(self, gray):
+        """
+        Detect markers on a grayscale image
+
+        Returns:
+            List[Dict]: [{'id': int, 'position': [cX, cY]}] marker centers
+        """
+        (corners, ids, _) = self.detector.detectMarkers(self.preprocess(gray))
+        positions = []
+        if ids is not None:
+            for markerCorner, markerID in zip(corners, ids.flatten()):
+                (topLeft, topRight, bottomRight, bottomLeft) = markerCorner.reshape((4, 2))
+                cX = int((topLeft[0] + bottomRight[0]) / 2.0)
+                cY = int((topLeft[1] + bottomRight[1]) / 2.0)
+                positions.append({'id': int(markerID), 'position': [cX, cY]})
+        return positions
+
+
+_local = threading.local()
+
+
+def get_marker_detector(aruco_type, preset='grading'):
+    """MarkerDetector for (aruco_type, preset), built once per thread"""
+    cache = _local.__dict__
+    detector = cache.get((aruco_type, preset))
+    if detector is None:
+        detector = cache[(aruco_type, preset)] = MarkerDetector(aruco_type, preset)
+    return detector
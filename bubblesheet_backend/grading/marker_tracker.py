@@ -0,0 +1,162 @@
+"""
+Marker tracking for burst scans of the same sheet layout.
+
+With a fixed camera (scanning stand) consecutive frames put the markers at
+almost the same pixels. track_markers() projects the template markers back
+into the image through the previous frame's homography and runs the ArUco
+detector only in a small window around each expected position, instead of
+over the whole frame. The tracked homography is solved from the corner
+markers without RANSAC and accepted only if every corner marker was found
+and the reprojection error stays small; otherwise the caller falls back to
+full detection.
+
+The seed is plain data (lists), so it can be handed to a grading worker
+process. Seeds of a scan session are kept by TrackingSessions in the server
+process between requests.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from .homography import HOMOGRAPHY_MAX_ERROR, solve_homography
+from .marker_detector import get_marker_detector
+
+# Cửa sổ tìm marker: hộp marker dự kiến nới thêm TRACK_WINDOW_MARGIN lần cạnh marker mỗi phía
+TRACK_WINDOW_MARGIN = 1.0
+TRACK_MIN_MARGIN = 16  # pixels
+# Sai số chiếu lại tối đa của homography khi tracking (pixel ở 300 DPI)
+TRACK_MAX_ERROR = HOMOGRAPHY_MAX_ERROR
+
+DEFAULT_SESSION_TTL = 300  # seconds
+DEFAULT_MAX_SESSIONS = 1000
+
+_BOX_CORNERS = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64) / 2
+
+
+def seed_from_homography(homography, image_size, page_size):
+    """
+    Seed for the next frame of a session
+
+    Args:
+        homography: 3x3 homography from the image to warped-image space
+        image_size: (width, height) of the input image
+        page_size: (width, height) of the warped image
+
+    Returns:
+        dict: {'homography', 'image_size', 'page_size'} of plain lists
+    """
+    return {
+        'homography': np.asarray(homography, dtype=np.float64).tolist(),
+        'image_size': [int(v) for v in image_size],
+        'page_size': [int(v) for v in page_size],
+    }
+
+
+def track_markers(gray, template, seed, aruco_type, corner_ids):
+    """
+    Detect markers only around the positions predicted by the previous homography
+
+    Args:
+        gray: Grayscale input image
+        template: CompiledTemplate
+        seed: seed_from_homography() of the previous frame
+        aruco_type: Key of ARUCO_DICT
+        corner_ids: Ids of the 4 corner markers, see homography.solve_homography()
+
+    Returns:
+        tuple: (detected [{'id', 'position'}], H, reprojection error in
+            warped-image pixels) or None if tracking failed
+    """
+    h, w = gray.shape[:2]
+    if not seed or list(seed['image_size']) != [w, h] or list(seed['page_size']) != list(template.page_size):
+        return None
+    try:
+        inv = np.linalg.inv(np.asarray(seed['homography'], dtype=np.float64))
+    except np.linalg.LinAlgError:
+        return None
+
+    # Expected marker boxes in the image
+    boxes = template.marker_positions[:, None, :] + _BOX_CORNERS[None] * template.marker_sizes[:, None, None]
+    boxes = cv2.perspectiveTransform(boxes.reshape(-1, 1, 2), inv).reshape(-1, 4, 2)
+
+    detector = get_marker_detector(aruco_type, 'grading')
+    detected = []
+    for marker_id, box in zip(template.marker_ids.tolist(), boxes):
+        (bx1, by1), (bx2, by2) = box.min(axis=0), box.max(axis=0)
+        margin = max(TRACK_MIN_MARGIN, TRACK_WINDOW_MARGIN * max(bx2 - bx1, by2 - by1))
+        x1, y1 = max(0, int(bx1 - margin)), max(0, int(by1 - margin))
+        x2, y2 = min(w, int(np.ceil(bx2 + margin))), min(h, int(np.ceil(by2 + margin)))
+        if x2 - x1 < 2 * TRACK_MIN_MARGIN or y2 - y1 < 2 * TRACK_MIN_MARGIN:
+            continue
+        for m in detector.detect(gray[y1:y2, x1:x2]):
+            if m['id'] == marker_id:
+                detected.append({'id': marker_id, 'position': [m['position'][0] + x1, m['position'][1] + y1]})
+                break
+
+    # Markers were found where expected: solve from the corners, no RANSAC
+    try:
+        H, error, _ = solve_homography(detected, template.markers, corner_ids, ransac=False)
+    except ValueError:
+        return None
+    if error > TRACK_MAX_ERROR * template.scale:
+        return None
+    return detected, H, error
+
+
+class TrackingSessions:
+    """
+    Tracking seeds of active scan sessions (in the memory of this process)
+
+    Args:
+        ttl: Seconds a session is kept after its last frame
+        max_sessions: Sessions kept at most (least recently used dropped first)
+    """
+
+    def __init__(self, ttl=DEFAULT_SESSION_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._seeds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Seed of a session, or None if unknown / expired"""
+        with self._lock:
+            entry = self._seeds.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._seeds[key]
+                return None
+            return entry[1]
+
+    def update(self, key, seed):
+        """Store the seed of the latest frame (None forgets the session)"""
+        with self._lock:
+            self._seeds.pop(key, None)
+            if seed is None:
+                return
+            self._seeds[key] = (time.time(), seed)
+            while len(self._seeds) > self.max_sessions:
+                self._seeds.popitem(last=False)
+
+
+_sessions = None
+_sessions_lock = threading.Lock()
+
+
+def get_tracking_sessions():
+    """Process-wide TrackingSessions configured from GRADING_CONFIG"""
+    global _sessions
+    if _sessions is None:
+        with _sessions_lock:
+            if _sessions is None:
+                from django.conf import settings
+                config = getattr(settings, 'GRADING_CONFIG', {})
+                _sessions = TrackingSessions(
+                    ttl=config.get('SCAN_SESSION_TTL', DEFAULT_SESSION_TTL),
+                    max_sessions=config.get('MAX_SCAN_SESSIONS', DEFAULT_MAX_SESSIONS),
+                )
+    return _sessions
@@ -1,4 +1,6 @@
-from mongoengine import Document, StringField, FloatField, DictField, DateTimeField, ObjectIdField
+from mongoengine import (
+    Document, StringField, FloatField, IntField, BooleanField, DictField, DateTimeField, ObjectIdField,
+)
 from datetime import datetime
 
 
@@ -26,17 +28,63 @@ class Grade(Document):
         'collection': 'grades',
         'strict': False,  # Ignore fields not defined in model (e.g., is_latest, attempt_number from old data)
         'indexes': [
+            # Index đơn của bản gốc: vẫn phục vụ các truy vấn không lọc theo teacher_id (vd. chỉ theo exam_id)
             'exam_id',
             'student_id',
             'class_code',
             'teacher_id',
             'version_code',
             'scanned_at',
+            # Truy vấn của view lọc theo teacher_id (+ exam_id / student_id / class_code) và sắp xếp -scanned_at:
+            # index compound theo thứ tự equality → sort để không phải sort trong bộ nhớ
+            {'fields': ['teacher_id', '-scanned_at'], 'name': 'teacher_scanned'},
+            {'fields': ['teacher_id', 'exam_id', '-scanned_at'], 'name': 'teacher_exam_scanned'},
+            {'fields': ['teacher_id', 'exam_id', 'student_id', '-scanned_at'], 'name': 'teacher_exam_student_scanned'},
+            {'fields': ['teacher_id', 'exam_id', 'class_code', '-scanned_at'], 'name': 'teacher_exam_class_scanned'},
+            {'fields': ['teacher_id', 'student_id', '-scanned_at'], 'name': 'teacher_student_scanned'},
+            {'fields': ['teacher_id', 'class_code', '-scanned_at'], 'name': 'teacher_class_scanned'},
         ],
+        # Index còn thiếu được tạo nền (background) khi truy cập collection lần đầu;
+        # `manage.py build_grade_indexes` tạo trước lúc deploy và báo index thừa
+        'index_background': True,
         'ordering': ['-scanned_at']
     }
     
     def save(self, *args, **kwargs):
         """Override save to update updated_at"""
         self.updated_at = datetime.now()
-        return super().save(*args, **kwargs)
\ No newline at end of file
+        return super().save(*args, **kwargs)
+
+
+class QuizStats(Document):
+    """
+    Materialized statistics of the grades of one quiz (per teacher)
+
+    Kept up to date with atomic $inc updates by grading.quiz_stats whenever a
+    grade is saved, edited or deleted, so dashboard reads cost O(questions)
+    instead of a pass over every Grade of the quiz. See grading.quiz_stats for
+    how generation / revision keep rebuilds and increments consistent.
+    """
+    exam_id = StringField(required=True)  # quiz_id
+    teacher_id = ObjectIdField()
+    num_papers = IntField(default=0)
+    papers = DictField()  # {version_key: number of papers}
+    option_counts = DictField()  # {version_key: {question: {answer_code: count}}} (blank answers not stored)
+    score_histogram = DictField()  # {score in hundredths: count}
+    score_count = IntField(default=0)
+    score_sum = FloatField(default=0.0)
+    score_sq_sum = FloatField(default=0.0)
+    percentage_count = IntField(default=0)
+    percentage_sum = FloatField(default=0.0)
+    generation = IntField(default=0)  # Tăng mỗi lần rebuild / đánh dấu stale
+    revision = IntField(default=0)  # Tăng mỗi lần $inc, rebuild chỉ ghi đè nếu không đổi
+    stale = BooleanField(default=False)  # Cần rebuild ở lần đọc tới
+    updated_at = DateTimeField(default=datetime.now)
+
+    meta = {
+        'collection': 'quiz_stats',
+        'strict': False,
+        'indexes': [
+            {'fields': ['exam_id', 'teacher_id'], 'unique': True},
+        ],
+    }
@@ -0,0 +1,77 @@
+"""
+multipart/mixed encoding of scan results.
+
+With annotation_output=binary the scan endpoints answer with a
+multipart/mixed body instead of JSON: every result is an application/json
+part and its annotated image follows as a raw image part (no base64). The
+JSON part references the image by its Content-ID in 'annotated_image_part',
+so a client can show the score as soon as the JSON part arrives and read
+the image bytes afterwards. Parts are produced by generators so a batch is
+streamed sheet by sheet.
+"""
+import json
+import uuid
+
+MULTIPART_CONTENT_TYPE = 'multipart/mixed'
+
+
+def new_boundary():
+    return f'scan-{uuid.uuid4().hex}'
+
+
+def content_type(boundary):
+    """Content-Type header of a multipart/mixed body with this boundary"""
+    return f'{MULTIPART_CONTENT_TYPE}; boundary={boundary}'
+
+
+def encode_part(boundary, body, part_type, part_id=None):
+    """
+    One multipart part (delimiter, headers and body)
+
+    Args:
+        boundary: Multipart boundary
+        body: Part body bytes
+        part_type: Content-Type of the part
+        part_id: Optional Content-ID (without angle brackets)
+
+    Returns:
+        bytes
+    """
+    headers = [f'--{boundary}', f'Content-Type: {part_type}', f'Content-Length: {len(body)}']
+    if part_id:
+        headers.append(f'Content-ID: <{part_id}>')
+    return '\r\n'.join(headers).encode('ascii') + b'\r\n\r\n' + body + b'\r\n'
+
+
+def json_part(boundary, data, part_id=None, encoder=None):
+    """application/json part of data (encoder: optional json.JSONEncoder class)"""
+    body = json.dumps(data, cls=encoder).encode('utf-8')
+    return encode_part(boundary, body, 'application/json', part_id)
+
+
+def closing(boundary):
+    """Close delimiter ending the body"""
+    return f'--{boundary}--\r\n'.encode('ascii')
+
+
+def result_parts(boundary, result, part_id, encoder=None):
+    """
+    Yield the parts of one scan result: its JSON, then the annotated image if any
+
+    The raw 'annotated_image_bytes' are moved out of the JSON into their own
+    part, referenced by 'annotated_image_part'.
+
+    Args:
+        boundary: Multipart boundary
+        result: scan_and_grade() result with annotation_output='binary'
+        part_id: Content-ID of the JSON part; the image part is '<part_id>-image'
+        encoder: Optional json.JSONEncoder class
+    """
+    result = dict(result)
+    image = result.pop('annotated_image_bytes', None)
+    image_part = f'{part_id}-image' if image else None
+    result['annotated_image_part'] = image_part
+    yield json_part(boundary, result, part_id, encoder)
+    if image:
+        yield encode_part(boundary, image, result.get('annotated_image_mime') or 'application/octet-stream',
+                          image_part)
@@ -0,0 +1,397 @@
+"""
+Materialized per-quiz statistics.
+
+A QuizStats document per (quiz, teacher) holds how often each answer code
+was given to each question (per version), a score histogram and running
+sums for the score mean / variance. Saving, editing or deleting a grade
+applies the grade's contribution (+1 / -1) with one atomic $inc update.
+Correct / incorrect / blank counts are derived at read time from the
+option counts and the current answer key, so editing the answer key does
+not invalidate the document.
+
+Increments and rebuilds are ordered by two counters of the document:
+'generation' changes on every rebuild (or when the document is marked
+stale), 'revision' on every increment.
+- QuizStatsUpdate reads the generation before the grade is written; its
+  $inc only matches that generation and bumps the revision. If it misses
+  (a rebuild got in between, or there is no document yet) the document is
+  marked stale, upserting it if needed.
+- A rebuild reads generation and revision before counting the grades and
+  replaces the document only if both are unchanged, retrying otherwise.
+So a grade written during a rebuild either makes the rebuild retry or
+leaves the document stale, and a stale or missing document is rebuilt on
+the next read: no change is lost. Concurrent increments do not conflict.
+
+Discrimination, point-biserial and KR-20 need the score of every paper and
+stay in the full item analysis (grading.analysis).
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+
+from pymongo.errors import DuplicateKeyError
+
+from .analysis import (
+    BLANK, INVALID, NO_KEY, MIN_OPTIONS, OPTION_LETTERS, encode_student_answer,
+)
+from .models import Grade, QuizStats
+
+logger = logging.getLogger(__name__)
+
+# Trường của Grade dùng cho thống kê
+STATS_FIELDS = ('exam_id', 'teacher_id', 'answers', 'version_code', 'score', 'percentage')
+
+# Số lần thử lại khi rebuild bị cập nhật đồng thời chen vào
+REBUILD_ATTEMPTS = 3
+
+
+def version_key(version_code):
+    """Field name of a version code ('.' and '$' are not allowed in MongoDB field names)"""
+    return 'v' + (version_code or '').replace('.', '．').replace('$', '＄')
+
+
+def version_code_of(key):
+    """Inverse of version_key()"""
+    return key[1:].replace('．', '.').replace('＄', '$')
+
+
+def grade_snapshot(grade):
+    """
+    Fields of a grade the statistics depend on
+
+    Take it before modifying a grade so its old contribution can be removed.
+
+    Args:
+        grade: Grade document or raw dict (as_pymongo)
+    """
+    doc = grade if isinstance(grade, dict) else grade.to_mongo()
+    return {field: doc.get(field) for field in STATS_FIELDS}
+
+
+def grade_increments(snapshot, sign=1):
+    """
+    $inc paths of one grade's contribution
+
+    Args:
+        snapshot: grade_snapshot()
+        sign: 1 to add the grade, -1 to remove it
+
+    Returns:
+        dict: {dotted path: increment}
+    """
+    vkey = version_key(snapshot.get('version_code'))
+    inc = {'num_papers': sign, f'papers.{vkey}': sign}
+
+    for question, value in (snapshot.get('answers') or {}).items():
+        question = str(question)
+        if not question.isdigit():
+            continue
+        code = encode_student_answer(value)
+        if code != BLANK:
+            inc[f'option_counts.{vkey}.{question}.{code}'] = sign
+
+    score = snapshot.get('score')
+    if score is not None:
+        score = float(score)
+        inc[f'score_histogram.{int(round(score * 100))}'] = sign
+        inc['score_count'] = sign
+        inc['score_sum'] = sign * score
+        inc['score_sq_sum'] = sign * score * score
+    percentage = snapshot.get('percentage')
+    if percentage is not None:
+        inc['percentage_count'] = sign
+        inc['percentage_sum'] = sign * float(percentage)
+    return inc
+
+
+def _stats_key(snapshot):
+    return snapshot.get('exam_id'), snapshot.get('teacher_id')
+
+
+# Generation of a quiz without a usable statistics document
+NO_STATS = object()
+
+
+def _read_generation(exam_id, teacher_id):
+    """Generation of a quiz's statistics document, NO_STATS if missing or stale"""
+    doc = QuizStats._get_collection().find_one(
+        {'exam_id': exam_id, 'teacher_id': teacher_id}, {'generation': 1, 'stale': 1}
+    )
+    if doc is None or doc.get('stale'):
+        return NO_STATS
+    return doc.get('generation')
+
+
+def mark_quiz_stats_stale(exam_id, teacher_id):
+    """Flag (creating if needed) the statistics of a quiz for a rebuild on the next read"""
+    QuizStats._get_collection().update_one(
+        {'exam_id': exam_id, 'teacher_id': teacher_id},
+        {'$set': {'stale': True, 'updated_at': datetime.now()}, '$inc': {'generation': 1}},
+        upsert=True,
+    )
+
+
+class QuizStatsUpdate:
+    """
+    Change of grades to apply to their quiz statistics
+
+    Create it before writing the grades (it reads the statistics
+    generation), call apply() after the write:
+
+        update = QuizStatsUpdate(removed=[grade_snapshot(grade)])
+        grade.delete()
+        update.apply()
+
+    Args:
+        removed: grade_snapshot() of grades removed or as they were before an edit
+        added: grade_snapshot() of grades added or as they are after an edit
+    """
+
+    def __init__(self, removed=(), added=()):
+        self.changes = [(snapshot, -1) for snapshot in removed] + [(snapshot, 1) for snapshot in added]
+        self.generations = {}
+        for snapshot, _ in self.changes:
+            key = _stats_key(snapshot)
+            if key[0] and key not in self.generations:
+                try:
+                    self.generations[key] = _read_generation(*key)
+                except Exception as e:
+                    logger.error(f"Failed to read quiz stats for {key[0]}: {str(e)}")
+                    self.generations[key] = NO_STATS
+
+    def increments(self):
+        """{(exam_id, teacher_id): {dotted path: increment}} of all changes"""
+        merged = {}
+        for snapshot, sign in self.changes:
+            key = _stats_key(snapshot)
+            if key not in self.generations:
+                continue
+            inc = merged.setdefault(key, defaultdict(int))
+            for path, value in grade_increments(snapshot, sign).items():
+                inc[path] += value
+        return merged
+
+    def apply(self):
+        """
+        Apply the changes, one atomic update per quiz
+
+        Failures are logged, never raised: the grades are already written and
+        a quiz whose update failed is marked stale (rebuilt on the next read).
+
+        Returns:
+            bool: True if every quiz's statistics were incremented
+        """
+        applied = True
+        for (exam_id, teacher_id), inc in self.increments().items():
+            generation = self.generations[(exam_id, teacher_id)]
+            try:
+                if generation is not NO_STATS:
+                    inc['revision'] = 1
+                    result = QuizStats._get_collection().update_one(
+                        {'exam_id': exam_id, 'teacher_id': teacher_id, 'generation': generation},
+                        {'$inc': dict(inc), '$set': {'updated_at': datetime.now()}},
+                    )
+                    if result.matched_count > 0:
+                        continue
+                # No document yet, or rebuilt / updated since the generation was read
+                applied = False
+                mark_quiz_stats_stale(exam_id, teacher_id)
+            except Exception as e:
+                applied = False
+                logger.error(f"Failed to update quiz stats for {exam_id}: {str(e)}")
+                try:
+                    mark_quiz_stats_stale(exam_id, teacher_id)
+                except Exception:
+                    pass
+        return applied
+
+
+def _nest(increments):
+    """{'a.b.c': 1} → {'a': {'b': {'c': 1}}}"""
+    nested = {}
+    for path, value in increments.items():
+        *parents, leaf = path.split('.')
+        node = nested
+        for name in parents:
+            node = node.setdefault(name, {})
+        node[leaf] = value
+    return nested
+
+
+def count_quiz_stats(exam_id, teacher_id):
+    """Statistics document of a quiz counted from its grades (one pass, not stored)"""
+    totals = defaultdict(float)
+    grades = Grade.objects(exam_id=exam_id, teacher_id=teacher_id).only(*STATS_FIELDS).as_pymongo()
+    for grade in grades:
+        for path, value in grade_increments(grade_snapshot(grade)).items():
+            totals[path] += value
+
+    doc = {
+        'exam_id': exam_id, 'teacher_id': teacher_id,
+        'num_papers': 0, 'papers': {}, 'option_counts': {}, 'score_histogram': {},
+        'score_count': 0, 'score_sum': 0.0, 'score_sq_sum': 0.0,
+        'percentage_count': 0, 'percentage_sum': 0.0,
+    }
+    float_fields = ('score_sum', 'score_sq_sum', 'percentage_sum')
+    doc.update(_nest({p: v if p in float_fields else int(v) for p, v in totals.items()}))
+    return doc
+
+
+def rebuild_quiz_stats(exam_id, teacher_id, attempts=REBUILD_ATTEMPTS):
+    """
+    Recompute the statistics document of a quiz from its grades
+
+    The document is replaced only if nothing touched it while the grades
+    were counted (same generation and revision); otherwise the count is
+    retried. If every attempt is interrupted the last count is returned
+    without being stored (a stale document is rebuilt on the next read).
+
+    Returns:
+        dict: The statistics document
+    """
+    collection = QuizStats._get_collection()
+    query = {'exam_id': exam_id, 'teacher_id': teacher_id}
+    for _ in range(max(1, attempts)):
+        current = collection.find_one(query, {'generation': 1, 'revision': 1})
+        doc = count_quiz_stats(exam_id, teacher_id)
+        doc.update({'revision': 0, 'stale': False, 'updated_at': datetime.now()})
+        if current is None:
+            doc['generation'] = 1
+            try:
+                collection.insert_one(dict(doc))
+                return doc
+            except DuplicateKeyError:
+                continue
+        doc['generation'] = (current.get('generation') or 0) + 1
+        unchanged = {**query, 'generation': current.get('generation'), 'revision': current.get('revision')}
+        if collection.replace_one(unchanged, doc).matched_count > 0:
+            return doc
+    logger.warning(f"Quiz stats rebuild for {exam_id} kept being interrupted, not stored")
+    return doc
+
+
+def get_quiz_stats(exam_id, teacher_id, rebuild=False):
+    """Statistics document of a quiz (raw dict), rebuilt if missing, stale or when rebuild=True"""
+    if not rebuild:
+        doc = QuizStats.objects(exam_id=exam_id, teacher_id=teacher_id).as_pymongo().first()
+        if doc is not None and not doc.get('stale'):
+            return doc
+    return rebuild_quiz_stats(exam_id, teacher_id)
+
+
+def histogram_statistics(stats):
+    """
+    Score summary from the histogram and running sums
+
+    Returns:
+        dict: Same keys as analysis.score_statistics()
+    """
+    histogram = sorted(
+        (int(bin_), count) for bin_, count in (stats.get('score_histogram') or {}).items() if count > 0
+    )
+    n = stats.get('score_count') or 0
+    if histogram and n > 0:
+        values = np.array([b for b, _ in histogram], dtype=np.float64) / 100
+        cumulative = np.cumsum([c for _, c in histogram])
+        total = int(cumulative[-1])
+        # Median: average of the two middle scores
+        low, high = np.searchsorted(cumulative, [(total - 1) // 2 + 1, total // 2 + 1])
+        median = float(values[low] + values[high]) / 2
+        mean = stats['score_sum'] / n
+        std = float(np.sqrt(max(0.0, stats['score_sq_sum'] / n - mean ** 2))) if n > 1 else 0.0
+        summary = (float(values[0]), float(values[-1]), mean, median, std)
+    else:
+        summary = (0, 0, 0, 0, 0)
+    min_score, max_score, avg_score, median_score, std_dev = summary
+    percentage_count = stats.get('percentage_count') or 0
+    avg_percent = stats.get('percentage_sum', 0) / percentage_count if percentage_count > 0 else 0
+    return {
+        'min_score': round(min_score, 2),
+        'max_score': round(max_score, 2),
+        'average_score': round(avg_score, 2),
+        'average_percent': round(avg_percent, 2),
+        'median_score': round(median_score, 2),
+        'std_deviation': round(std_dev, 2),
+    }
+
+
+def quiz_stats_report(stats, key, num_questions):
+    """
+    Dashboard statistics of a quiz from its materialized document
+
+    Args:
+        stats: get_quiz_stats() document
+        key: analysis.KeyMatrix of the quiz's answer key
+        num_questions: Number of questions
+
+    Returns:
+        dict: {'total_papers', 'num_questions', 'items', 'statistics', 'score_histogram'}
+            Items carry the counts / percentages of the item analysis,
+            'option_counts' and 'difficulty'.
+    """
+    total = max(0, stats.get('num_papers') or 0)
+    correct = np.zeros(num_questions, dtype=np.int64)
+    answered = np.zeros(num_questions, dtype=np.int64)
+    codes = defaultdict(lambda: np.zeros(num_questions, dtype=np.int64))
+    missing_row = len(key.codes) - 1
+
+    for vkey, questions in (stats.get('option_counts') or {}).items():
+        expected = key.codes[key.version_codes.get(version_code_of(vkey), missing_row)]
+        for question, counts in questions.items():
+            q = int(question) - 1
+            if not 0 <= q < num_questions:
+                continue
+            for code, count in counts.items():
+                code = int(code)
+                answered[q] += count
+                codes[code][q] += count
+                if code == expected[q] and code not in (NO_KEY, INVALID):
+                    correct[q] += count
+
+    answered = np.maximum(answered, 0)
+    correct = np.maximum(correct, 0)
+    blank = np.maximum(total - answered, 0)
+    incorrect = answered - correct
+
+    # Option letters as in analysis.analyze_items()
+    valid_keys = key.codes[key.codes >= 0]
+    used = [c for c, counts in codes.items() if 0 <= c < len(OPTION_LETTERS) and counts.any()]
+    num_options = max(
+        MIN_OPTIONS, max(used, default=-1) + 1,
+        int(valid_keys[valid_keys < len(OPTION_LETTERS)].max(initial=-1)) + 1,
+    )
+    options = list(OPTION_LETTERS[:num_options])
+    zeros = np.zeros(num_questions, dtype=np.int64)
+    option_counts = np.stack([np.maximum(codes.get(i, zeros), 0) for i in range(num_options)], axis=1).tolist()
+
+    def percent(count):
+        return round(count / total * 100, 2) if total > 0 else 0
+
+    items = []
+    for q in range(num_questions):
+        c, i, b = int(correct[q]), int(incorrect[q]), int(blank[q])
+        items.append({
+            'question_number': q + 1,
+            'correct_answer': key.display_answers[q],
+            'correct_count': c,
+            'incorrect_count': i,
+            'blank_count': b,
+            'correct_percent': percent(c),
+            'incorrect_percent': percent(i),
+            'blank_percent': percent(b),
+            'option_counts': dict(zip(options, option_counts[q])),
+            'difficulty': round(c / total, 4) if total > 0 else None,
+        })
+
+    histogram = sorted(
+        (int(bin_), count) for bin_, count in (stats.get('score_histogram') or {}).items() if count > 0
+    )
+    return {
+        'total_papers': total,
+        'num_questions': num_questions,
+        'items': items,
+        'statistics': histogram_statistics(stats),
+        'score_histogram': [{'score': b / 100, 'count': count} for b, count in histogram],
+    }
@@ -0,0 +1,201 @@
+"""
+Dense grading results.
+
+A graded sheet is kept as a few NumPy arrays aligned with the template's
+question rows instead of per-question dicts: the fill-ratio matrix, the
+selected option (int8, -1 = none), a status code (int8) and a confidence
+per question. Scoring against an answer key is one vectorized comparison;
+the legacy {question_index: answer_index} dict is only built at the API
+boundary by SheetResult.answers_dict().
+
+classify_marks() is shared by answer rows and ID digit columns: besides
+blank / single / multiple it flags 'erased' rows (a bubble darker than
+blank but below the marking threshold, e.g. an erased or too light mark),
+and its confidence is the distance of the fill ratios from the marking
+threshold, so only low-confidence rows need a human look.
+"""
+import numpy as np
+
+# Trạng thái mỗi câu / cột ID: không tô / tô 1 ô / tô nhiều ô / tô nhạt hoặc đã tẩy
+STATUS_BLANK = 0
+STATUS_SINGLE = 1
+STATUS_MULTIPLE = 2
+STATUS_ERASED = 3
+STATUS_NAMES = ('blank', 'single', 'multiple', 'erased')
+
+NO_ANSWER = -1
+
+# Ô có tỉ lệ tô trong [ERASED_FILL_RATIO * ngưỡng, ngưỡng) coi là tô nhạt / đã tẩy
+ERASED_FILL_RATIO = 0.5
+# Độ tin cậy = khoảng cách tỉ lệ tô tới ngưỡng / (CONFIDENCE_MARGIN * ngưỡng), cắt về [0, 1]
+CONFIDENCE_MARGIN = 0.5
+# Dưới mức này (hoặc tô nhiều ô / đã tẩy) → cần giáo viên xem lại
+REVIEW_CONFIDENCE = 0.5
+
+
+def classify_marks(fill, min_fill, valid=None, pick='first'):
+    """
+    Status and margin-based confidence of each row of a fill-ratio matrix
+
+    Args:
+        fill: (rows, options) fill ratios
+        min_fill: Fill ratio from which a bubble counts as marked
+        valid: Optional (rows, options) mask of existing bubbles
+        pick: Option reported for multi-marked rows: 'first' marked or 'max' fill
+
+    Returns:
+        tuple: (selected int8, status int8, confidence float32), each (rows,)
+    """
+    fill = np.asarray(fill, dtype=np.float32)
+    if valid is not None:
+        fill = np.where(valid, fill, 0)
+    rows, options = fill.shape
+    marked = fill >= min_fill
+    count = marked.sum(axis=1)
+
+    if pick == 'max':
+        choice = np.where(marked, fill, -1).argmax(axis=1) if options else np.zeros(rows, np.int64)
+    else:
+        choice = marked.argmax(axis=1) if options else np.zeros(rows, np.int64)
+    selected = np.where(count > 0, choice, NO_ANSWER).astype(np.int8)
+
+    # Two highest fills of each row
+    top = -np.sort(-fill, axis=1) if options else np.zeros((rows, 0), np.float32)
+    top1 = top[:, 0] if options > 0 else np.zeros(rows, np.float32)
+    top2 = top[:, 1] if options > 1 else np.zeros(rows, np.float32)
+
+    status = np.minimum(count, STATUS_MULTIPLE).astype(np.int8)
+    status[(count == 0) & (top1 >= ERASED_FILL_RATIO * min_fill)] = STATUS_ERASED
+
+    # Distance to the decision: blank / erased → below threshold, single → both
+    # sides of it, multiple → how clearly the second bubble is marked
+    margin = np.where(
+        count == 0, min_fill - top1,
+        np.where(count == 1, np.minimum(top1 - min_fill, min_fill - top2), top2 - min_fill),
+    )
+    confidence = np.clip(margin / (CONFIDENCE_MARGIN * min_fill), 0, 1).astype(np.float32)
+    return selected, status, confidence
+
+
+def needs_review(status, confidence, required=False):
+    """(rows,) bool mask of rows a human should check (required: a blank row is an error too, e.g. ID digits)"""
+    review = (status == STATUS_MULTIPLE) | (status == STATUS_ERASED) | (confidence < REVIEW_CONFIDENCE)
+    if required:
+        review |= status == STATUS_BLANK
+    return review
+
+
+def mark_details(fill, status, confidence, values=None, required=False):
+    """
+    JSON-ready per-row details
+
+    Args:
+        fill, status, confidence: from classify_marks()
+        values: Optional extra per-row list, e.g. {'digits': [...]}
+        required: Every row must be marked, see needs_review()
+
+    Returns:
+        dict: {'status': List[str], 'confidence': List[float], 'fill': List[List[float]], 'review': List[bool], ...}
+    """
+    details = dict(values or {})
+    details.update({
+        'status': [STATUS_NAMES[s] for s in status.tolist()],
+        'confidence': np.round(confidence.astype(np.float64), 3).tolist(),
+        'fill': np.round(np.asarray(fill, dtype=np.float64), 3).tolist(),
+        'review': needs_review(status, confidence, required).tolist(),
+    })
+    return details
+
+
+class SheetResult:
+    """
+    Answers read from one sheet
+
+    Attributes:
+        question_index: np.ndarray (Q,) int32 0-based question number of each row
+        fill: np.ndarray (Q, options) float32 fill ratio of each bubble
+        selected: np.ndarray (Q,) int8 selected option, NO_ANSWER if blank
+            (the first marked option when several are marked)
+        status: np.ndarray (Q,) int8 STATUS_* code
+        confidence: np.ndarray (Q,) float32 margin-based confidence in [0, 1]
+    """
+
+    def __init__(self, question_index, fill, selected, status, confidence=None):
+        self.question_index = question_index
+        self.fill = fill
+        self.selected = selected
+        self.status = status
+        self.confidence = np.ones(len(question_index), np.float32) if confidence is None else confidence
+
+    @classmethod
+    def from_fill(cls, question_index, fill, min_fill, valid=None):
+        """
+        Read answers from a fill-ratio matrix
+
+        Args:
+            question_index: (Q,) question number of each row
+            fill: (Q, options) fill ratios
+            min_fill: Fill ratio from which a bubble counts as marked
+            valid: Optional (Q, options) mask of existing bubbles
+        """
+        fill = np.asarray(fill, dtype=np.float32)
+        selected, status, confidence = classify_marks(fill, min_fill, valid)
+        return cls(np.asarray(question_index, dtype=np.int32), fill, selected, status, confidence)
+
+    def __len__(self):
+        return len(self.question_index)
+
+    def key_vector(self, answer_key_dict):
+        """Answer key {question_index: answer_index} as an int8 vector aligned with the rows"""
+        return key_vector(answer_key_dict, self.question_index)
+
+    def correct(self, key):
+        """(Q,) bool mask of rows answered correctly; key from key_vector()"""
+        return (self.selected == key) & (key != NO_ANSWER)
+
+    def score(self, key):
+        """Number of correct answers; key from key_vector()"""
+        return score_answers(self.selected, key)
+
+    def answers_dict(self):
+        """Legacy {question_index: answer_index or -1} dict"""
+        return dict(zip(self.question_index.tolist(), self.selected.tolist()))
+
+    def review_mask(self):
+        """(Q,) bool mask of questions needing review (multi-mark, erased or low confidence)"""
+        return needs_review(self.status, self.confidence)
+
+    def details(self):
+        """Per-question details for the API, rows in template order"""
+        return mark_details(self.fill, self.status, self.confidence, {'questions': self.question_index.tolist()})
+
+
+def score_answers(selected, key):
+    """Number of rows where the selected option equals the keyed answer (one vectorized comparison)"""
+    return int(np.count_nonzero((selected == key) & (key != NO_ANSWER)))
+
+
+def key_vector(answer_key_dict, question_index):
+    """
+    Dense answer key for the given question rows
+
+    Args:
+        answer_key_dict: {question_index: answer_index} (None or empty = no key)
+        question_index: (Q,) question number of each row
+
+    Returns:
+        np.ndarray (Q,) int8, NO_ANSWER where the question has no key
+    """
+    question_index = np.asarray(question_index, dtype=np.int64)
+    key = np.full(len(question_index), NO_ANSWER, dtype=np.int8)
+    if not answer_key_dict:
+        return key
+    questions = np.fromiter(answer_key_dict.keys(), dtype=np.int64, count=len(answer_key_dict))
+    answers = np.fromiter(
+        (NO_ANSWER if a is None else a for a in answer_key_dict.values()), dtype=np.int64, count=len(answer_key_dict)
+    )
+    size = int(max(questions.max(initial=-1), question_index.max(initial=-1))) + 1
+    dense = np.full(size, NO_ANSWER, dtype=np.int8)
+    keep = questions >= 0
+    dense[questions[keep]] = answers[keep]
+    return dense[question_index]
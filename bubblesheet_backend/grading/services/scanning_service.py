@@ -1,35 +1,37 @@
 """
 Service for scanning and grading answer sheets
 """
+import io
 import os
-import base64
-from typing import Dict, Optional, List, Tuple
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from typing import Dict, Iterable, Iterator, Optional, List, Tuple, Union
+from django.conf import settings
 from answer_sheets.models import AnswerSheetTemplate
 from answer_keys.models import AnswerKey
+from grading.executor import get_grading_executor, GradingOverloaded
+from grading.marker_tracker import get_tracking_sessions
+from grading.annotation import (
+    annotate_mode,
+    purge_annotation_cache,
+    CROP_REGIONS,
+    DEFAULT_IMAGE_QUALITY,
+    IMAGE_FORMATS,
+    THUMBNAIL_WIDTH,
+)
 from grading.grade_pipeline import (
-    process_answer_sheet,
+    grade_image,
+    decode_image,
     detect_aruco,
     ARUCO_TYPE,
-    encode_image_base64
+    CORNER_MARKER_IDS,
+    THRESHOLD_MODE,
+    WARP_DPI,
 )
 import cv2
 import numpy as np
-
-
-def quiz_id_to_version_code(quiz_id_digits: List[int], num_exam_id: int) -> str:
-    """
-    Convert quiz ID digits to version code
-    
-    Args:
-        quiz_id_digits: List[int] like [0, 0, 1]
-        num_exam_id: int like 3 (number of digits)
-    
-    Returns:
-        str: Version code like "001"
-    """
-    version_code = ''.join(map(str, quiz_id_digits))
-    version_code = version_code.zfill(num_exam_id)
-    return version_code
+from PIL import Image
 
 
 def get_answer_key_for_version(
@@ -105,8 +107,6 @@ def grade_answers_with_key(
     else:
         total_questions = max_idx + 1 if max_idx >= 0 else 0
 
-    score = 0
-
     # Helper to normalize student answer to index
     def _to_index(value) -> Optional[int]:
         if value is None:
@@ -132,12 +132,10 @@ def grade_answers_with_key(
                     return ord(ch) - ord("A")
         return None
 
+    # Look up each keyed question's answer ("1", "2", ... for 0-based 0, 1, ...)
+    score = 0
     for q_idx_0_based, correct_idx in answer_key_dict.items():
-        # convert 0-based index to "1", "2", ...
-        q_key = str(q_idx_0_based + 1)
-        student_val = student_answers.get(q_key)
-        student_idx = _to_index(student_val)
-
+        student_idx = _to_index(student_answers.get(str(q_idx_0_based + 1)))
         if student_idx is not None and correct_idx is not None and student_idx == correct_idx:
             score += 1
 
@@ -145,20 +143,249 @@ def grade_answers_with_key(
     return score, total_questions, percentage
 
 
+def load_scan_context(quiz_id: str, answersheet_id: str, teacher_id: str) -> Tuple[AnswerSheetTemplate, AnswerKey]:
+    """
+    Load and check the template + answer key used to grade scans of a quiz
+
+    Raises:
+        AnswerSheetTemplate.DoesNotExist, AnswerKey.DoesNotExist,
+        PermissionError, ValueError
+    """
+    # 1. Load AnswerSheetTemplate
+    template = AnswerSheetTemplate.objects.get(id=answersheet_id)
+    if str(template.teacher_id) != str(teacher_id):
+        raise PermissionError('You do not have permission to access this answer sheet template')
+    
+    if not template.file_json or not os.path.exists(template.file_json):
+        raise ValueError(f'Template JSON file not found: {template.file_json}')
+    
+    # 2. Load AnswerKey
+    answer_key_obj = AnswerKey.objects.get(
+        quiz_id=quiz_id,
+        id_teacher=str(teacher_id)
+    )
+    return template, answer_key_obj
+
+
+def get_version_keys(answer_key_obj: AnswerKey) -> Dict[str, Dict[int, int]]:
+    """
+    Answer key dicts of every version of an answer key
+
+    Returns:
+        dict: {version_code: {question_index: answer_index}}
+    """
+    return {
+        v.get('version_code'): get_answer_key_for_version(answer_key_obj, v.get('version_code'))
+        for v in answer_key_obj.versions
+    }
+
+
+def annotation_cache_dir() -> str:
+    """Directory of annotated images rendered by scans (annotation_output='url')"""
+    grading_config = getattr(settings, 'GRADING_CONFIG', {})
+    return grading_config.get(
+        'ANNOTATION_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'grading', 'annotation_cache')
+    )
+
+
+def get_annotation_encoding(overrides: Optional[Dict] = None) -> Dict:
+    """
+    Output encoding of annotated images: GRADING_CONFIG defaults + per-request overrides
+
+    Args:
+        overrides: Optional {'format', 'quality', 'max_width', 'max_height', 'crop'}
+            (None values are ignored)
+
+    Returns:
+        dict: {'format', 'quality', 'max_width', 'max_height', 'crop'}
+
+    Raises:
+        ValueError: for an unknown format / crop region or a non-numeric size
+    """
+    grading_config = getattr(settings, 'GRADING_CONFIG', {})
+    encoding = {
+        'format': grading_config.get('ANNOTATION_FORMAT', 'jpeg'),
+        'quality': grading_config.get('IMAGE_QUALITY', DEFAULT_IMAGE_QUALITY),
+        'max_width': grading_config.get('ANNOTATION_MAX_WIDTH'),
+        'max_height': grading_config.get('ANNOTATION_MAX_HEIGHT'),
+        'crop': grading_config.get('ANNOTATION_CROP'),
+    }
+    encoding.update({k: v for k, v in (overrides or {}).items() if v not in (None, '')})
+
+    encoding['format'] = str(encoding['format']).lower().replace('jpg', 'jpeg')
+    if encoding['format'] not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {encoding['format']}. Expected one of {tuple(IMAGE_FORMATS)}")
+    if encoding['crop'] and encoding['crop'] not in CROP_REGIONS:
+        raise ValueError(f"Unknown crop region: {encoding['crop']}. Expected one of {tuple(CROP_REGIONS)}")
+    try:
+        encoding['quality'] = int(encoding['quality'])
+        for key in ('max_width', 'max_height'):
+            encoding[key] = int(encoding[key]) if encoding[key] else None
+    except (TypeError, ValueError):
+        raise ValueError('Annotation quality / max size must be integers')
+    return encoding
+
+
+def _grade_image_args(template: AnswerSheetTemplate, answersheet_id: str, answer_key_obj: AnswerKey,
+                      annotate: str, annotation_output: Optional[str] = None,
+                      annotation_encoding: Optional[Dict] = None, annotation_owner: Optional[str] = None) -> Dict:
+    grading_config = getattr(settings, 'GRADING_CONFIG', {})
+    annotation_output = annotation_output or grading_config.get('ANNOTATION_OUTPUT', 'inline')
+    if annotation_output not in ANNOTATION_OUTPUTS:
+        raise ValueError(f'Unknown annotation output: {annotation_output}. Expected one of {ANNOTATION_OUTPUTS}')
+
+    annotation_dir = None
+    if annotation_output == 'url' and annotate != 'none':
+        annotation_dir = annotation_cache_dir()
+        purge_annotation_cache(annotation_dir, grading_config.get('ANNOTATION_CACHE_TTL', 3600))
+
+    return {
+        'template_json_path': template.file_json,
+        'template_key': str(answersheet_id),
+        'num_exam_id': answer_key_obj.num_exam_id,
+        'version_keys': get_version_keys(answer_key_obj),
+        'annotate': annotate,
+        'threshold_mode': grading_config.get('THRESHOLD_MODE', THRESHOLD_MODE),
+        'dpi': grading_config.get('WARP_DPI', WARP_DPI),
+        'annotation_dir': annotation_dir,
+        'thumbnail_width': grading_config.get('ANNOTATION_THUMBNAIL_WIDTH', THUMBNAIL_WIDTH),
+        'annotation_encoding': get_annotation_encoding(annotation_encoding),
+        'raw_annotation': annotation_output == 'binary',
+        # Only the teacher who scanned may keep the cached image (save_grade_api)
+        'annotation_owner': str(annotation_owner) if annotation_dir and annotation_owner else None,
+    }
+
+
+def _session_key(teacher_id: str, answersheet_id: str, scan_session: str) -> Tuple[str, str, str]:
+    return str(teacher_id), str(answersheet_id), str(scan_session)
+
+
+def _keep_tracking_seed(session_key: Optional[Tuple], result: Dict) -> Dict:
+    # The seed stays server side; a failed frame keeps the previous seed
+    seed = result.pop('tracking_seed', None)
+    if session_key is not None and seed is not None:
+        get_tracking_sessions().update(session_key, seed)
+    return result
+
+
+def annotation_url(filename: str) -> str:
+    """Media URL of a file in the annotation cache"""
+    rel = os.path.relpath(annotation_cache_dir(), settings.MEDIA_ROOT).replace(os.sep, '/')
+    return f"{settings.MEDIA_URL.rstrip('/')}/{rel}/{filename}"
+
+
+def _api_result(result: Dict) -> Dict:
+    """grade_image() result in the API shape: legacy 'answers' dict + details, annotation URL"""
+    sheet_result = result.pop('sheet_result', None)
+    if sheet_result is not None:
+        result['answers'] = sheet_result.answers_dict()
+        result['answer_details'] = sheet_result.details()
+        result['review_questions'] = sheet_result.question_index[sheet_result.review_mask()].tolist()
+    filename = result.pop('annotated_image_file', None)
+    if filename:
+        result['annotated_image_url'] = annotation_url(filename)
+    return result
+
+
+class ScanTimeout(Exception):
+    """Raised when grading a sheet takes longer than IMAGE_PROCESSING_TIMEOUT"""
+
+
+# 'inline': base64 trong JSON, 'url': file trong cache annotate (MEDIA_URL),
+# 'binary': bytes ảnh gốc trong 'annotated_image_bytes' (view trả multipart/mixed)
+ANNOTATION_OUTPUTS = ('inline', 'url', 'binary')
+
+# Image file path, or the encoded image bytes of an upload
+ImageSource = Union[str, bytes, bytearray, memoryview]
+
+
+def _task_image(image: ImageSource) -> Union[str, bytes]:
+    # Grading tasks may be pickled to a worker process: memoryview is not picklable
+    return bytes(image) if isinstance(image, (bytearray, memoryview)) else image
+
+
+def _processing_timeout() -> float:
+    grading_config = getattr(settings, 'GRADING_CONFIG', {})
+    return grading_config.get('IMAGE_PROCESSING_TIMEOUT', 30)
+
+
+def _deadline() -> float:
+    """time.time() by which a sheet submitted now must be graded (IMAGE_PROCESSING_TIMEOUT)"""
+    return time.time() + _processing_timeout()
+
+
+def _wait_result(future: Future, deadline: float) -> Dict:
+    """
+    Wait for a grading task until its deadline, enforcing IMAGE_PROCESSING_TIMEOUT
+
+    A task still queued is cancelled. grade_image() gets the same deadline
+    and stops at its next stage boundary (read → grade → annotate), so a
+    task already running frees its worker and its slot shortly after the
+    timeout instead of finishing a result nobody waits for. A single stage
+    is not interrupted: the worker is held at most one stage past it.
+    """
+    try:
+        return future.result(timeout=max(0.0, deadline - time.time()))
+    except (FuturesTimeoutError, TimeoutError):
+        # TimeoutError: grade_image() itself hit the deadline (inline mode)
+        future.cancel()
+        raise ScanTimeout(f'Processing timed out after {_processing_timeout()} seconds')
+
+
+def _scan_error(e: Exception, quiz_id: str, answersheet_id: str) -> Dict:
+    if isinstance(e, GradingOverloaded):
+        return {
+            'success': False,
+            'error': str(e),
+            'overloaded': True,
+        }
+    if isinstance(e, ScanTimeout):
+        return {
+            'success': False,
+            'error': str(e),
+            'timeout': True,
+        }
+    if isinstance(e, AnswerSheetTemplate.DoesNotExist):
+        error = f'Answer sheet template with id {answersheet_id} not found'
+    elif isinstance(e, AnswerKey.DoesNotExist):
+        error = f'Answer key not found for quiz {quiz_id}'
+    elif isinstance(e, (PermissionError, ValueError)):
+        error = str(e)
+    else:
+        error = f'Processing failed: {str(e)}'
+    return {
+        'success': False,
+        'error': error,
+    }
+
+
 def scan_and_grade(
-    image_path: str,
+    image_path: ImageSource,
     quiz_id: str,
     answersheet_id: str,
-    teacher_id: str
+    teacher_id: str,
+    annotate: str = 'full',
+    annotation_output: Optional[str] = None,
+    annotation_encoding: Optional[Dict] = None,
+    scan_session: Optional[str] = None,
 ) -> Dict:
     """
     Scan and grade answer sheet
     
     Args:
-        image_path: Path to image file
+        image_path: Path to image file, or the uploaded image bytes
         quiz_id: Quiz ID (Exam.id)
         answersheet_id: AnswerSheetTemplate ID
         teacher_id: Teacher ID
+        annotate: 'none' | 'thumbnail' | 'full' annotated image
+        annotation_output: 'inline' (base64), 'url' (cached on disk) or
+            'binary' (raw bytes, not JSON serializable);
+            default GRADING_CONFIG['ANNOTATION_OUTPUT']
+        annotation_encoding: Overrides of the annotated image encoding,
+            see get_annotation_encoding()
+        scan_session: Optional client-chosen id of a burst of scans (fixed
+            camera): markers are tracked from the previous frame of the
+            session instead of detected on the whole image
     
     Returns:
         dict: {
@@ -170,146 +397,243 @@ def scan_and_grade(
             'quiz_id': str,
             'class_id': str,
             'answers': dict,
+            'answer_details': dict,  # per question (template order): 'questions', 'status'
+                                     # (blank/single/multiple/erased), 'confidence', 'fill', 'review'
+            'review_questions': List[int],  # 0-based questions needing a human check
+            'id_details': dict,  # {'student'|'quiz'|'class': per-digit 'digits', 'status', ...}
             'version_code': str,
-            'annotated_image_base64': str,
+            'thresholds': dict,  # Binarization thresholds per region
+            'annotated_image_base64': str,  # annotation_output='inline'
+            'annotated_image_url': str,  # annotation_output='url'
+            'annotated_image_bytes': bytes,  # annotation_output='binary'
+            'tracked': bool,  # scan_session given: markers found by tracking
+            'annotated_image_mime': str,  # e.g. 'image/jpeg'
             'error': str,  # Optional
+            'overloaded': bool,  # Optional, grading queue full
+            'timeout': bool,  # Optional, IMAGE_PROCESSING_TIMEOUT exceeded
         }
     """
     try:
-        # 1. Load AnswerSheetTemplate
-        template = AnswerSheetTemplate.objects.get(id=answersheet_id)
-        if str(template.teacher_id) != str(teacher_id):
-            raise PermissionError('You do not have permission to access this answer sheet template')
-        
-        if not template.file_json or not os.path.exists(template.file_json):
-            raise ValueError(f'Template JSON file not found: {template.file_json}')
-        
-        template_json_path = template.file_json
-        
-        # 2. Load AnswerKey
-        answer_key_obj = AnswerKey.objects.get(
-            quiz_id=quiz_id,
-            id_teacher=str(teacher_id)
-        )
-        
-        # 3. Process image (read IDs first, without grading)
-        result = process_answer_sheet(
-            image_path=image_path,
-            template_json_path=template_json_path,
-            answer_key_dict=None,  # Don't grade yet
-            save_warped=False,
-        )
-        
-        # 4. Convert quiz_id to version_code
-        quiz_id_digits = result['quiz_id']  # List[int]
-        if not quiz_id_digits:
-            return {
-                'success': False,
-                'error': 'Failed to read quiz ID from answer sheet',
-            }
-        
-        version_code = quiz_id_to_version_code(
-            quiz_id_digits,
-            answer_key_obj.num_exam_id
+        template, answer_key_obj = load_scan_context(quiz_id, answersheet_id, teacher_id)
+        kwargs = _grade_image_args(
+            template, answersheet_id, answer_key_obj, annotate_mode(annotate), annotation_output,
+            annotation_encoding, teacher_id,
         )
-        
-        # 5. Get answer key for version
-        answer_key_dict = get_answer_key_for_version(
-            answer_key_obj,
-            version_code
-        )
-        
-        # 6. Process image again with answer key (if found)
-        if answer_key_dict is None:
-            # Version not found → score = 0
-            # Use result from first process (already has answers)
-            student_id_str = ''.join(map(str, result['student_id'])) if result['student_id'] else ''
-            quiz_id_str = ''.join(map(str, result['quiz_id'])) if result['quiz_id'] else ''
-            class_id_str = ''.join(map(str, result['class_id'])) if result['class_id'] else None
-            
-            # Create annotated image (without grading circles, but with answers read)
-            annotated_img = result['annotated_image']
-            annotated_image_base64 = encode_image_base64(annotated_img)
-            
-            return {
-                'success': True,
-                'score': 0,
-                'total_questions': result['total_questions'],
-                'percentage': 0.0,
-                'student_id': student_id_str,
-                'quiz_id': quiz_id_str,
-                'class_id': class_id_str,
-                'answers': result.get('answers', {}),
-                'version_code': version_code,
-                'error': f'Version code {version_code} not found in answer key',
-                'annotated_image_base64': annotated_image_base64,
-            }
-        
-        # 7. Grade with answer key (process again with answer key)
-        result = process_answer_sheet(
-            image_path=image_path,
-            template_json_path=template_json_path,
-            answer_key_dict=answer_key_dict,
-            save_warped=False,
-        )
-        
-        # 8. Convert IDs to strings
-        student_id_str = ''.join(map(str, result['student_id'])) if result['student_id'] else ''
-        quiz_id_str = ''.join(map(str, result['quiz_id'])) if result['quiz_id'] else ''
-        class_id_str = ''.join(map(str, result['class_id'])) if result['class_id'] else None
-        
-        # 9. Encode annotated image to base64
-        annotated_image_base64 = None
-        if 'annotated_image' in result:
-            annotated_image_base64 = encode_image_base64(result['annotated_image'])
-        
-        # 10. Return result
-        return {
-            'success': True,
-            'score': result['score'],
-            'total_questions': result['total_questions'],
-            'percentage': result['percentage'],
-            'student_id': student_id_str,
-            'quiz_id': quiz_id_str,
-            'class_id': class_id_str,
-            'answers': result.get('answers', {}),
-            'version_code': version_code,
-            'annotated_image_base64': annotated_image_base64,
-        }
-        
-    except AnswerSheetTemplate.DoesNotExist:
-        return {
-            'success': False,
-            'error': f'Answer sheet template with id {answersheet_id} not found',
-        }
-    except AnswerKey.DoesNotExist:
-        return {
-            'success': False,
-            'error': f'Answer key not found for quiz {quiz_id}',
-        }
-    except PermissionError as e:
-        return {
-            'success': False,
-            'error': str(e),
-        }
-    except ValueError as e:
-        return {
-            'success': False,
-            'error': str(e),
+        session_key = None
+        if scan_session:
+            session_key = _session_key(teacher_id, answersheet_id, scan_session)
+            kwargs.update(track=True, tracking_seed=get_tracking_sessions().get(session_key))
+        deadline = _deadline()
+        future = get_grading_executor().submit(grade_image, _task_image(image_path), deadline=deadline, **kwargs)
+        result = _wait_result(future, deadline)
+        return _api_result(_keep_tracking_seed(session_key, result))
+    except Exception as e:
+        return _scan_error(e, quiz_id, answersheet_id)
+
+
+def iter_scan_and_grade_batch(
+    image_paths: Iterable[Tuple[str, ImageSource]],
+    quiz_id: str,
+    answersheet_id: str,
+    teacher_id: str,
+    annotate: str = 'none',
+    annotation_output: Optional[str] = None,
+    annotation_encoding: Optional[Dict] = None,
+    scan_session: Optional[str] = None,
+) -> Dict:
+    """
+    Start grading a batch and yield per-sheet results as they complete
+
+    The template and answer key are resolved once for the whole batch and
+    the sheets are graded in parallel on the grading executor. Sheets are
+    only submitted while the returned iterator is consumed, so a caller can
+    stream each result out before the rest of the batch is done.
+
+    Args:
+        See scan_and_grade_batch()
+
+    Returns:
+        dict: {
+            'success': bool,
+            'results': Iterator[dict],  # scan_and_grade() result + 'index', 'filename', in input order
+            'error': str,  # Optional, if the batch could not start
         }
+    """
+    try:
+        template, answer_key_obj = load_scan_context(quiz_id, answersheet_id, teacher_id)
+        kwargs = _grade_image_args(
+            template, answersheet_id, answer_key_obj, annotate_mode(annotate, 'none'), annotation_output,
+            annotation_encoding, teacher_id,
+        )
     except Exception as e:
-        return {
-            'success': False,
-            'error': f'Processing failed: {str(e)}',
+        return _scan_error(e, quiz_id, answersheet_id)
+
+    executor = get_grading_executor()
+    timeout = _processing_timeout()
+    sessions = get_tracking_sessions()
+    session_key = _session_key(teacher_id, answersheet_id, scan_session) if scan_session else None
+    if session_key is not None:
+        kwargs['track'] = True
+
+    def collect(index, filename, future, deadline):
+        try:
+            result = _api_result(_keep_tracking_seed(session_key, _wait_result(future, deadline)))
+        except Exception as e:
+            result = _scan_error(e, quiz_id, answersheet_id)
+        result['index'] = index
+        result['filename'] = filename
+        return result
+
+    def results() -> Iterator[Dict]:
+        # Keep at most `workers` sheets of this batch in the executor so the
+        # queue slots stay available to single scans
+        pending = deque()
+        for index, (filename, image_path) in enumerate(image_paths):
+            if len(pending) >= executor.workers:
+                yield collect(*pending.popleft())
+            if session_key is not None:
+                # Seed from the latest graded frame of the session
+                kwargs['tracking_seed'] = sessions.get(session_key)
+            deadline = _deadline()
+            try:
+                future = executor.submit(
+                    grade_image, _task_image(image_path), timeout=timeout, deadline=deadline, **kwargs
+                )
+            except Exception as e:
+                future = Future()
+                future.set_exception(e)
+            pending.append((index, filename, future, deadline))
+        while pending:
+            yield collect(*pending.popleft())
+
+    return {'success': True, 'results': results()}
+
+
+def scan_and_grade_batch(
+    image_paths: Iterable[Tuple[str, ImageSource]],
+    quiz_id: str,
+    answersheet_id: str,
+    teacher_id: str,
+    annotate: str = 'none',
+    annotation_output: Optional[str] = None,
+    annotation_encoding: Optional[Dict] = None,
+    scan_session: Optional[str] = None,
+) -> Dict:
+    """
+    Scan and grade many sheets of the same quiz / answer sheet template
+
+    Args:
+        image_paths: (filename, image path or image bytes) pairs; may be a
+            generator, images are only read as sheets are submitted
+        quiz_id: Quiz ID (Exam.id)
+        answersheet_id: AnswerSheetTemplate ID
+        teacher_id: Teacher ID
+        annotate: 'none' | 'thumbnail' | 'full' annotated images (costly for large batches)
+        annotation_output: 'inline', 'url' or 'binary', see scan_and_grade()
+        annotation_encoding: Annotated image encoding overrides, see scan_and_grade()
+        scan_session: Track markers from sheet to sheet, see scan_and_grade()
+
+    Returns:
+        dict: {
+            'success': bool,
+            'count': int,
+            'graded': int,
+            'failed': int,
+            'results': List[dict],  # scan_and_grade() result + 'index', 'filename'
+            'error': str,  # Optional, if the batch could not start
         }
+    """
+    batch = iter_scan_and_grade_batch(
+        image_paths, quiz_id, answersheet_id, teacher_id, annotate, annotation_output, annotation_encoding,
+        scan_session,
+    )
+    if not batch['success']:
+        return batch
+
+    results = list(batch['results'])
+    graded = sum(1 for r in results if r.get('success'))
+    return {
+        'success': True,
+        'count': len(results),
+        'graded': graded,
+        'failed': len(results) - graded,
+        'results': results,
+    }
 
 
-def preview_check(image_path: str) -> Dict:
+# Preview: giải mã ảnh thu nhỏ sao cho cạnh ngắn vẫn >= PREVIEW_MIN_SIDE pixel
+PREVIEW_REDUCED_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+PREVIEW_MIN_SIDE = 480
+# Phương sai Laplacian (trên ảnh preview) coi là đủ nét
+PREVIEW_SHARP_VARIANCE = 2000.0
+
+
+def _image_size(image: ImageSource) -> Optional[Tuple[int, int]]:
+    """(width, height) from the image header, without decoding the pixels"""
+    try:
+        with Image.open(image if isinstance(image, str) else io.BytesIO(image)) as im:
+            return im.size
+    except Exception:
+        return None
+
+
+def _preview_quality(gray: np.ndarray, markers: List[Dict]) -> Dict:
+    """
+    Per-frame quality of a preview image
+
+    Args:
+        gray: Grayscale preview image
+        markers: Markers detected on gray
+
+    Returns:
+        dict: {
+            'score': float,  # 0..1, higher is better
+            'marker_count': int,
+            'corner_markers': int,  # Corner markers found (of 4)
+            'skew': float or None,  # 0 = rectangle, 1 = badly skewed (None without 4 corners)
+            'sharpness': float,  # 0..1 from the variance of the Laplacian
+        }
+    """
+    positions = {m['id']: m['position'] for m in markers}
+    corners = [positions[i] for i in CORNER_MARKER_IDS if i in positions]
+
+    skew = None
+    if len(corners) == 4:
+        # Largest deviation of the sheet corner angles from 90°
+        quad = np.array(corners, dtype=np.float64)
+        v1 = np.roll(quad, -1, axis=0) - quad
+        v2 = np.roll(quad, 1, axis=0) - quad
+        cos = np.abs((v1 * v2).sum(axis=1)) / np.maximum(
+            np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1), 1e-9
+        )
+        skew = float(min(1.0, cos.max()))
+
+    variance = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    sharpness = min(1.0, variance / PREVIEW_SHARP_VARIANCE)
+
+    score = 0.5 * len(corners) / len(CORNER_MARKER_IDS) + 0.3 * sharpness
+    if skew is not None:
+        score += 0.2 * (1.0 - skew)
+    return {
+        'score': round(score, 3),
+        'marker_count': len(markers),
+        'corner_markers': len(corners),
+        'skew': round(skew, 3) if skew is not None else None,
+        'sharpness': round(sharpness, 3),
+    }
+
+
+def preview_check(image_path: ImageSource) -> Dict:
     """
     Preview check for ArUco markers
     
     Args:
-        image_path: Path to image file
+        image_path: Path to image file, or the uploaded image bytes
     
     Returns:
         dict: {
@@ -317,13 +641,29 @@ def preview_check(image_path: str) -> Dict:
             'markers': List[Dict],
             'markers_norm': List[Dict],
             'image_size': Dict,
+            'quality': Dict,  # see _preview_quality()
             'error': str,  # Optional
         }
     """
     try:
-        # Load image
-        img = cv2.imread(image_path)
-        if img is None:
+        # Load image at reduced resolution (markers only need a small frame)
+        size = _image_size(image_path)
+        if size is None:
+            # Header not readable: try the usual camera-frame reduction first
+            reduction = 4
+            gray = decode_image(image_path, PREVIEW_REDUCED_FLAGS[reduction])
+            if gray is not None:
+                size = (gray.shape[1] * reduction, gray.shape[0] * reduction)
+        else:
+            reduction, gray = None, None
+        if size is not None:
+            fit = next(
+                (f for f in sorted(PREVIEW_REDUCED_FLAGS, reverse=True) if min(size) // f >= PREVIEW_MIN_SIDE),
+                1
+            )
+            if fit != reduction:
+                gray = decode_image(image_path, PREVIEW_REDUCED_FLAGS[fit])
+        if gray is None:
             return {
                 'ready': False,
                 'error': 'Invalid image data',
@@ -332,20 +672,26 @@ def preview_check(image_path: str) -> Dict:
                 'image_size': {'width': 0, 'height': 0},
             }
         
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        
         # Detect ArUco markers
-        markers = detect_aruco(gray, ARUCO_TYPE)
+        small_markers = detect_aruco(gray, ARUCO_TYPE, preset='preview')
         
-        # Normalize marker positions
-        h, w = gray.shape[:2]
+        # Normalize marker positions, scale them back to full resolution
+        sh, sw = gray.shape[:2]
+        w, h = size if size is not None else (sw, sh)
+        if (w > h) != (sw > sh):
+            # imread applied the EXIF orientation, the header size did not
+            w, h = h, w
         markers_norm = [
             {
                 'id': m['id'],
-                'x': float(m['position'][0]) / float(w if w else 1),
-                'y': float(m['position'][1]) / float(h if h else 1),
+                'x': float(m['position'][0]) / float(sw if sw else 1),
+                'y': float(m['position'][1]) / float(sh if sh else 1),
             }
-            for m in markers
+            for m in small_markers
+        ]
+        markers = [
+            {'id': m['id'], 'position': [int(round(m['x'] * w)), int(round(m['y'] * h))]}
+            for m in markers_norm
         ]
         
         # Check if ready (chỉ cần có ít nhất 1 marker để xác định có phải phiếu không)
@@ -357,6 +703,7 @@ def preview_check(image_path: str) -> Dict:
             'markers': markers,
             'markers_norm': markers_norm,
             'image_size': {'width': w, 'height': h},
+            'quality': _preview_quality(gray, small_markers),
         }
         
     except Exception as e:
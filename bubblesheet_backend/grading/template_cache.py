@@ -0,0 +1,197 @@
+"""
+Process-wide cache of compiled answer sheet templates.
+
+A template JSON (AnswerSheetTemplate.file_json) is parsed once and turned
+into NumPy arrays + BubbleSamplers. Entries are keyed by answersheet_id (or
+the JSON path when no id is given), validated against the file's mtime/size
+on every lookup and evicted in LRU order.
+"""
+import os
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .bubble_sampler import BubbleSampler
+
+DEFAULT_TEMPLATE_CACHE_SIZE = 32
+
+# Template JSON coordinates are generated at 300 DPI on an A4 page
+TEMPLATE_DPI = 300
+TEMPLATE_SIZE = (2481, 3508)
+
+ID_SECTIONS = {
+    'student': 'student_id_section',
+    'quiz': 'quiz_id_section',
+    'class': 'class_id_section',
+}
+
+
+class IdSectionLayout:
+    """
+    Compiled ID section: one sampler group per digit column
+
+    Attributes:
+        sampler: BubbleSampler over the columns
+        values: np.ndarray (columns x rows) digit value of each bubble
+        section: Raw section dict from the template JSON
+    """
+
+    def __init__(self, section, scale=1.0):
+        self.section = section
+        columns = [col['bubbles'] for col in section['columns']]
+        self.sampler = BubbleSampler(columns, scale)
+        self.values = np.full(self.sampler.shape, -1, dtype=np.int16)
+        for c, bubbles in enumerate(columns):
+            for r, b in enumerate(bubbles):
+                self.values[c, r] = b['value']
+
+    @property
+    def num_digits(self):
+        return self.sampler.shape[0]
+
+
+class CompiledTemplate:
+    """
+    Template JSON compiled to arrays
+
+    All coordinates are in warped-image space, i.e. template coordinates
+    multiplied by scale (1.0 = 300 DPI).
+
+    Attributes:
+        data: Raw template JSON (read-only, shared between requests)
+        scale: Warp scale relative to TEMPLATE_DPI
+        page_size: (width, height) of the warped image
+        marker_ids: np.ndarray (M,) ArUco marker ids
+        marker_positions: np.ndarray (M, 2) marker centers in warped-image space
+        marker_sizes: np.ndarray (M,) marker side lengths in warped-image space
+        question_index: np.ndarray (Q,) 0-based question index of each row
+        answer_sampler: BubbleSampler over the answer area (Q x options)
+        id_sections: {'student'|'quiz'|'class': IdSectionLayout}
+    """
+
+    def __init__(self, data, scale=1.0):
+        self.data = data
+        self.scale = scale
+        self.page_size = (int(round(TEMPLATE_SIZE[0] * scale)), int(round(TEMPLATE_SIZE[1] * scale)))
+
+        markers = data['aruco_marker']
+        self.marker_ids = np.array([m['id'] for m in markers], dtype=np.int32)
+        self.marker_positions = np.array([m['position'] for m in markers], dtype=np.float32).reshape(-1, 2) * scale
+        self.marker_sizes = np.array([m.get('size', 50) for m in markers], dtype=np.float32) * scale
+
+        questions = data['answer_area']['questions']
+        self.question_index = np.array([q['question'] - 1 for q in questions], dtype=np.int32)
+        self.answer_sampler = BubbleSampler([q['bubbles'] for q in questions], scale)
+
+        self.id_sections = {label: IdSectionLayout(data[key], scale) for label, key in ID_SECTIONS.items()}
+
+        self._scaled = {scale: self}
+        self._scaled_lock = threading.Lock()
+
+    def at_scale(self, scale):
+        """Same template compiled for another warp scale (memoized)"""
+        scaled = self._scaled.get(scale)
+        if scaled is None:
+            with self._scaled_lock:
+                scaled = self._scaled.get(scale)
+                if scaled is None:
+                    scaled = CompiledTemplate(self.data, scale)
+                    self._scaled[scale] = scaled
+        return scaled
+
+    @property
+    def markers(self):
+        """Markers as [{'id', 'position'}] in warped-image space"""
+        return [
+            {'id': int(i), 'position': [float(x), float(y)]}
+            for i, (x, y) in zip(self.marker_ids, self.marker_positions)
+        ]
+
+    @property
+    def questions(self):
+        return self.data['answer_area']['questions']
+
+    @property
+    def total_questions(self):
+        return len(self.question_index)
+
+    @property
+    def answer_centers(self):
+        return self.answer_sampler.centers
+
+    @property
+    def answer_radii(self):
+        return self.answer_sampler.radii
+
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_max_size = DEFAULT_TEMPLATE_CACHE_SIZE
+
+
+def set_template_cache_size(size):
+    """
+    Set how many compiled templates the cache keeps (GRADING_CONFIG['TEMPLATE_CACHE_SIZE'])
+
+    Called from GradingConfig.ready() in the server process and from the
+    grading worker initializer, so worker processes never import the project
+    settings (which would open the database connection).
+    """
+    global _max_size
+    with _lock:
+        _max_size = max(1, int(size))
+        while len(_cache) > _max_size:
+            _cache.popitem(last=False)
+
+
+def template_cache_size():
+    return _max_size
+
+
+def get_compiled_template(json_path, key=None, scale=1.0):
+    """
+    Get the compiled template for a JSON file, compiling it on a cache miss
+
+    Args:
+        json_path: Path to template JSON
+        key: Cache key (answersheet_id); defaults to json_path
+        scale: Warp scale relative to TEMPLATE_DPI
+
+    Returns:
+        CompiledTemplate
+    """
+    key = str(key) if key is not None else json_path
+    st = os.stat(json_path)
+    stamp = (json_path, st.st_mtime_ns, st.st_size)
+
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[0] == stamp:
+            _cache.move_to_end(key)
+        else:
+            entry = None
+    if entry is not None:
+        return entry[1].at_scale(scale)
+
+    with open(json_path, 'r', encoding='utf-8') as f:
+        compiled = CompiledTemplate(json.load(f))
+
+    with _lock:
+        _cache[key] = (stamp, compiled)
+        _cache.move_to_end(key)
+        while len(_cache) > _max_size:
+            _cache.popitem(last=False)
+    return compiled.at_scale(scale)
+
+
+def invalidate_template(key):
+    """Drop a template from the cache (e.g. after it was regenerated or deleted)"""
+    with _lock:
+        _cache.pop(str(key), None)
+
+
+def clear_template_cache():
+    with _lock:
+        _cache.clear()
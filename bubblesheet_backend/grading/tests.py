@@ -1,3 +1,1396 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from email.parser import BytesParser
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from grading.services.scanning_service import (
+    PREVIEW_MIN_SIDE, ScanTimeout, _preview_quality, _scan_error, _wait_result, grade_answers_with_key,
+    iter_scan_and_grade_batch, preview_check, scan_and_grade,
+)
+
+from .aggregation import item_counts_pipeline, stats_from_aggregation
+from .annotation import THUMBNAIL_WIDTH, encode_image, is_annotation_owner, save_annotation
+from .analysis import GradeMatrix, KeyMatrix, item_analysis_report, test_statistics
+from .bubble_sampler import BubbleSampler, disk_offsets
+from .executor import GradingExecutor, GradingOverloaded, _init_worker
+from .grade_pipeline import (
+    ARUCO_TYPE, BUBBLE_AREA_PIXELS, CORNER_MARKER_IDS, MIN_ANSWER_FILL, MIN_ANSWER_PIXELS, MIN_ID_FILL, MIN_ID_PIXELS,
+    decode_image, detect_aruco, grade_image, grade_sheet, read_sheet,
+)
+from .homography import HOMOGRAPHY_MAX_ERROR, RANSAC_REPROJ_THRESHOLD, solve_homography
+from .jobs import ScanJobQueue
+from .marker_tracker import TRACK_MAX_ERROR, TrackingSessions, seed_from_homography, track_markers
+from .management.commands.build_grade_indexes import index_key, index_plan
+from .management.commands.explain_grade_queries import plan_stages, summarize_explain
+from .models import Grade
+from .multipart import closing, content_type, new_boundary, result_parts
+from .quiz_stats import _nest, grade_increments, grade_snapshot, quiz_stats_report
+from .results import (
+    NO_ANSWER, STATUS_BLANK, STATUS_ERASED, STATUS_MULTIPLE, STATUS_SINGLE,
+    SheetResult, classify_marks, key_vector, mark_details, needs_review, score_answers,
+)
+from .template_cache import (
+    clear_template_cache, get_compiled_template, invalidate_template, set_template_cache_size, template_cache_size,
+)
+from .views import _scan_error_status, scan_answer_sheet_batch
+
+TEMPLATE_JSON = os.path.join(settings.BASE_DIR, 'media', 'answer_sheets', '684d41c296421fe6d3d11d9d.json')
+MARKER_PNG = os.path.join(settings.BASE_DIR, 'answer_sheets', 'aruco_markers', 'aruco_{}.png')
+
+SHEET_IDS = {'student_id_section': '12345678', 'quiz_id_section': '00123', 'class_id_section': '00042'}
+# Câu được tô 2 ô (ô đầu và ô cuối)
+MULTI_MARKED_QUESTIONS = (7, 42)
+
+
+def load_template():
+    with open(TEMPLATE_JSON, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def sheet_answers(template):
+    """{question_index: option} filled on the synthetic sheet (-1 = blank)"""
+    questions = template['answer_area']['questions']
+    return {q['question'] - 1: (q['question'] * 7) % (len(q['bubbles']) + 1) - 1 for q in questions}
+
+
+def render_sheet(template, answers, ids=SHEET_IDS, multi_marked=MULTI_MARKED_QUESTIONS):
+    """
+    PNG bytes of a filled-in sheet drawn from a template, photographed at a slight angle
+
+    Args:
+        template: Template JSON
+        answers: {question_index: option index or -1}
+        ids: {section: digit string}
+        multi_marked: Questions where the first and last option are both filled
+    """
+    img = np.full((3508, 2481, 3), 255, np.uint8)
+    for m in template['aruco_marker']:
+        size = m['size']
+        x, y = m['position'][0] - size // 2, m['position'][1] - size // 2
+        marker = cv2.imread(MARKER_PNG.format(m['id']))
+        img[y:y + size, x:x + size] = cv2.resize(marker, (size, size), interpolation=cv2.INTER_NEAREST)
+
+    def bubble(b, filled):
+        cv2.circle(img, tuple(b['position']), b['radius'], (0, 0, 0), 2)
+        if filled:
+            cv2.circle(img, tuple(b['position']), b['radius'] - 3, (30, 30, 30), -1)
+
+    for q in template['answer_area']['questions']:
+        chosen = {answers[q['question'] - 1]}
+        if q['question'] - 1 in multi_marked:
+            chosen = {0, len(q['bubbles']) - 1}
+        for o, b in enumerate(q['bubbles']):
+            bubble(b, o in chosen)
+    for section, digits in ids.items():
+        for col, digit in zip(template[section]['columns'], digits):
+            for b in col['bubbles']:
+                bubble(b, b['value'] == int(digit))
+
+    h, w = img.shape[:2]
+    corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    M = cv2.getPerspectiveTransform(corners, np.float32([[90, 60], [w - 40, 110], [w - 20, h - 30], [50, h - 90]]))
+    img = cv2.warpPerspective(img, M, (w, h), borderValue=(200, 200, 200))
+    return cv2.imencode('.png', img)[1].tobytes()
+
+
+def legacy_counts(gray, bubbles):
+    """Filled pixel counts of one question row / ID column, measured as the baseline pipeline did"""
+    xs = [b['position'][0] for b in bubbles]
+    ys = [b['position'][1] for b in bubbles]
+    r_max = max(b['radius'] for b in bubbles)
+    x1, x2 = max(int(min(xs) - r_max), 0), min(int(max(xs) + r_max), gray.shape[1])
+    y1, y2 = max(int(min(ys) - r_max), 0), min(int(max(ys) + r_max), gray.shape[0])
+    _, thresh = cv2.threshold(gray[y1:y2, x1:x2], 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    counts = []
+    for b in bubbles:
+        mask = np.zeros_like(thresh)
+        cv2.circle(mask, (int(b['position'][0] - x1), int(b['position'][1] - y1)), int(b['radius']), 255, -1)
+        counts.append(cv2.countNonZero(cv2.bitwise_and(thresh, thresh, mask=mask)))
+    return counts
+
+
+NUM_QUESTIONS = 6
+KEY_VERSIONS = [
+    {'version_code': '001', 'questions': [{'order': q, 'answer': a} for q, a in zip(range(1, 7), 'ABCDEA')]},
+    {'version_code': '002', 'questions': [{'order': q, 'answer': a} for q, a in zip(range(1, 7), 'BCDA') if a]},
+    {'version_code': '001', 'questions': [{'order': 1, 'answer': 'E'}]},  # duplicate version: the first one wins
+]
+
+
+def grade_documents(count, seed=0):
+    """
+    Grade documents with every stored answer format
+
+    Answers are option indices, [index] lists, numeric strings, letters or
+    blank (missing, None, '' or -1); a few papers have a version code that
+    is not in KEY_VERSIONS or none at all.
+    """
+    rng = np.random.default_rng(seed)
+    formats = (
+        lambda o: o, lambda o: [o], lambda o: str(o), lambda o: 'ABCDE'[o], lambda o: 'abcde'[o],
+        lambda o: None, lambda o: '', lambda o: -1,
+    )
+    documents = []
+    for i in range(count):
+        answers = {}
+        for q in range(1, NUM_QUESTIONS + 1):
+            if rng.random() < 0.1:
+                continue
+            answers[str(q)] = formats[rng.integers(len(formats))](int(rng.integers(5)))
+        documents.append({
+            'answers': answers,
+            'version_code': ('001', '002', '003', None)[rng.choice(4, p=[0.5, 0.35, 0.1, 0.05])],
+            'score': None if i % 17 == 5 else round(float(rng.integers(0, 1001)) / 100, 2),
+            'percentage': None if i % 13 == 4 else round(float(rng.random() * 100), 2),
+        })
+    return documents
+
+
+def legacy_item_counts(documents, versions, num_questions):
+    """[(correct, incorrect, blank)] per question, counted as the baseline item analysis did"""
+    def key_answer(version_code, question):
+        version = next((v for v in versions if v.get('version_code') == version_code), None)
+        for q in (version or {}).get('questions', []):
+            if str(q.get('order', '')) == question or str(q.get('question_code', '')) == question:
+                return q.get('answer', '')
+        return None
+
+    counts = []
+    for q in range(1, num_questions + 1):
+        correct = incorrect = blank = 0
+        for doc in documents:
+            answer = (doc.get('answers') or {}).get(str(q))
+            if answer is None or answer == '' or answer == -1:
+                blank += 1
+                continue
+            expected = key_answer(doc.get('version_code') or '', str(q))
+            if isinstance(answer, list):
+                answer = answer[0] if answer else None
+            elif isinstance(answer, str):
+                answer = int(answer) if answer.isdigit() else ord(answer.upper()[0]) - ord('A')
+            if expected and answer == ord(expected.upper()[0]) - ord('A'):
+                correct += 1
+            else:
+                incorrect += 1
+        counts.append((correct, incorrect, blank))
+    return counts
+
+
+def materialize(added, removed=()):
+    """QuizStats document left by the $inc updates of saving `added` and deleting `removed` grades"""
+    totals = defaultdict(int)
+    for documents, sign in ((added, 1), (removed, -1)):
+        for doc in documents:
+            for path, value in grade_increments(grade_snapshot(doc), sign).items():
+                totals[path] += value
+    return _nest(totals)
+
+
+def aggregation_result(documents):
+    """What item_counts_pipeline() returns for these grades (its $facet groups, computed in Python)"""
+    answers, values, versions, scores = Counter(), {}, Counter(), Counter()
+    percentages = []
+    for doc in documents:
+        version = doc.get('version_code') or ''
+        versions[version] += 1
+        for question, value in (doc.get('answers') or {}).items():
+            group = (version, question, repr(value))
+            answers[group] += 1
+            values[group] = value
+        if doc.get('score') is not None:
+            scores[doc['score']] += 1
+        if doc.get('percentage') is not None:
+            percentages.append(doc['percentage'])
+    return {
+        'answers': [{'_id': {'v': v, 'q': q, 'a': values[(v, q, a)]}, 'count': c} for (v, q, a), c in answers.items()],
+        'versions': [{'_id': v, 'count': c} for v, c in versions.items()],
+        'scores': [{'_id': score, 'count': c} for score, c in scores.items()],
+        'percentages': [{'_id': None, 'count': len(percentages), 'sum': sum(percentages)}] if percentages else [],
+    }
+
+
+def wait_for(job, timeout=5):
+    """Status dict of a scan job once it has finished"""
+    end = time.time() + timeout
+    while not job.finished and time.time() < end:
+        time.sleep(0.01)
+    return job.to_dict()
+
+
+class SheetTestCase(SimpleTestCase):
+    """Shares one rendered synthetic sheet between the tests of a class"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.template = load_template()
+        cls.answers = sheet_answers(cls.template)
+        cls.image = render_sheet(cls.template, cls.answers)
+
+    def expected_answers(self):
+        return {q: 0 if q in MULTI_MARKED_QUESTIONS else a for q, a in self.answers.items()}
+
+    def assertReadsSheet(self, sheet):
+        self.assertEqual(sheet.sheet_result.answers_dict(), self.expected_answers())
+        self.assertEqual(sheet.student_id, [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(sheet.quiz_id, [0, 0, 1, 2, 3])
+        self.assertEqual(sheet.class_id, [0, 0, 0, 4, 2])
+
+
+class BubbleSamplerTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.binary = np.where(rng.random((400, 600)) < 0.4, 255, 0).astype(np.uint8)
+        self.groups = [
+            [{'position': [60 + 70 * o, 50 + 90 * g], 'radius': 27 if g % 2 else 20} for o in range(5)]
+            for g in range(4)
+        ]
+        self.groups[3] = self.groups[3][:3]
+
+    def test_disk_matches_filled_circle(self):
+        for r in (1, 5, 20, 27, 40):
+            mask = np.zeros((2 * r + 1, 2 * r + 1), np.uint8)
+            cv2.circle(mask, (r, r), r, 255, -1)
+            dy, dx = disk_offsets(r)
+            self.assertEqual(len(dy), cv2.countNonZero(mask))
+            self.assertTrue((mask[dy + r, dx + r] == 255).all())
+
+    def test_counts_match_per_bubble_masks(self):
+        sampler = BubbleSampler(self.groups)
+        roi = sampler.crop(self.binary)
+        counts = sampler.count(roi)
+        ox, oy = sampler.origin
+        for g, bubbles in enumerate(self.groups):
+            for o, b in enumerate(bubbles):
+                mask = np.zeros_like(roi)
+                cv2.circle(mask, (b['position'][0] - ox, b['position'][1] - oy), b['radius'], 255, -1)
+                self.assertEqual(counts[g, o], cv2.countNonZero(cv2.bitwise_and(roi, mask)))
+        self.assertEqual(counts[3, 3:].tolist(), [0, 0])
+        self.assertFalse(sampler.valid[3, 3:].any())
+
+    def test_group_threshold_matches_legacy_rows(self):
+        rng = np.random.default_rng(3)
+        gray = rng.integers(0, 256, (400, 600), dtype=np.uint8)
+        sampler = BubbleSampler(self.groups)
+        counts, fill, _ = sampler.measure(gray)
+        for g, bubbles in enumerate(self.groups):
+            self.assertEqual(counts[g, :len(bubbles)].tolist(), legacy_counts(gray, bubbles))
+        np.testing.assert_allclose(fill, counts / np.maximum(sampler.area, 1), rtol=1e-6)
+
+    def test_empty_template(self):
+        sampler = BubbleSampler([])
+        self.assertEqual(sampler.shape, (0, 0))
+        self.assertEqual(sampler.count(np.zeros((0, 0), np.uint8)).shape, (0, 0))
+
+
+class BaselinePipelineTests(SheetTestCase):
+
+    def test_counts_match_baseline(self):
+        sheet = read_sheet(self.image, TEMPLATE_JSON)
+        questions = self.template['answer_area']['questions']
+        baseline = [legacy_counts(sheet.gray, q['bubbles']) for q in questions]
+        self.assertEqual(sheet.answer_counts.tolist(), baseline)
+
+    def test_answers_match_baseline(self):
+        sheet = read_sheet(self.image, TEMPLATE_JSON)
+        baseline = {}
+        for q in self.template['answer_area']['questions']:
+            marked = [o for o, cnt in enumerate(legacy_counts(sheet.gray, q['bubbles'])) if cnt >= MIN_ANSWER_PIXELS]
+            baseline[q['question'] - 1] = marked[0] if marked else -1
+        self.assertEqual(sheet.sheet_result.answers_dict(), baseline)
+        self.assertReadsSheet(sheet)
+
+    def test_ids_match_baseline(self):
+        sheet = read_sheet(self.image, TEMPLATE_JSON)
+        for label, digits in (('student', sheet.student_id), ('quiz', sheet.quiz_id), ('class', sheet.class_id)):
+            baseline = []
+            for col in self.template[f'{label}_id_section']['columns']:
+                counts = legacy_counts(sheet.gray, col['bubbles'])
+                best = max(range(len(counts)), key=lambda i: counts[i])
+                self.assertGreaterEqual(counts[best], MIN_ID_PIXELS[label])
+                baseline.append(col['bubbles'][best]['value'])
+            self.assertEqual(digits, baseline)
+
+    def test_reduced_modes_read_the_same_sheet(self):
+        full = read_sheet(self.image, TEMPLATE_JSON)
+        for mode in ({'roi_only': True}, {'grayscale': True}, {'roi_only': True, 'grayscale': True}):
+            with self.subTest(**mode):
+                sheet = read_sheet(self.image, TEMPLATE_JSON, **mode)
+                self.assertIsNone(sheet.warped)
+                self.assertReadsSheet(sheet)
+                self.assertEqual(sheet.sheet_result.answers_dict(), full.sheet_result.answers_dict())
+                np.testing.assert_allclose(sheet.answer_fill, full.answer_fill, atol=0.01)
+
+    def test_score(self):
+        key = {q: 0 if a < 0 else a for q, a in self.answers.items()}
+        result = grade_sheet(read_sheet(self.image, TEMPLATE_JSON), key)
+        expected = sum(a == key[q] for q, a in self.expected_answers().items())
+        self.assertEqual(result['score'], expected)
+        self.assertEqual(result['total_questions'], len(self.answers))
+
+
+class TemplateCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        clear_template_cache()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(clear_template_cache)
+        self.path = os.path.join(self.tmp, 'sheet.json')
+        shutil.copy(TEMPLATE_JSON, self.path)
+
+    def test_hit_returns_compiled_template(self):
+        compiled = get_compiled_template(self.path, key='sheet')
+        self.assertIs(get_compiled_template(self.path, key='sheet'), compiled)
+        self.assertEqual(compiled.total_questions, len(load_template()['answer_area']['questions']))
+
+    def test_changed_file_is_recompiled(self):
+        compiled = get_compiled_template(self.path, key='sheet')
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(get_compiled_template(self.path, key='sheet'), compiled)
+
+    def test_invalidate(self):
+        compiled = get_compiled_template(self.path, key='sheet')
+        invalidate_template('sheet')
+        self.assertIsNot(get_compiled_template(self.path, key='sheet'), compiled)
+
+    def test_scaled_templates_are_memoized(self):
+        half = get_compiled_template(self.path, key='sheet', scale=0.5)
+        self.assertIs(get_compiled_template(self.path, key='sheet', scale=0.5), half)
+        full = get_compiled_template(self.path, key='sheet')
+        self.assertEqual(half.page_size, (1240, 1754))
+        np.testing.assert_array_equal(half.answer_radii, np.round(full.answer_radii * 0.5))
+
+    def test_least_recently_used_is_evicted(self):
+        self.addCleanup(set_template_cache_size, template_cache_size())
+        set_template_cache_size(1)
+        first = get_compiled_template(self.path, key='first')
+        get_compiled_template(self.path, key='second')
+        self.assertIsNot(get_compiled_template(self.path, key='first'), first)
+
+
+class ThresholdModeTests(SheetTestCase):
+
+    def test_modes_read_the_same_sheet(self):
+        for mode in ('group', 'region', 'tiled'):
+            with self.subTest(mode=mode):
+                sheet = read_sheet(self.image, TEMPLATE_JSON, threshold_mode=mode)
+                self.assertReadsSheet(sheet)
+                self.assertEqual(sheet.thresholds['mode'], mode)
+
+    def test_threshold_layout(self):
+        sampler = get_compiled_template(TEMPLATE_JSON).answer_sampler
+        roi = np.full((sampler.size[1], sampler.size[0]), 255, np.uint8)
+        _, per_group = sampler.binarize_region(roi, 'group')
+        _, region = sampler.binarize_region(roi, 'region')
+        _, tiles = sampler.binarize_region(roi, 'tiled', tile_size=256)
+        self.assertEqual(len(per_group), sampler.shape[0])
+        self.assertIsInstance(region, float)
+        self.assertEqual(len(tiles), -(-roi.shape[0] // 256))
+        self.assertEqual(len(tiles[0]), -(-roi.shape[1] // 256))
+
+    def test_unknown_mode(self):
+        sampler = get_compiled_template(TEMPLATE_JSON).answer_sampler
+        with self.assertRaises(ValueError):
+            sampler.binarize_region(np.zeros((10, 10), np.uint8), 'adaptive')
+
+
+class FillRatioTests(SheetTestCase):
+
+    def assertSameCutOff(self, min_pixels, min_fill):
+        sampler = get_compiled_template(TEMPLATE_JSON).answer_sampler
+        counts = np.zeros(sampler.shape, np.int32)
+        pixels = np.arange(min_pixels - 20, min_pixels + 21)
+        counts[:len(pixels), 0] = pixels
+        selected, _, _ = classify_marks(sampler.fill_ratios(counts), min_fill, sampler.valid)
+        self.assertEqual((selected[:len(pixels)] == 0).tolist(), (pixels >= min_pixels).tolist())
+
+    def test_fill_thresholds_match_pixel_thresholds(self):
+        self.assertEqual(int(get_compiled_template(TEMPLATE_JSON).answer_sampler.area.max()), BUBBLE_AREA_PIXELS)
+        self.assertSameCutOff(MIN_ANSWER_PIXELS, MIN_ANSWER_FILL)
+        for label, pixels in MIN_ID_PIXELS.items():
+            with self.subTest(label=label):
+                self.assertSameCutOff(pixels, MIN_ID_FILL[label])
+
+    def test_lower_warp_resolution(self):
+        full = read_sheet(self.image, TEMPLATE_JSON)
+        half = read_sheet(self.image, TEMPLATE_JSON, dpi=150)
+        self.assertReadsSheet(half)
+        self.assertEqual(half.gray.shape, (1754, 1240))
+        np.testing.assert_allclose(half.answer_fill, full.answer_fill, atol=0.1)
+
+
+class BatchScanTests(SheetTestCase):
+
+    def post(self, data, **kwargs):
+        request = APIRequestFactory().post('/api/grading/scan/batch/', {
+            'quiz_id': 'quiz', 'answersheet_id': 'sheet', **data,
+        }, format='multipart')
+        force_authenticate(request, user=SimpleNamespace(id='teacher', is_authenticated=True))
+        received = []
+
+        def scan_and_grade_batch(image_paths, **batch_kwargs):
+            received.extend(image_paths)
+            return {'success': True, 'count': len(received)}
+
+        with mock.patch('grading.views.scan_and_grade_batch', scan_and_grade_batch):
+            response = scan_answer_sheet_batch(request)
+        return response, received
+
+    @staticmethod
+    def upload(name, data=b'image'):
+        return SimpleUploadedFile(name, data)
+
+    @staticmethod
+    def archive(entries):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            for name, data in entries:
+                zf.writestr(name, data)
+        return SimpleUploadedFile('scans.zip', buffer.getvalue(), 'application/zip')
+
+    def test_images_and_archive(self):
+        inner = BytesIO()
+        with zipfile.ZipFile(inner, 'w') as zf:
+            zf.writestr('hidden.png', b'inner')
+        archive = self.archive([
+            ('a.png', b'a'), ('scans/', b''), ('scans/b.JPG', b'b'), ('notes.txt', b'x'),
+            ('more.zip', inner.getvalue()),
+        ])
+        response, received = self.post({'images': [self.upload('1.png', b'1'), self.upload('2.jpg', b'2')],
+                                        'archive': archive})
+        self.assertEqual(response.status_code, 200)
+        # Uploads first, then the archive images (directories, other files and nested zips skipped)
+        self.assertEqual(received, [('1.png', b'1'), ('2.jpg', b'2'), ('a.png', b'a'), ('scans/b.JPG', b'b')])
+
+    def test_rejected_batches(self):
+        with override_settings(GRADING_CONFIG={'MAX_BATCH_SIZE': 2}):
+            response, received = self.post({'images': [self.upload(f'{i}.png') for i in range(3)]})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Max batch size: 2', response.data['error'])
+        self.assertEqual(received, [])
+
+        response, _ = self.post({'archive': self.archive([('notes.txt', b'x')])})
+        self.assertEqual((response.status_code, response.data['error']), (400, 'No images found in request'))
+        response, _ = self.post({'archive': self.upload('scans.zip', b'not a zip')})
+        self.assertEqual((response.status_code, response.data['error']), (400, 'Invalid zip archive'))
+        response, _ = self.post({})
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_sheet_does_not_stop_the_batch(self):
+        template = SimpleNamespace(file_json=TEMPLATE_JSON)
+        questions = [{'order': q + 1, 'answer': 'ABCDE'[max(a, 0)]} for q, a in self.answers.items()]
+        answer_key = SimpleNamespace(num_exam_id=5, versions=[{'version_code': '00123', 'questions': questions}])
+        executor = GradingExecutor('thread', workers=2)
+        self.addCleanup(executor.shutdown)
+        with mock.patch('grading.services.scanning_service.load_scan_context', return_value=(template, answer_key)), \
+                mock.patch('grading.services.scanning_service.get_grading_executor', return_value=executor):
+            batch = iter_scan_and_grade_batch(
+                [('1.png', self.image), ('broken.png', b'not an image'), ('3.png', self.image)],
+                'quiz', 'sheet', 'teacher',
+            )
+            results = list(batch['results'])
+        self.assertEqual([(r['index'], r['filename'], r['success']) for r in results],
+                         [(0, '1.png', True), (1, 'broken.png', False), (2, '3.png', True)])
+        self.assertTrue(results[1]['error'])
+        self.assertEqual(results[0]['score'], results[2]['score'])
+        self.assertEqual(results[0]['student_id'], '12345678')
+        self.assertEqual(executor.stats()['in_flight'], 0)
+
+
+class ExecutorTests(SimpleTestCase):
+
+    def executor(self, mode='thread', **kwargs):
+        kwargs = {'workers': 1, 'queue_depth': 0, 'queue_timeout': 0.05, **kwargs}
+        executor = GradingExecutor(mode, **kwargs)
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    @staticmethod
+    def fail():
+        raise ValueError('bad sheet')
+
+    def test_overloaded(self):
+        release = threading.Event()
+        executor = self.executor()
+        self.addCleanup(release.set)
+        future = executor.submit(release.wait, 5)
+        with self.assertRaises(GradingOverloaded):
+            executor.submit(abs, -1)
+        release.set()
+        self.assertTrue(future.result(timeout=5))
+        self.assertEqual(executor.run(abs, -1, timeout=5), 1)
+
+    def test_inline_slots_are_released(self):
+        executor = self.executor('inline')
+        self.assertEqual(executor.submit(abs, -1).result(), 1)
+        self.assertIsInstance(executor.submit(self.fail).exception(), ValueError)
+        self.assertEqual(executor.submit(abs, -2).result(), 2)
+        self.assertEqual(executor.stats()['in_flight'], 0)
+
+    def test_thread_slots_are_released(self):
+        executor = self.executor()
+        self.assertEqual(executor.run(abs, -1), 1)
+        self.assertIsInstance(executor.submit(self.fail, timeout=5).exception(timeout=5), ValueError)
+        # The slot is released by a done callback: the next submit waits for it
+        self.assertEqual(executor.run(abs, -2, timeout=5), 2)
+
+    def test_broken_pool_is_rebuilt(self):
+        def broken():
+            raise BrokenProcessPool('worker died')
+
+        executor = self.executor()
+        executor.run(abs, -1)
+        pool = executor._pool
+        self.assertIsInstance(executor.submit(broken).exception(timeout=5), BrokenProcessPool)
+        end = time.time() + 5
+        while executor._pool is pool and time.time() < end:
+            time.sleep(0.01)
+        self.assertIsNot(executor._pool, pool)
+        self.assertEqual(executor.run(abs, -1, timeout=5), 1)
+        self.assertIsNot(executor._pool, pool)
+
+    def test_submit_to_broken_pool(self):
+        class BrokenPool:
+            def submit(self, *args, **kwargs):
+                raise BrokenProcessPool('worker died')
+
+            def shutdown(self, wait=True):
+                pass
+
+        executor = self.executor()
+        executor._pool = BrokenPool()
+        with self.assertRaises(BrokenProcessPool):
+            executor.submit(abs, -1)
+        self.assertIsNone(executor._pool)
+        self.assertEqual(executor.run(abs, -1), 1)
+
+    def test_worker_template_cache_size(self):
+        self.addCleanup(set_template_cache_size, template_cache_size())
+        _init_worker(3)
+        self.assertEqual(template_cache_size(), 3)
+        executor = self.executor('process', template_cache_size=5, queue_timeout=5)
+        self.assertEqual(executor.run(template_cache_size), 5)
+
+
+class ScanJobTests(SimpleTestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir, True)
+
+    def job_queue(self, **kwargs):
+        queue = ScanJobQueue(spool_dir=self.spool_dir, **kwargs)
+        self.addCleanup(queue._pool.shutdown)
+        return queue
+
+    @staticmethod
+    def scan(image_path, **kwargs):
+        return {'success': True, 'score': 3}
+
+    def test_image_is_spooled_until_the_job_runs(self):
+        seen = {}
+
+        def scan(image_path, **kwargs):
+            with open(image_path, 'rb') as f:
+                seen['image'] = f.read()
+            seen['kwargs'] = kwargs
+            return {'success': True, 'score': 3}
+
+        job = self.job_queue().submit(scan, 'teacher', b'image bytes', quiz_id='q1')
+        status = wait_for(job)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['result'], {'success': True, 'score': 3})
+        self.assertIsNone(status['error'])
+        self.assertEqual(seen, {'image': b'image bytes', 'kwargs': {'quiz_id': 'q1'}})
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_failed_jobs(self):
+        def fails(image_path):
+            return {'success': False, 'error': 'Failed to read quiz ID'}
+
+        def raises(image_path):
+            raise RuntimeError('boom')
+
+        queue = self.job_queue()
+        status = wait_for(queue.submit(fails, 'teacher', b'x'))
+        self.assertEqual((status['status'], status['error']), ('failed', 'Failed to read quiz ID'))
+        with self.assertLogs('grading.jobs', 'ERROR'):
+            status = wait_for(queue.submit(raises, 'teacher', b'x'))
+        self.assertEqual((status['status'], status['error']), ('failed', 'Processing failed: boom'))
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_queue_full(self):
+        release = threading.Event()
+
+        def blocked(image_path):
+            release.wait(5)
+            return {'success': True}
+
+        queue = self.job_queue(dispatchers=1, max_queued=2)
+        self.addCleanup(release.set)
+        jobs = [queue.submit(blocked, 'teacher', b'x') for _ in range(2)]
+        with self.assertRaises(GradingOverloaded):
+            queue.submit(blocked, 'teacher', b'x')
+        release.set()
+        for job in jobs:
+            self.assertEqual(wait_for(job)['status'], 'done')
+        self.assertEqual(wait_for(queue.submit(self.scan, 'teacher', b'x'))['status'], 'done')
+
+    def test_finished_jobs_expire(self):
+        queue = self.job_queue(result_ttl=0)
+        job = queue.submit(self.scan, 'teacher', b'x')
+        wait_for(job)
+        time.sleep(0.01)
+        self.assertIsNone(queue.get(job.job_id, 'teacher'))
+
+    def test_only_the_owner_reads_a_job(self):
+        queue = self.job_queue()
+        job = queue.submit(self.scan, 'teacher-1', b'x')
+        self.assertIs(queue.get(job.job_id, 'teacher-1'), job)
+        self.assertIsNone(queue.get(job.job_id, 'teacher-2'))
+        self.assertIsNone(queue.get('unknown', 'teacher-1'))
+
+
+class ScanTimeoutTests(SheetTestCase):
+
+    def test_queued_task_is_cancelled(self):
+        future = Future()
+        with self.assertRaises(ScanTimeout):
+            _wait_result(future, time.time())
+        self.assertTrue(future.cancelled())
+
+    def test_result_before_deadline(self):
+        future = Future()
+        future.set_result({'success': True})
+        self.assertEqual(_wait_result(future, time.time() - 1), {'success': True})
+
+    def test_running_task_stops_at_deadline(self):
+        with self.assertRaises(TimeoutError):
+            grade_image(self.image, TEMPLATE_JSON, None, 5, {}, deadline=time.time() - 1)
+        executor = GradingExecutor('inline', workers=1, queue_depth=0)
+        future = executor.submit(grade_image, self.image, TEMPLATE_JSON, None, 5, {}, deadline=time.time() - 1)
+        with self.assertRaises(ScanTimeout):
+            _wait_result(future, time.time() + 60)
+        self.assertEqual(executor.stats()['in_flight'], 0)
+        result = grade_image(self.image, TEMPLATE_JSON, None, 5, {}, annotate='none', deadline=time.time() + 60)
+        self.assertTrue(result['success'])
+
+    def test_error_status(self):
+        self.assertEqual(_scan_error_status(_scan_error(ScanTimeout('slow'), 'quiz', 'sheet')), 504)
+        self.assertEqual(_scan_error_status(_scan_error(GradingOverloaded('full'), 'quiz', 'sheet')), 503)
+        self.assertEqual(_scan_error_status(_scan_error(ValueError('bad'), 'quiz', 'sheet')), 400)
+
+
+class PreviewCheckTests(SheetTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.color = cv2.imdecode(np.frombuffer(cls.image, np.uint8), cv2.IMREAD_COLOR)
+
+    @staticmethod
+    def encode(img):
+        return cv2.imencode('.png', img)[1].tobytes()
+
+    def preview(self, image):
+        with mock.patch('grading.services.scanning_service.decode_image', wraps=decode_image) as decode:
+            result = preview_check(image)
+        return result, [call.args[1] for call in decode.call_args_list]
+
+    def resized(self, width):
+        height = int(round(self.color.shape[0] * width / self.color.shape[1]))
+        return self.encode(cv2.resize(self.color, (width, height), interpolation=cv2.INTER_AREA))
+
+    def test_reduced_decode(self):
+        result, flags = self.preview(self.image)
+        # 1/4 keeps the short side (2481 / 4 = 620) over PREVIEW_MIN_SIDE, 1/8 would not
+        self.assertEqual(flags, [cv2.IMREAD_REDUCED_GRAYSCALE_4])
+        self.assertTrue(result['ready'])
+        self.assertEqual(result['image_size'], {'width': 2481, 'height': 3508})
+        full = {m['id']: m['position'] for m in detect_aruco(cv2.cvtColor(self.color, cv2.COLOR_BGR2GRAY), ARUCO_TYPE)}
+        for m in result['markers']:
+            np.testing.assert_allclose(m['position'], full[m['id']], atol=8)
+
+    def test_reduction_stops_at_min_side(self):
+        for width, flag in ((1000, cv2.IMREAD_REDUCED_GRAYSCALE_2), (300, cv2.IMREAD_GRAYSCALE)):
+            with self.subTest(width=width):
+                result, flags = self.preview(self.resized(width))
+                self.assertEqual(flags, [flag])
+                self.assertEqual(result['image_size']['width'], width)
+                self.assertTrue(result['ready'])
+        self.assertGreaterEqual(1000 // 2, PREVIEW_MIN_SIDE)
+
+    def test_quality(self):
+        sharp = preview_check(self.image)['quality']
+        self.assertEqual((sharp['corner_markers'], sharp['sharpness']), (4, 1.0))
+        self.assertLess(sharp['skew'], 0.1)
+        self.assertGreater(sharp['score'], 0.9)
+
+        blurred = preview_check(self.encode(cv2.GaussianBlur(self.color, (0, 0), 6)))['quality']
+        self.assertLess(blurred['sharpness'], 0.2)
+        self.assertLess(blurred['score'], sharp['score'])
+
+        h, w = self.color.shape[:2]
+        src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        dst = np.float32([[0, 0], [w, 300], [w * 0.8, h], [w * 0.1, h * 0.9]])
+        skewed = cv2.warpPerspective(self.color, cv2.getPerspectiveTransform(src, dst), (w, h),
+                                     borderValue=(255, 255, 255))
+        skewed = preview_check(self.encode(skewed))['quality']
+        self.assertEqual(skewed['corner_markers'], 4)
+        self.assertGreater(skewed['skew'], sharp['skew'])
+        self.assertLess(skewed['score'], sharp['score'])
+
+    def test_quality_without_markers(self):
+        quality = _preview_quality(np.full((600, 480), 128, np.uint8), [])
+        self.assertEqual(quality, {
+            'score': 0.0, 'marker_count': 0, 'corner_markers': 0, 'skew': None, 'sharpness': 0.0,
+        })
+
+    def test_invalid_image(self):
+        result = preview_check(b'not an image')
+        self.assertFalse(result['ready'])
+        self.assertEqual(result['error'], 'Invalid image data')
+
+
+class AnnotationTests(SheetTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        key = {q: 0 if a < 0 else a for q, a in cls.answers.items()}
+        cls.version_keys = {'00123': key}
+
+    def grade(self, **kwargs):
+        return grade_image(self.image, TEMPLATE_JSON, None, 5, self.version_keys, **kwargs)
+
+    @staticmethod
+    def decode(data):
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+    def test_annotation_is_rendered_on_demand(self):
+        none = self.grade(annotate='none')
+        self.assertIsNone(none['annotated_image_base64'])
+        self.assertIsNone(none['annotated_image_mime'])
+        for mode, width in (('thumbnail', THUMBNAIL_WIDTH), ('full', 2481)):
+            with self.subTest(mode=mode):
+                result = self.grade(annotate=mode)
+                self.assertEqual(result['annotated_image_mime'], 'image/jpeg')
+                img = self.decode(base64.b64decode(result['annotated_image_base64']))
+                self.assertEqual(img.shape[1], width)
+                self.assertEqual(result['score'], none['score'])
+                self.assertEqual(result['student_id'], none['student_id'])
+
+    def test_raw_bytes_and_cache_file(self):
+        result = self.grade(annotate='thumbnail', raw_annotation=True)
+        self.assertIsNone(result['annotated_image_base64'])
+        self.assertEqual(self.decode(result['annotated_image_bytes']).shape[1], THUMBNAIL_WIDTH)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        result = self.grade(annotate='thumbnail', annotation_dir=cache_dir, annotation_owner='teacher1')
+        filename = result['annotated_image_file']
+        self.assertEqual(os.listdir(cache_dir), [filename])
+        self.assertTrue(is_annotation_owner(filename, 'teacher1'))
+
+    def test_encode_size_limits(self):
+        img = np.zeros((400, 300, 3), np.uint8)
+        self.assertEqual(self.decode(encode_image(img, max_width=150)).shape[:2], (200, 150))
+        self.assertEqual(self.decode(encode_image(img, max_width=150, max_height=100)).shape[:2], (100, 75))
+        self.assertEqual(self.decode(encode_image(img, max_width=1000)).shape[:2], (400, 300))
+
+    def test_encode_quality(self):
+        rng = np.random.default_rng(4)
+        img = rng.integers(0, 256, (200, 200, 3), dtype=np.uint8)
+        for fmt in ('jpeg', 'webp'):
+            with self.subTest(fmt=fmt):
+                self.assertLess(len(encode_image(img, fmt, quality=30)), len(encode_image(img, fmt, quality=90)))
+        for quality in (1, 100, 500):
+            np.testing.assert_array_equal(self.decode(encode_image(img, 'png', quality=quality)), img)
+        with self.assertRaises(ValueError):
+            encode_image(img, 'gif')
+
+    def test_cached_annotation_owner(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        owned = save_annotation(b'data', cache_dir, 'png', owner='teacher1')
+        self.assertTrue(owned.endswith('_annotated.png'))
+        self.assertTrue(is_annotation_owner(owned, 'teacher1'))
+        self.assertFalse(is_annotation_owner(owned, 'teacher2'))
+        self.assertFalse(is_annotation_owner(owned, None))
+        self.assertFalse(is_annotation_owner(f'../{owned}', 'teacher1'))
+        self.assertFalse(is_annotation_owner(save_annotation(b'data', cache_dir), 'teacher1'))
+
+
+class MultipartTests(SimpleTestCase):
+
+    def parse(self, boundary, parts):
+        body = b''.join(parts) + closing(boundary)
+        message = BytesParser().parsebytes(f'Content-Type: {content_type(boundary)}\r\n\r\n'.encode() + body)
+        self.assertTrue(message.is_multipart())
+        return message.get_payload()
+
+    def test_result_with_image(self):
+        boundary = new_boundary()
+        image = bytes(range(256)) * 4
+        result = {'score': 7, 'annotated_image_bytes': image, 'annotated_image_mime': 'image/jpeg'}
+        json_part, image_part = self.parse(boundary, result_parts(boundary, result, 'sheet-0'))
+
+        self.assertEqual(json_part.get_content_type(), 'application/json')
+        self.assertEqual(json_part['Content-ID'], '<sheet-0>')
+        self.assertEqual(json.loads(json_part.get_payload(decode=True)), {
+            'score': 7, 'annotated_image_mime': 'image/jpeg', 'annotated_image_part': 'sheet-0-image',
+        })
+        self.assertEqual(image_part.get_content_type(), 'image/jpeg')
+        self.assertEqual(image_part['Content-ID'], '<sheet-0-image>')
+        self.assertEqual(image_part.get_payload(decode=True), image)
+        self.assertIn('annotated_image_bytes', result)
+
+    def test_result_without_image(self):
+        boundary = new_boundary()
+        (part,) = self.parse(boundary, result_parts(boundary, {'score': 3}, 'sheet-1'))
+        self.assertEqual(json.loads(part.get_payload(decode=True)), {'score': 3, 'annotated_image_part': None})
+
+
+class MarkerTrackerTests(SheetTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.color = cv2.imdecode(np.frombuffer(cls.image, np.uint8), cv2.IMREAD_COLOR)
+        first = read_sheet(cls.image, TEMPLATE_JSON)
+        cls.seed = seed_from_homography(first.homography, first.image_size, first.template.page_size)
+
+    def frame(self, dx, dy):
+        """The sheet moved by (dx, dy) pixels between two frames"""
+        h, w = self.color.shape[:2]
+        moved = cv2.warpAffine(self.color, np.float32([[1, 0, dx], [0, 1, dy]]), (w, h), borderValue=(255, 255, 255))
+        return cv2.imencode('.png', moved)[1].tobytes()
+
+    def test_second_frame_is_tracked(self):
+        for shift in ((0, 0), (12, -8)):
+            with self.subTest(shift=shift):
+                sheet = read_sheet(self.frame(*shift), TEMPLATE_JSON, tracking_seed=self.seed)
+                self.assertTrue(sheet.tracked)
+                self.assertAlmostEqual(sheet.homography_error, 1.5, delta=0.5)
+                self.assertReadsSheet(sheet)
+
+    def test_falls_back_to_full_detection(self):
+        sheet = read_sheet(self.frame(300, 200), TEMPLATE_JSON, tracking_seed=self.seed)
+        self.assertFalse(sheet.tracked)
+        self.assertLess(sheet.homography_error, TRACK_MAX_ERROR)
+        self.assertReadsSheet(sheet)
+
+        gray = cv2.cvtColor(self.color, cv2.COLOR_BGR2GRAY)
+        template = get_compiled_template(TEMPLATE_JSON)
+        self.assertIsNone(track_markers(gray[:-1], template, self.seed, ARUCO_TYPE, CORNER_MARKER_IDS))
+        self.assertIsNone(track_markers(gray, template, None, ARUCO_TYPE, CORNER_MARKER_IDS))
+
+    def test_seed_is_reused_per_scan_session(self):
+        template = SimpleNamespace(file_json=TEMPLATE_JSON)
+        answer_key = SimpleNamespace(num_exam_id=5, versions=[])
+        sessions = TrackingSessions()
+        with mock.patch('grading.services.scanning_service.load_scan_context', return_value=(template, answer_key)), \
+                mock.patch('grading.services.scanning_service.get_grading_executor',
+                           return_value=GradingExecutor('inline')), \
+                mock.patch('grading.services.scanning_service.get_tracking_sessions', return_value=sessions):
+            def scan(session, image=self.image):
+                return scan_and_grade(image, 'quiz', 'sheet', 'teacher', annotate='none', scan_session=session)
+
+            self.assertFalse(scan('s1')['tracked'])
+            second = scan('s1', self.frame(3, 2))
+            self.assertTrue(second['tracked'])
+            self.assertEqual(second['student_id'], '12345678')
+            self.assertNotIn('tracking_seed', second)
+            self.assertFalse(scan('s2')['tracked'])
+            self.assertNotIn('tracked', scan(None))
+        self.assertIsNotNone(sessions.get(('teacher', 'sheet', 's1')))
+
+    def test_sessions_expire(self):
+        sessions = TrackingSessions(ttl=0)
+        sessions.update('s1', self.seed)
+        time.sleep(0.01)
+        self.assertIsNone(sessions.get('s1'))
+
+        sessions = TrackingSessions(max_sessions=1)
+        sessions.update('s1', self.seed)
+        sessions.update('s2', self.seed)
+        self.assertIsNone(sessions.get('s1'))
+        self.assertEqual(sessions.get('s2'), self.seed)
+        sessions.update('s2', None)
+        self.assertIsNone(sessions.get('s2'))
+
+
+class HomographyTests(SimpleTestCase):
+
+    def setUp(self):
+        self.template_markers = [{'id': m['id'], 'position': m['position']} for m in load_template()['aruco_marker']]
+        # Template → photo
+        self.to_image = np.array([[0.8, 0.05, 120], [-0.04, 0.82, 90], [2e-5, 1e-5, 1]])
+        self.detected = [
+            {'id': m['id'], 'position': self.project(self.to_image, [m['position']])[0].tolist()}
+            for m in self.template_markers
+        ]
+
+    @staticmethod
+    def project(H, points):
+        return cv2.perspectiveTransform(np.array(points, np.float64).reshape(-1, 1, 2), H).reshape(-1, 2)
+
+    def assertMapsToTemplate(self, H, markers, atol):
+        template = {m['id']: m['position'] for m in self.template_markers}
+        for m in markers:
+            np.testing.assert_allclose(self.project(H, [m['position']])[0], template[m['id']], atol=atol)
+
+    def test_corner_markers(self):
+        H, error, method = solve_homography(self.detected, self.template_markers, CORNER_MARKER_IDS)
+        self.assertEqual(method, 'corners')
+        self.assertLess(error, 0.01)
+        self.assertMapsToTemplate(H, self.detected, 0.01)
+
+    def test_misplaced_marker_escalates_to_ransac(self):
+        moved = next(m for m in self.detected if m['id'] not in CORNER_MARKER_IDS)
+        moved['position'] = [moved['position'][0] + 40, moved['position'][1] - 25]
+        H, error, method = solve_homography(self.detected, self.template_markers, CORNER_MARKER_IDS)
+        self.assertEqual(method, 'ransac')
+        self.assertMapsToTemplate(H, [m for m in self.detected if m is not moved], 0.5)
+        # The error covers the rejected marker too
+        self.assertGreater(error, 40)
+
+        H, error, method = solve_homography(self.detected, self.template_markers, CORNER_MARKER_IDS, ransac=False)
+        self.assertEqual(method, 'corners')
+        self.assertGreater(error, HOMOGRAPHY_MAX_ERROR)
+
+    def test_missing_corner(self):
+        detected = [m for m in self.detected if m['id'] != CORNER_MARKER_IDS[0]]
+        H, _, method = solve_homography(detected, self.template_markers, CORNER_MARKER_IDS)
+        self.assertEqual(method, 'ransac')
+        self.assertMapsToTemplate(H, detected, 0.5)
+        with self.assertRaises(ValueError):
+            solve_homography(detected, self.template_markers, CORNER_MARKER_IDS, ransac=False)
+
+    def test_too_few_markers(self):
+        with self.assertRaises(ValueError):
+            solve_homography(self.detected[:3], self.template_markers, CORNER_MARKER_IDS)
+
+    def test_ransac_threshold_scales_with_template(self):
+        # Template at 150 DPI: a marker 2 px off is 4 px off at 300 DPI, over RANSAC_REPROJ_THRESHOLD
+        template_markers = [
+            {'id': m['id'], 'position': [p * 0.5 for p in m['position']]} for m in self.template_markers
+        ]
+        detected = [
+            {'id': m['id'], 'position': self.project(self.to_image, [m['position']])[0].tolist()}
+            for m in template_markers if m['id'] != CORNER_MARKER_IDS[0]
+        ]
+        moved = next(m for m in detected if m['id'] not in CORNER_MARKER_IDS)
+        moved['position'] = [moved['position'][0] + 2, moved['position'][1]]
+        self.template_markers = template_markers
+        H, error, _ = solve_homography(
+            detected, template_markers, CORNER_MARKER_IDS, ransac_threshold=RANSAC_REPROJ_THRESHOLD * 0.5
+        )
+        self.assertMapsToTemplate(H, [m for m in detected if m is not moved], 0.01)
+        self.assertGreater(error, 1.5)
+
+
+class DenseResultTests(SheetTestCase):
+
+    def test_key_vector(self):
+        key = key_vector({0: 2, 3: None, 5: 1, -1: 3, 40: 0}, [0, 1, 3, 5])
+        self.assertEqual(key.tolist(), [2, NO_ANSWER, NO_ANSWER, 1])
+        self.assertEqual(key.dtype, np.int8)
+        self.assertEqual(key_vector(None, [0, 1]).tolist(), [NO_ANSWER, NO_ANSWER])
+        self.assertEqual(key_vector({}, []).tolist(), [])
+
+    def test_score(self):
+        selected = np.array([0, 1, NO_ANSWER, 3, NO_ANSWER], np.int8)
+        key = np.array([0, 2, 1, 3, NO_ANSWER], np.int8)
+        self.assertEqual(score_answers(selected, key), 2)
+        result = SheetResult.from_fill([4, 5, 6], [[0.9, 0, 0], [0, 0, 0], [0.9, 0.9, 0]], 0.5)
+        self.assertEqual(result.answers_dict(), {4: 0, 5: -1, 6: 0})
+        self.assertEqual(result.score(result.key_vector({4: 0, 5: -1, 6: 2})), 1)
+
+    def test_sheet_score_matches_stored_answer_grading(self):
+        sheet = read_sheet(self.image, TEMPLATE_JSON)
+        key = {q: (q * 3) % 5 for q in self.answers}
+        result = grade_sheet(sheet, key)
+        stored = {str(q + 1): a for q, a in sheet.sheet_result.answers_dict().items()}
+        score, total, percentage = grade_answers_with_key(key, stored)
+        self.assertEqual((result['score'], result['total_questions']), (score, total))
+        self.assertAlmostEqual(result['percentage'], percentage)
+
+    def test_stored_answer_grading_baseline(self):
+        # Only "1"-based string keys are looked up; an int key is not read
+        self.assertEqual(grade_answers_with_key({0: 0, 1: 1}, {'1': 'A', 2: 1})[0], 1)
+        self.assertEqual(grade_answers_with_key({0: 2, 1: 1, 2: 0}, {'1': [2], '2': '1', '3': ''})[0], 2)
+        # A -1 key answer matches a blank (-1) answer, a key for question -1 reads key "0"
+        self.assertEqual(grade_answers_with_key({0: -1, -1: 3}, {'1': -1, '0': 'D'})[0], 2)
+        self.assertEqual(grade_answers_with_key({0: 1}, {}, num_questions=4), (0, 4, 0.0))
+
+
+class MarkStatusTests(SheetTestCase):
+
+    def test_classify_marks(self):
+        fill = [
+            [0.0, 0.1, 0.0],   # blank
+            [0.1, 0.9, 0.0],   # single
+            [0.6, 0.0, 0.9],   # multiple
+            [0.3, 0.0, 0.0],   # erased / too light
+            [0.0, 0.55, 0.0],  # single, close to the threshold
+        ]
+        selected, status, confidence = classify_marks(fill, 0.5)
+        self.assertEqual(selected.tolist(), [NO_ANSWER, 1, 0, NO_ANSWER, 1])
+        self.assertEqual(status.tolist(), [STATUS_BLANK, STATUS_SINGLE, STATUS_MULTIPLE, STATUS_ERASED, STATUS_SINGLE])
+        np.testing.assert_allclose(confidence, [1.0, 1.0, 0.4, 0.8, 0.2], atol=1e-6)
+        self.assertEqual(needs_review(status, confidence).tolist(), [False, False, True, True, True])
+        self.assertEqual(needs_review(status, confidence, required=True).tolist(), [True, False, True, True, True])
+
+        selected, _, _ = classify_marks(fill, 0.5, pick='max')
+        self.assertEqual(selected[2], 2)
+
+    def test_invalid_bubbles_are_ignored(self):
+        valid = np.array([[True, True, False]])
+        selected, status, _ = classify_marks([[0.0, 0.0, 0.9]], 0.5, valid)
+        self.assertEqual((selected[0], status[0]), (NO_ANSWER, STATUS_BLANK))
+
+    def test_no_rows(self):
+        selected, status, confidence = classify_marks(np.zeros((0, 4)), 0.5)
+        self.assertEqual((selected.size, status.size, confidence.size), (0, 0, 0))
+
+    def test_mark_details(self):
+        _, status, confidence = classify_marks([[0.9, 0.0], [0.0, 0.0]], 0.5)
+        details = mark_details([[0.9, 0.0], [0.0, 0.0]], status, confidence, {'digits': [0, -1]}, required=True)
+        self.assertEqual(details['digits'], [0, -1])
+        self.assertEqual(details['status'], ['single', 'blank'])
+        self.assertEqual(details['review'], [False, True])
+
+    def test_sheet_flags_multi_marked_questions(self):
+        sheet = read_sheet(self.image, TEMPLATE_JSON)
+        result = sheet.sheet_result
+        multiple = np.flatnonzero(result.status == STATUS_MULTIPLE)
+        self.assertEqual(result.question_index[multiple].tolist(), list(MULTI_MARKED_QUESTIONS))
+        self.assertEqual(np.flatnonzero(result.review_mask()).tolist(), multiple.tolist())
+        for label, details in sheet.id_details.items():
+            self.assertFalse(any(details['review']), label)
+
+
+class ItemAnalysisTests(SimpleTestCase):
+
+    def report(self, documents):
+        grades = GradeMatrix.from_documents(documents, NUM_QUESTIONS)
+        return item_analysis_report(grades, KeyMatrix(KEY_VERSIONS, NUM_QUESTIONS))
+
+    def test_counts_match_baseline(self):
+        documents = grade_documents(200)
+        report = self.report(documents)
+        counts = [(i['correct_count'], i['incorrect_count'], i['blank_count']) for i in report['items']]
+        self.assertEqual(counts, legacy_item_counts(documents, KEY_VERSIONS, NUM_QUESTIONS))
+        self.assertEqual(report['total_papers'], 200)
+        self.assertEqual([i['correct_answer'] for i in report['items']], list('ABCDEA'))
+        first = report['items'][0]
+        self.assertEqual(first['correct_percent'], round(first['correct_count'] / 200 * 100, 2))
+
+    def test_option_counts(self):
+        documents = [
+            {'answers': {'1': 0, '2': [3]}, 'version_code': '001'},
+            {'answers': {'1': 'a', '2': '3'}, 'version_code': '002'},
+            {'answers': {'1': 'E', '2': ''}, 'version_code': '003'},
+        ]
+        items = self.report(documents)['items']
+        self.assertEqual(items[0]['option_counts'], {'A': 2, 'B': 0, 'C': 0, 'D': 0, 'E': 1})
+        self.assertEqual(items[1]['option_counts'], {'A': 0, 'B': 0, 'C': 0, 'D': 2, 'E': 0})
+        self.assertEqual([items[0]['correct_count'], items[1]['blank_count']], [1, 1])
+
+    def test_score_statistics(self):
+        documents = grade_documents(50, seed=1)
+        statistics = self.report(documents)['statistics']
+        scores = [d['score'] for d in documents if d['score'] is not None]
+        percentages = [d['percentage'] for d in documents if d['percentage'] is not None]
+        self.assertEqual(statistics['min_score'], round(min(scores), 2))
+        self.assertEqual(statistics['max_score'], round(max(scores), 2))
+        self.assertEqual(statistics['average_score'], round(sum(scores) / len(scores), 2))
+        self.assertEqual(statistics['average_percent'], round(sum(percentages) / len(percentages), 2))
+        self.assertEqual(statistics['std_deviation'], round(float(np.std(scores)), 2))
+
+
+class TestTheoryTests(SimpleTestCase):
+
+    def analyze(self, rows):
+        """test_statistics() and report of version 001 papers built from rows of 0/1 correct flags"""
+        documents = [
+            {'answers': {str(q + 1): 'ABCDEA'[q] if ok else 'EABCDE'[q] for q, ok in enumerate(row)},
+             'version_code': '001', 'score': float(sum(row))}
+            for row in rows
+        ]
+        grades = GradeMatrix.from_documents(documents, NUM_QUESTIONS)
+        key = KeyMatrix(KEY_VERSIONS, NUM_QUESTIONS)
+        return test_statistics(grades, key), item_analysis_report(grades, key)
+
+    def test_reliability_and_point_biserial(self):
+        rng = np.random.default_rng(5)
+        ability = rng.random(40)
+        x = (ability[:, None] + rng.random((40, NUM_QUESTIONS)) * 0.8 > np.linspace(0.5, 1.2, NUM_QUESTIONS))
+        x = x.astype(np.float64)
+        total = x.sum(axis=1)
+        ctt, report = self.analyze(x)
+
+        k = NUM_QUESTIONS
+        alpha = k / (k - 1) * (1 - x.var(axis=0, ddof=1).sum() / total.var(ddof=1))
+        p = x.mean(axis=0)
+        kr20 = k / (k - 1) * (1 - (p * (1 - p)).sum() / total.var())
+        self.assertAlmostEqual(ctt['cronbach_alpha'], alpha)
+        self.assertAlmostEqual(ctt['kr20'], kr20)
+        self.assertAlmostEqual(ctt['sem'], total.std() * np.sqrt(1 - kr20))
+        np.testing.assert_allclose(ctt['difficulty'], p)
+        np.testing.assert_allclose(
+            ctt['point_biserial'], [np.corrcoef(x[:, q], total)[0, 1] for q in range(k)], rtol=1e-9
+        )
+        self.assertEqual(report['statistics']['kr20'], round(kr20, 4))
+        self.assertEqual(report['items'][0]['point_biserial'], round(float(ctt['point_biserial'][0]), 4))
+
+    def test_discrimination(self):
+        # 10 papers → groups of round(0.27 * 10) = 3, ties broken by paper order
+        rows = [
+            [1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 0], [1, 1, 1, 1, 0, 0], [1, 1, 1, 0, 0, 0], [1, 1, 0, 0, 0, 0],
+            [1, 1, 0, 0, 0, 0], [1, 0, 0, 0, 0, 0], [0, 1, 0, 0, 0, 0], [1, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0],
+        ]
+        ctt, report = self.analyze(rows)
+        self.assertEqual(np.flatnonzero(ctt['upper']).tolist(), [0, 1, 2])
+        self.assertEqual(np.flatnonzero(ctt['lower']).tolist(), [6, 7, 9])
+        x = np.array(rows, dtype=np.float64)
+        np.testing.assert_allclose(ctt['discrimination'], x[[0, 1, 2]].mean(axis=0) - x[[6, 7, 9]].mean(axis=0))
+        self.assertEqual(report['statistics']['group_size'], 3)
+        # Question 2 (key B): distractor A was chosen by papers 6, 8 and 9
+        self.assertEqual(report['items'][1]['distractors']['A'], {'count': 3, 'upper': 0, 'lower': 2})
+        self.assertEqual(report['items'][1]['distractors']['B'], {'count': 7, 'upper': 3, 'lower': 1})
+        self.assertEqual(report['items'][1]['distractors']['C'], {'count': 0, 'upper': 0, 'lower': 0})
+
+    def test_median(self):
+        _, report = self.analyze([[1, 0, 0, 0, 0, 0], [1, 1, 1, 0, 0, 0], [1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 0, 0]])
+        self.assertEqual(report['statistics']['median_score'], 3.5)
+
+    def test_empty_quiz(self):
+        _, report = self.analyze([])
+        self.assertEqual(report['total_papers'], 0)
+        self.assertEqual([item['correct_count'] for item in report['items']], [0] * NUM_QUESTIONS)
+        self.assertEqual(report['items'][0]['correct_percent'], 0)
+        self.assertIsNone(report['items'][0]['difficulty'])
+        self.assertIsNone(report['items'][0]['discrimination'])
+        for name in ('kr20', 'cronbach_alpha', 'sem'):
+            self.assertIsNone(report['statistics'][name])
+        self.assertEqual(report['statistics']['median_score'], 0)
+        self.assertEqual(report['statistics']['group_size'], 0)
+
+    def test_zero_variance(self):
+        _, report = self.analyze([[1, 1, 0, 1, 0, 1]] * 5)
+        self.assertIsNone(report['statistics']['kr20'])
+        self.assertIsNone(report['statistics']['cronbach_alpha'])
+        self.assertIsNone(report['items'][0]['point_biserial'])
+        self.assertEqual([item['discrimination'] for item in report['items']], [0.0] * NUM_QUESTIONS)
+        self.assertEqual(report['statistics']['std_deviation'], 0)
+
+    def test_one_paper(self):
+        _, report = self.analyze([[1, 0, 1, 0, 1, 0]])
+        self.assertEqual(report['total_papers'], 1)
+        self.assertEqual([item['difficulty'] for item in report['items']], [1.0, 0.0, 1.0, 0.0, 1.0, 0.0])
+        self.assertIsNone(report['items'][0]['discrimination'])
+        self.assertIsNone(report['statistics']['kr20'])
+        self.assertEqual(report['statistics']['median_score'], 3)
+        self.assertEqual(report['statistics']['std_deviation'], 0)
+
+
+class StatsReportTestCase(SimpleTestCase):
+    """Compares statistics reports with the item analysis engine"""
+    COUNT_FIELDS = ('correct_count', 'incorrect_count', 'blank_count', 'option_counts', 'difficulty')
+
+    def setUp(self):
+        self.key = KeyMatrix(KEY_VERSIONS, NUM_QUESTIONS)
+
+    def engine_report(self, documents):
+        return item_analysis_report(GradeMatrix.from_documents(documents, NUM_QUESTIONS), self.key)
+
+    def assertSameReport(self, report, expected):
+        self.assertEqual(report['total_papers'], expected['total_papers'])
+        for item, expected_item in zip(report['items'], expected['items']):
+            for field in self.COUNT_FIELDS:
+                self.assertEqual(item[field], expected_item[field], (item['question_number'], field))
+        shared = set(report['statistics']) & set(expected['statistics'])
+        self.assertEqual({name: report['statistics'][name] for name in shared},
+                         {name: expected['statistics'][name] for name in shared})
+
+
+class QuizStatsTests(StatsReportTestCase):
+
+    def test_grade_increments(self):
+        grade = {'answers': {'1': 'B', '2': [0], '3': '', '4': -1, 'x': 2}, 'version_code': '1.0',
+                 'score': 7.25, 'percentage': 72.5}
+        self.assertEqual(grade_increments(grade, -1), {
+            'num_papers': -1, 'papers.v1．0': -1,
+            'option_counts.v1．0.1.1': -1, 'option_counts.v1．0.2.0': -1,
+            'score_histogram.725': -1, 'score_count': -1, 'score_sum': -7.25, 'score_sq_sum': -7.25 ** 2,
+            'percentage_count': -1, 'percentage_sum': -72.5,
+        })
+        self.assertEqual(grade_increments({'answers': None}), {'num_papers': 1, 'papers.v': 1})
+
+    def test_report_matches_engine(self):
+        documents = grade_documents(150, seed=2)
+        self.assertSameReport(quiz_stats_report(materialize(documents), self.key, NUM_QUESTIONS),
+                              self.engine_report(documents))
+
+    def test_edits_and_deletes(self):
+        documents = grade_documents(40, seed=3)
+        edited = [dict(doc, answers={'1': 'A'}, score=1.0) for doc in documents[:10]]
+        stats = materialize(documents + edited, removed=documents[:10] + documents[30:])
+        self.assertSameReport(quiz_stats_report(stats, self.key, NUM_QUESTIONS),
+                              self.engine_report(edited + documents[10:30]))
+
+    def test_score_histogram(self):
+        documents = [{'score': s, 'percentage': s * 10} for s in (3.5, 1.25, 3.5, 8.0)]
+        report = quiz_stats_report(materialize(documents), self.key, NUM_QUESTIONS)
+        self.assertEqual(report['score_histogram'], [
+            {'score': 1.25, 'count': 1}, {'score': 3.5, 'count': 2}, {'score': 8.0, 'count': 1},
+        ])
+        self.assertEqual(report['statistics']['median_score'], 3.5)
+        self.assertEqual(report['statistics']['std_deviation'], round(float(np.std([3.5, 1.25, 3.5, 8.0])), 2))
+
+    def test_empty_quiz(self):
+        for stats in ({}, materialize([])):
+            report = quiz_stats_report(stats, self.key, NUM_QUESTIONS)
+            self.assertSameReport(report, self.engine_report([]))
+            self.assertIsNone(report['items'][0]['difficulty'])
+            self.assertEqual(report['score_histogram'], [])
+
+    def test_all_grades_deleted(self):
+        documents = grade_documents(5)
+        report = quiz_stats_report(materialize(documents, removed=documents), self.key, NUM_QUESTIONS)
+        self.assertSameReport(report, self.engine_report([]))
+
+
+class AggregationTests(StatsReportTestCase):
+
+    def test_pipeline_filters_quiz(self):
+        pipeline = item_counts_pipeline('quiz', 'teacher')
+        self.assertEqual(pipeline[0], {'$match': {'exam_id': 'quiz', 'teacher_id': 'teacher'}})
+        self.assertEqual(set(pipeline[-1]['$facet']), {'answers', 'versions', 'scores', 'percentages'})
+
+    def test_same_document_as_materialized(self):
+        documents = grade_documents(120, seed=6)
+        stats = stats_from_aggregation(aggregation_result(documents))
+        materialized = materialize(documents)
+        for field in ('num_papers', 'papers', 'option_counts', 'score_histogram', 'score_count', 'percentage_count'):
+            self.assertEqual(stats[field], materialized[field], field)
+        for field in ('score_sum', 'score_sq_sum', 'percentage_sum'):
+            self.assertAlmostEqual(stats[field], materialized[field], places=6)
+
+    def test_backends_agree(self):
+        for count in (0, 1, 2, 97):
+            with self.subTest(papers=count):
+                documents = grade_documents(count, seed=count)
+                engine = self.engine_report(documents)
+                self.assertSameReport(quiz_stats_report(materialize(documents), self.key, NUM_QUESTIONS), engine)
+                aggregate = stats_from_aggregation(aggregation_result(documents))
+                self.assertSameReport(quiz_stats_report(aggregate, self.key, NUM_QUESTIONS), engine)
+
+    def test_backends_agree_without_variance(self):
+        documents = [{'answers': {'1': 'A', '2': 'C'}, 'version_code': '001', 'score': 5.0, 'percentage': 50.0}] * 4
+        engine = self.engine_report(documents)
+        self.assertIsNone(engine['statistics']['kr20'])
+        for stats in (materialize(documents), stats_from_aggregation(aggregation_result(documents))):
+            report = quiz_stats_report(stats, self.key, NUM_QUESTIONS)
+            self.assertSameReport(report, engine)
+            self.assertEqual(report['statistics']['std_deviation'], 0)
+
+    def test_empty_result(self):
+        stats = stats_from_aggregation({})
+        self.assertEqual((stats['num_papers'], stats['option_counts'], stats['score_count']), (0, {}, 0))
+        self.assertSameReport(quiz_stats_report(stats, self.key, NUM_QUESTIONS), self.engine_report([]))
+
+
+class IndexPlanTests(SimpleTestCase):
+
+    class Model:
+        """Stand-in for a Document: declared index specs + a collection with existing indexes"""
+
+        def __init__(self, meta, existing):
+            self._meta = meta
+            self.collection = type('Collection', (), {'index_information': lambda _: existing})()
+
+        def _get_collection(self):
+            return self.collection
+
+    def test_index_key(self):
+        self.assertEqual(index_key([('teacher_id', 1), ('scanned_at', -1.0)]), (('teacher_id', 1), ('scanned_at', -1)))
+
+    def test_grade_keeps_single_field_indexes(self):
+        keys = {index_key(spec['fields']) for spec in Grade._meta['index_specs']}
+        for field in ('exam_id', 'student_id', 'class_code', 'teacher_id', 'version_code', 'scanned_at'):
+            self.assertIn(((field, 1),), keys)
+        self.assertIn((('teacher_id', 1), ('exam_id', 1), ('scanned_at', -1)), keys)
+        self.assertNotEqual(Grade._meta.get('auto_create_index'), False)
+
+    def test_plan(self):
+        existing = {
+            '_id_': {'key': [('_id', 1)]},
+            'exam_id_1': {'key': [('exam_id', 1)]},
+            'teacher_scanned': {'key': [('teacher_id', 1), ('scanned_at', -1)]},
+            'percentage_1': {'key': [('percentage', 1)]},
+        }
+        missing, present, obsolete = index_plan(self.Model(Grade._meta, existing))
+        self.assertEqual(sorted(present), ['exam_id_1', 'teacher_scanned'])
+        self.assertEqual(obsolete, ['percentage_1'])
+        self.assertEqual(len(missing), len(Grade._meta['index_specs']) - 2)
+        fields, options = next(m for m in missing if m[1].get('name') == 'teacher_exam_scanned')
+        self.assertEqual(fields, [('teacher_id', 1), ('exam_id', 1), ('scanned_at', -1)])
+        self.assertNotIn('fields', options)
+
+    def test_fresh_collection(self):
+        missing, present, obsolete = index_plan(self.Model(Grade._meta, {'_id_': {'key': [('_id', 1)]}}))
+        self.assertEqual((len(missing), present, obsolete), (len(Grade._meta['index_specs']), [], []))
+
+
+class ExplainSummaryTests(SimpleTestCase):
+
+    def explain(self, plan, **stats):
+        return {'queryPlanner': {'winningPlan': plan}, 'executionStats': stats}
+
+    def test_index_scan(self):
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'teacher_exam_scanned'}}
+        self.assertEqual(plan_stages(plan), [('FETCH', None), ('IXSCAN', 'teacher_exam_scanned')])
+        summary = summarize_explain(self.explain(plan, totalKeysExamined=5, totalDocsExamined=5, nReturned=5))
+        self.assertEqual(summary, {
+            'indexes': ['teacher_exam_scanned'], 'collscan': False, 'in_memory_sort': False,
+            'keys_examined': 5, 'docs_examined': 5, 'returned': 5,
+        })
+
+    def test_collscan_and_in_memory_sort(self):
+        plan = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}
+        summary = summarize_explain(self.explain(plan, totalDocsExamined=100, nReturned=3))
+        self.assertTrue(summary['collscan'])
+        self.assertTrue(summary['in_memory_sort'])
+        self.assertEqual(summary['indexes'], [])
+
+    def test_slot_based_plan_with_several_inputs(self):
+        plan = {'queryPlan': {'stage': 'OR', 'inputStages': [
+            {'stage': 'IXSCAN', 'indexName': 'exam_id_1'},
+            {'stage': 'IXSCAN', 'indexName': 'teacher_scanned'},
+        ]}}
+        self.assertEqual(summarize_explain(self.explain(plan))['indexes'], ['exam_id_1', 'teacher_scanned'])
+        self.assertEqual(summarize_explain({})['indexes'], [])
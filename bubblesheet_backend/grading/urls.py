@@ -4,10 +4,13 @@ from grading.views import (
     GradeListView,
     GradeDetailView,
     scan_answer_sheet,
+    scan_answer_sheet_batch,
+    scan_job_status,
     preview_check_api,
     save_grade_api,
     get_grades_for_quiz,
     item_analysis,
+    quiz_stats,
     check_answer_key,
     grade_from_json_api,
     get_template_json_api,
@@ -23,6 +26,8 @@ urlpatterns = [
     
     # New scanning URLs
     path('scan/', scan_answer_sheet, name='scan-answer-sheet'),
+    path('scan/batch/', scan_answer_sheet_batch, name='scan-answer-sheet-batch'),
+    path('scan/jobs/<str:job_id>/', scan_job_status, name='scan-job-status'),
     path('preview-check/', preview_check_api, name='preview-check'),
     path('save-grade/', save_grade_api, name='save-grade'),
     path('grade-from-json/', grade_from_json_api, name='grade-from-json'),
@@ -30,5 +35,6 @@ urlpatterns = [
     
     # Other grading URLs
     path('item-analysis/', item_analysis, name='item-analysis'),
+    path('quiz-stats/', quiz_stats, name='quiz-stats'),
     path('check-answer-key/', check_answer_key, name='check-answer-key'),
 ]
\ No newline at end of file
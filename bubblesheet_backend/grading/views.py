@@ -4,21 +4,36 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
-import tempfile
+from rest_framework.utils.encoders import JSONEncoder
 import os
 import json
+import zipfile
 import logging
 from datetime import datetime
 from django.conf import settings
+from django.http import StreamingHttpResponse
 
 from grading.models import Grade
 from grading.serializers import GradeSerializer
 from grading.services.scanning_service import (
     scan_and_grade,
+    scan_and_grade_batch,
+    iter_scan_and_grade_batch,
     preview_check,
+    annotation_url,
+    annotation_cache_dir,
+    get_annotation_encoding,
     get_answer_key_for_version,
     grade_answers_with_key,
 )
+from grading.template_cache import get_compiled_template
+from grading.executor import GradingOverloaded
+from grading.jobs import get_job_queue
+from grading.annotation import annotate_mode, is_annotation_owner
+from grading import multipart
+from grading.analysis import GradeMatrix, KeyMatrix, item_analysis_report
+from grading.quiz_stats import grade_snapshot, QuizStatsUpdate, get_quiz_stats, quiz_stats_report
+from grading.aggregation import aggregate_quiz_stats
 from exams.models import Exam as Quiz
 from answer_sheets.models import AnswerSheetTemplate
 from answer_keys.models import AnswerKey
@@ -60,7 +75,9 @@ class GradeListView(APIView):
         serializer = GradeSerializer(data=request.data)
         if serializer.is_valid():
             grade_obj = Grade(**serializer.validated_data)
+            stats_update = QuizStatsUpdate(added=[grade_snapshot(grade_obj)])
             grade_obj.save()
+            stats_update.apply()
             return Response(GradeSerializer(grade_obj).data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -81,9 +98,12 @@ class GradeDetailView(APIView):
             return Response({'error': 'Not found'}, status=404)
         serializer = GradeSerializer(grade_obj, data=request.data)
         if serializer.is_valid():
+            old_snapshot = grade_snapshot(grade_obj)
             for attr, value in serializer.validated_data.items():
                 setattr(grade_obj, attr, value)
+            stats_update = QuizStatsUpdate(removed=[old_snapshot], added=[grade_snapshot(grade_obj)])
             grade_obj.save()
+            stats_update.apply()
             return Response(GradeSerializer(grade_obj).data)
         return Response(serializer.errors, status=400)
 
@@ -91,7 +111,9 @@ class GradeDetailView(APIView):
         grade_obj = self.get_object(id)
         if not grade_obj:
             return Response({'error': 'Not found'}, status=404)
+        stats_update = QuizStatsUpdate(removed=[grade_snapshot(grade_obj)])
         grade_obj.delete()
+        stats_update.apply()
         return Response(status=204)
 
 
@@ -101,6 +123,19 @@ def scan_answer_sheet(request):
     """
     Scan and grade answer sheet
     POST /api/grading/scan/
+    POST /api/grading/scan/?async=true  → 202 {'job_id', 'status', 'status_url'}
+    
+    Optional params (query or form data):
+        annotate: 'none' | 'thumbnail' | 'full' (default: full)
+        annotation_output: 'inline' (base64) | 'url' (cached file under MEDIA_URL)
+            | 'binary' (multipart/mixed response: JSON part + raw image part,
+            also chosen by 'Accept: multipart/mixed' for synchronous scans)
+        annotation_format: 'jpeg' | 'webp' | 'png' (default: GRADING_CONFIG['ANNOTATION_FORMAT'])
+        annotation_quality: 1..100 (default: GRADING_CONFIG['IMAGE_QUALITY'])
+        annotation_max_width, annotation_max_height: Bounds of the annotated image in pixels
+        annotation_crop: 'answer_area' | 'student_id' | 'quiz_id' | 'class_id' | 'ids'
+        scan_session: Client-chosen id of a burst of scans with a fixed camera;
+            markers are tracked from the previous scan of the session
     """
     try:
         # 1. Validate input
@@ -115,6 +150,14 @@ def scan_answer_sheet(request):
         quiz_id = request.data['quiz_id']
         answersheet_id = request.data['answersheet_id']
         teacher_id = str(request.user.id)
+        try:
+            annotate = annotate_mode(read_param(request, 'annotate'))
+            annotation_encoding = read_annotation_encoding(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        async_scan = str(read_param(request, 'async', 'false')).lower() in ('1', 'true', 'yes')
+        annotation_output = read_annotation_output(request, async_scan)
+        scan_session = read_param(request, 'scan_session')
         
         # 2. Check image size
         grading_config = getattr(settings, 'GRADING_CONFIG', {})
@@ -126,44 +169,270 @@ def scan_answer_sheet(request):
                 'error': f'Image size too large. Max size: {max_size_mb}MB. Current: {image_size_mb:.2f}MB'
             }, status=400)
         
-        # 3. Save temporary image
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            for chunk in image_file.chunks():
-                temp_file.write(chunk)
-            temp_path = temp_file.name
+        # 3. Read the upload into memory (decoded with cv2.imdecode, no temp file)
+        image_bytes = read_upload(image_file)
+        
+        # 4a. Job mode: queue the scan and return the job id at once
+        if async_scan:
+            if annotation_output == 'binary':
+                return Response({'error': 'annotation_output=binary is not supported for async scans, use url'},
+                                status=400)
+            try:
+                job = get_job_queue().submit(
+                    scan_and_grade,
+                    teacher_id,
+                    image_bytes,
+                    quiz_id=quiz_id,
+                    answersheet_id=answersheet_id,
+                    teacher_id=teacher_id,
+                    annotate=annotate,
+                    annotation_output=annotation_output,
+                    annotation_encoding=annotation_encoding,
+                    scan_session=scan_session,
+                )
+            except GradingOverloaded as e:
+                return Response({'error': str(e)}, status=503)
+            return Response({
+                'job_id': job.job_id,
+                'status': job.status,
+                'status_url': f'/api/grading/scan/jobs/{job.job_id}/',
+            }, status=202)
+        
+        # 4. Process image
+        result = scan_and_grade(
+            image_path=image_bytes,
+            quiz_id=quiz_id,
+            answersheet_id=answersheet_id,
+            teacher_id=teacher_id,
+            annotate=annotate,
+            annotation_output=annotation_output,
+            annotation_encoding=annotation_encoding,
+            scan_session=scan_session,
+        )
+        
+        if not result.get('success'):
+            return Response({
+                'error': result.get('error', 'Processing failed')
+            }, status=_scan_error_status(result))
+        
+        # 5. Return result (JSON, or JSON part + raw image part)
+        if annotation_output == 'binary':
+            boundary = multipart.new_boundary()
+            parts = [*multipart.result_parts(boundary, result, 'result', JSONEncoder), multipart.closing(boundary)]
+            return StreamingHttpResponse(parts, content_type=multipart.content_type(boundary))
+        return Response(result)
+                
+    except Exception as e:
+        logger.error(f"Error scanning answer sheet: {str(e)}")
+        return Response({
+            'error': f'Internal server error: {str(e)}'
+        }, status=500)
+
+
+def read_upload(uploaded_file):
+    """Bytes of an uploaded file (small uploads are already in memory)"""
+    uploaded_file.seek(0)
+    return uploaded_file.read()
+
+
+def read_param(request, name, default=None):
+    """Request param from the query string, else from the form data"""
+    return request.query_params.get(name, request.data.get(name, default))
+
+
+def read_annotation_output(request, async_scan=False):
+    """
+    annotation_output param; 'binary' when absent and the client accepts multipart/mixed
+
+    The Accept header is ignored for async scans (their result is polled as JSON).
+    """
+    annotation_output = read_param(request, 'annotation_output')
+    if not annotation_output and not async_scan \
+            and multipart.MULTIPART_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+        return 'binary'
+    return annotation_output
+
+
+def read_annotation_encoding(request):
+    """
+    Annotated image encoding from the annotation_* request params (query or form data)
+
+    Raises:
+        ValueError: for an invalid format, quality, size or crop region
+    """
+    overrides = {
+        key: read_param(request, f'annotation_{key}')
+        for key in ('format', 'quality', 'max_width', 'max_height', 'crop')
+    }
+    return get_annotation_encoding(overrides)
+
+
+def _scan_error_status(result):
+    """HTTP status of a failed scan result"""
+    if result.get('overloaded'):
+        return 503
+    if result.get('timeout'):
+        return 504
+    return 400
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def scan_job_status(request, job_id):
+    """
+    Status / result of an asynchronous scan
+    GET /api/grading/scan/jobs/<job_id>/
+    """
+    job = get_job_queue().get(job_id, teacher_id=str(request.user.id))
+    if job is None:
+        return Response({'error': 'Scan job not found'}, status=404)
+    return Response(job.to_dict())
+
+
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def scan_answer_sheet_batch(request):
+    """
+    Scan and grade many answer sheets of the same quiz in one request
+    POST /api/grading/scan/batch/
+    
+    Form data:
+        images: Image files (repeated field), and/or
+        archive: Zip file of images
+        quiz_id, answersheet_id
+        annotate: 'none' | 'thumbnail' | 'full' annotated images (default: none)
+        annotation_output: 'inline' (base64) | 'url' (cached file under MEDIA_URL)
+            | 'binary' (streamed multipart/mixed: JSON + image part per sheet
+            as it is graded, then a JSON summary part)
+        annotation_format, annotation_quality, annotation_max_width,
+        annotation_max_height, annotation_crop, scan_session: see scan_answer_sheet
+    
+    annotate, annotation_* and scan_session may also be query params, as for scan_answer_sheet.
+    """
+    try:
+        # 1. Validate input
+        images = request.FILES.getlist('images')
+        archive = request.FILES.get('archive')
+        if not images and archive is None:
+            return Response({'error': 'No images or archive provided'}, status=400)
+        if 'quiz_id' not in request.data:
+            return Response({'error': 'No quiz_id provided'}, status=400)
+        if 'answersheet_id' not in request.data:
+            return Response({'error': 'No answersheet_id provided'}, status=400)
         
+        quiz_id = request.data['quiz_id']
+        answersheet_id = request.data['answersheet_id']
         try:
-            # 4. Process image
-            result = scan_and_grade(
-                image_path=temp_path,
+            annotate = annotate_mode(read_param(request, 'annotate'), 'none')
+            annotation_encoding = read_annotation_encoding(request)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=400)
+        annotation_output = read_annotation_output(request)
+        scan_session = read_param(request, 'scan_session')
+        teacher_id = str(request.user.id)
+        
+        grading_config = getattr(settings, 'GRADING_CONFIG', {})
+        max_size_mb = grading_config.get('MAX_IMAGE_SIZE_MB', 10)
+        max_batch_size = grading_config.get('MAX_BATCH_SIZE', 200)
+        
+        archive_members = []
+        zf = None
+        if archive is not None:
+            try:
+                zf = zipfile.ZipFile(archive)
+            except zipfile.BadZipFile:
+                return Response({'error': 'Invalid zip archive'}, status=400)
+            archive_members = [
+                info for info in zf.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(BATCH_IMAGE_EXTENSIONS)
+            ]
+        
+        # 2. Check batch and image sizes
+        named_sizes = [(f.name, f.size) for f in images] + [(i.filename, i.file_size) for i in archive_members]
+        if not named_sizes:
+            return Response({'error': 'No images found in request'}, status=400)
+        if len(named_sizes) > max_batch_size:
+            return Response({
+                'error': f'Too many images. Max batch size: {max_batch_size}. Current: {len(named_sizes)}'
+            }, status=400)
+        for name, size in named_sizes:
+            image_size_mb = size / (1024 * 1024)
+            if image_size_mb > max_size_mb:
+                return Response({
+                    'error': f'Image {name} too large. Max size: {max_size_mb}MB. Current: {image_size_mb:.2f}MB'
+                }, status=400)
+        
+        # 3. Read images lazily (uploaded files + archive members), one per sheet submitted
+        def iter_images():
+            for image_file in images:
+                yield image_file.name, read_upload(image_file)
+            for info in archive_members:
+                yield info.filename, zf.read(info)
+        
+        # 4a. Binary mode: stream each sheet's parts as soon as it is graded
+        if annotation_output == 'binary':
+            batch = iter_scan_and_grade_batch(
+                image_paths=iter_images(),
                 quiz_id=quiz_id,
                 answersheet_id=answersheet_id,
-                teacher_id=teacher_id
+                teacher_id=teacher_id,
+                annotate=annotate,
+                annotation_output=annotation_output,
+                annotation_encoding=annotation_encoding,
+                scan_session=scan_session,
             )
-            
-            if not result.get('success'):
+            if not batch.get('success'):
                 return Response({
-                    'error': result.get('error', 'Processing failed')
-                }, status=400)
-            
-            # 5. Return result
-            return Response(result)
-            
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                try:
-                    os.unlink(temp_path)
-                except Exception as e:
-                    logger.warning(f"Failed to delete temp file: {e}")
-                
+                    'error': batch.get('error', 'Processing failed')
+                }, status=_scan_error_status(batch))
+            boundary = multipart.new_boundary()
+            return StreamingHttpResponse(
+                stream_batch_parts(boundary, batch['results']),
+                content_type=multipart.content_type(boundary),
+            )
+        
+        # 4. Process images
+        result = scan_and_grade_batch(
+            image_paths=iter_images(),
+            quiz_id=quiz_id,
+            answersheet_id=answersheet_id,
+            teacher_id=teacher_id,
+            annotate=annotate,
+            annotation_output=annotation_output,
+            annotation_encoding=annotation_encoding,
+            scan_session=scan_session,
+        )
+        
+        if not result.get('success'):
+            return Response({
+                'error': result.get('error', 'Processing failed')
+            }, status=_scan_error_status(result))
+        
+        # 5. Return result
+        return Response(result)
+    
     except Exception as e:
-        logger.error(f"Error scanning answer sheet: {str(e)}")
+        logger.error(f"Error scanning answer sheet batch: {str(e)}")
         return Response({
             'error': f'Internal server error: {str(e)}'
         }, status=500)
 
 
+def stream_batch_parts(boundary, results):
+    """multipart/mixed body of a batch: parts of each sheet, then {'success', 'count', 'graded', 'failed'}"""
+    count = graded = 0
+    for result in results:
+        count += 1
+        graded += 1 if result.get('success') else 0
+        yield from multipart.result_parts(boundary, result, f"sheet-{result['index']}", JSONEncoder)
+    summary = {'success': True, 'count': count, 'graded': graded, 'failed': count - graded}
+    yield multipart.json_part(boundary, summary, 'summary', JSONEncoder)
+    yield multipart.closing(boundary)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_template_json_api(request):
@@ -199,9 +468,8 @@ def get_template_json_api(request):
                 status=404,
             )
 
-        # Load JSON file and return content
-        with open(template.file_json, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # Template content from the compiled-template cache (parsed once per file version)
+        data = get_compiled_template(template.file_json, key=answersheet_id).data
 
         return Response({'success': True, 'template': data})
 
@@ -361,23 +629,9 @@ def preview_check_api(request):
         
         image_file = request.FILES['image']
         
-        # Save temporary image
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            for chunk in image_file.chunks():
-                temp_file.write(chunk)
-            temp_path = temp_file.name
-        
-        try:
-            # Check markers
-            result = preview_check(temp_path)
-            return Response(result)
-        finally:
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                try:
-                    os.unlink(temp_path)
-                except Exception as e:
-                    logger.warning(f"Failed to delete temp file: {e}")
+        # Check markers (decoded in memory)
+        result = preview_check(read_upload(image_file))
+        return Response(result)
                 
     except Exception as e:
         logger.error(f"Error in preview check: {str(e)}")
@@ -525,6 +779,16 @@ def save_grade_api(request):
                     f.write(chunk)
             annotated_image_path = f"/media/grading/annotated_images/{filename}"
         
+        # Or keep an annotated image rendered by scan (annotation_output=url)
+        elif request.data.get('annotated_image_url') and annotated_image_dir:
+            cached_name = os.path.basename(str(request.data['annotated_image_url']))
+            cached_path = os.path.join(annotation_cache_dir(), cached_name)
+            if cached_name and str(request.data['annotated_image_url']).endswith(annotation_url(cached_name)) \
+                    and is_annotation_owner(cached_name, teacher_id) and os.path.isfile(cached_path):
+                os.makedirs(annotated_image_dir, exist_ok=True)
+                os.replace(cached_path, os.path.join(annotated_image_dir, cached_name))
+                annotated_image_path = f"/media/grading/annotated_images/{cached_name}"
+        
         # Create new Grade record (allow duplicates - like ZipGrade)
         from bson import ObjectId
         
@@ -544,7 +808,9 @@ def save_grade_api(request):
             annotated_image=annotated_image_path or '',
             scanned_at=datetime.now()
         )
+        stats_update = QuizStatsUpdate(added=[grade_snapshot(grade)])
         grade.save()
+        stats_update.apply()
         
         # Return result
         serializer = GradeSerializer(grade)
@@ -643,13 +909,22 @@ def get_grades_for_quiz(request):
 def item_analysis(request):
     """
     Get item analysis for a quiz
-    GET /api/grading/item-analysis/?quiz_id=xxx
+    GET /api/grading/item-analysis/?quiz_id=xxx[&backend=engine|aggregate]
+    
+    backend=aggregate counts in MongoDB and returns the counts, option
+    distribution, difficulty and score summary only (no discrimination,
+    point-biserial or reliability).
     """
     try:
         quiz_id = request.query_params.get('quiz_id')
         if not quiz_id:
             return Response({'error': 'quiz_id is required'}, status=400)
         
+        grading_config = getattr(settings, 'GRADING_CONFIG', {})
+        backend = request.query_params.get('backend') or grading_config.get('ITEM_ANALYSIS_BACKEND', 'engine')
+        if backend not in ('engine', 'aggregate'):
+            return Response({'error': "backend must be 'engine' or 'aggregate'"}, status=400)
+        
         teacher_id = str(request.user.id)
         
         # Verify quiz exists and teacher has permission
@@ -678,12 +953,21 @@ def item_analysis(request):
             logger.warning(f"Failed to convert teacher_id to ObjectId: {teacher_id}, error: {str(e)}")
             teacher_object_id = teacher_id
         
-        # Query grades with error handling
+        if backend == 'aggregate':
+            stats = aggregate_quiz_stats(quiz_id, teacher_object_id)
+            return Response({
+                'quiz_id': quiz_id,
+                'backend': backend,
+                **quiz_stats_report(stats, KeyMatrix(answer_key.versions, num_questions), num_questions),
+            })
+        
+        # Load the grades once into an answer matrix (one query, raw documents)
         try:
             grades = Grade.objects(
                 exam_id=quiz_id,
                 teacher_id=teacher_object_id
-            )
+            ).only('answers', 'version_code', 'score', 'percentage').as_pymongo()
+            grade_matrix = GradeMatrix.from_documents(grades, num_questions)
         except Exception as query_error:
             logger.error(f"Error querying grades for item analysis quiz {quiz_id}: {str(query_error)}")
             import traceback
@@ -692,7 +976,7 @@ def item_analysis(request):
                 'error': f'Failed to query grades: {str(query_error)}'
             }, status=500)
         
-        total_papers = grades.count()
+        total_papers = grade_matrix.num_papers
         if total_papers == 0:
             return Response({
                 'quiz_id': quiz_id,
@@ -701,151 +985,62 @@ def item_analysis(request):
                 'items': []
             })
         
-        # Helper function to get correct answer for a version
-        def get_correct_answer_for_version(version_code, question_str):
-            """Get correct answer for a specific version and question"""
-            if not answer_key.versions:
-                return None
-            
-            # Find version matching version_code
-            version = next(
-                (v for v in answer_key.versions if v.get('version_code') == version_code),
-                None
-            )
-            
-            if not version or 'questions' not in version:
-                return None
-            
-            # Find question in this version
-            for q in version['questions']:
-                if str(q.get('order', '')) == question_str or str(q.get('question_code', '')) == question_str:
-                    return q.get('answer', '')
-            
-            return None
+        # Vectorized counts against the (versions x questions) key matrix
+        key_matrix = KeyMatrix(answer_key.versions, num_questions)
+        return Response({
+            'quiz_id': quiz_id,
+            **item_analysis_report(grade_matrix, key_matrix),
+        })
         
-        # Calculate item statistics
-        items = []
-        for q_idx in range(1, num_questions + 1):
-            q_str = str(q_idx)
-            
-            # Count correct/incorrect for this question
-            correct_count = 0
-            incorrect_count = 0
-            blank_count = 0
-            
-            # Get correct answer from first version (for display purposes)
-            # But we'll check each grade's version when counting
-            display_correct_answer = None
-            if answer_key.versions and len(answer_key.versions) > 0:
-                first_version = answer_key.versions[0]
-                if 'questions' in first_version:
-                    for q in first_version['questions']:
-                        if str(q.get('order', '')) == q_str or str(q.get('question_code', '')) == q_str:
-                            display_correct_answer = q.get('answer', '')
-                            break
-            
-            # Count answers - check each grade's version
-            for grade in grades:
-                answers = grade.answers or {}
-                student_answer = answers.get(q_str)
-                
-                if student_answer is None or student_answer == '' or student_answer == -1:
-                    blank_count += 1
-                else:
-                    # Get correct answer for this grade's version
-                    version_code = grade.version_code or ''
-                    correct_answer = get_correct_answer_for_version(version_code, q_str)
-                    
-                    if not correct_answer:
-                        # If no correct answer found for this version, count as incorrect
-                        incorrect_count += 1
-                    else:
-                        # Convert both to comparable format
-                        # student_answer is stored as index (0, 1, 2, 3, 4) or list [0]
-                        # correct_answer is stored as letter ("A", "B", "C", "D", "E")
-                        
-                        # Handle student_answer - could be int, list, or string
-                        student_idx = None
-                        if isinstance(student_answer, list):
-                            if len(student_answer) > 0:
-                                student_idx = student_answer[0]
-                        elif isinstance(student_answer, int):
-                            student_idx = student_answer
-                        elif isinstance(student_answer, str):
-                            # Try to parse as int
-                            try:
-                                student_idx = int(student_answer)
-                            except:
-                                # If it's a letter, convert to index
-                                if len(student_answer) > 0:
-                                    student_idx = ord(student_answer.upper()[0]) - ord('A')
-                        
-                        # Convert correct_answer from letter to index
-                        correct_idx = None
-                        if isinstance(correct_answer, str) and len(correct_answer) > 0:
-                            correct_idx = ord(correct_answer.upper()[0]) - ord('A')
-                        elif isinstance(correct_answer, int):
-                            correct_idx = correct_answer
-                        
-                        # Compare
-                        if student_idx is not None and correct_idx is not None and student_idx == correct_idx:
-                            correct_count += 1
-                        else:
-                            incorrect_count += 1
-            
-            # Calculate percentages
-            correct_percent = (correct_count / total_papers * 100) if total_papers > 0 else 0
-            incorrect_percent = (incorrect_count / total_papers * 100) if total_papers > 0 else 0
-            blank_percent = (blank_count / total_papers * 100) if total_papers > 0 else 0
-            
-            items.append({
-                'question_number': q_idx,
-                'correct_answer': display_correct_answer or '',
-                'correct_count': correct_count,
-                'incorrect_count': incorrect_count,
-                'blank_count': blank_count,
-                'correct_percent': round(correct_percent, 2),
-                'incorrect_percent': round(incorrect_percent, 2),
-                'blank_percent': round(blank_percent, 2),
-            })
+    except Exception as e:
+        logger.error(f"Error in item analysis: {str(e)}")
+        return Response({'error': str(e)}, status=500)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def quiz_stats(request):
+    """
+    Get dashboard statistics of a quiz from its materialized stats document
+    GET /api/grading/quiz-stats/?quiz_id=xxx[&rebuild=true]
+    """
+    try:
+        quiz_id = request.query_params.get('quiz_id')
+        if not quiz_id:
+            return Response({'error': 'quiz_id is required'}, status=400)
+        
+        teacher_id = str(request.user.id)
         
-        # Calculate overall statistics
-        scores = [g.score for g in grades if g.score is not None]
-        percentages = [g.percentage for g in grades if g.percentage is not None]
+        try:
+            quiz = Quiz.objects.get(id=quiz_id)
+        except Quiz.DoesNotExist:
+            return Response({'error': 'Quiz not found'}, status=404)
         
-        min_score = min(scores) if scores else 0
-        max_score = max(scores) if scores else 0
-        avg_score = sum(scores) / len(scores) if scores else 0
-        avg_percent = sum(percentages) / len(percentages) if percentages else 0
+        if str(quiz.teacher_id) != teacher_id:
+            return Response({'error': 'Permission denied'}, status=403)
         
-        # Calculate median
-        sorted_scores = sorted(scores) if scores else []
-        median_score = sorted_scores[len(sorted_scores) // 2] if sorted_scores else 0
+        answer_key = AnswerKey.objects(quiz_id=quiz_id).first()
+        if not answer_key:
+            return Response({
+                'error': 'Answer key not found for this quiz'
+            }, status=404)
         
-        # Calculate standard deviation
-        if scores and len(scores) > 1:
-            variance = sum((x - avg_score) ** 2 for x in scores) / len(scores)
-            std_dev = variance ** 0.5
-        else:
-            std_dev = 0
+        from bson import ObjectId
+        try:
+            teacher_object_id = ObjectId(teacher_id)
+        except Exception:
+            teacher_object_id = teacher_id
         
+        rebuild = str(request.query_params.get('rebuild', '')).lower() in ('1', 'true', 'yes')
+        stats = get_quiz_stats(quiz_id, teacher_object_id, rebuild=rebuild)
+        num_questions = answer_key.num_questions
         return Response({
             'quiz_id': quiz_id,
-            'total_papers': total_papers,
-            'num_questions': num_questions,
-            'items': items,
-            'statistics': {
-                'min_score': round(min_score, 2),
-                'max_score': round(max_score, 2),
-                'average_score': round(avg_score, 2),
-                'average_percent': round(avg_percent, 2),
-                'median_score': round(median_score, 2),
-                'std_deviation': round(std_dev, 2),
-            }
+            **quiz_stats_report(stats, KeyMatrix(answer_key.versions, num_questions), num_questions),
         })
         
     except Exception as e:
-        logger.error(f"Error in item analysis: {str(e)}")
+        logger.error(f"Error in quiz stats: {str(e)}")
         return Response({'error': str(e)}, status=500)
 
 